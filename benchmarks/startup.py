@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+# Offline startup benchmark.
+#
+# Runs rdscli startup (everything up to the tunnel being ready) against in-process fakes of the AWS services it calls.
+# Fakes add configurable latency to every call and move the proxy through the states it goes through in AWS:
+# stack being created, ASG scaled up from 0, instance launching and registering with SSM. The tunnel is a stand-in
+# process started the same way session-manager-plugin is.
+#
+# Time is simulated: rdscli sees simulated seconds, which pass --speed times faster than real ones, so a cold start
+# of a few minutes runs in a couple of seconds. Reported are simulated wall time, AWS call counts and the sleeps
+# rdscli made while waiting, per scenario:
+#
+#   cold  - no stack, no cached discovery
+#   warm  - stack up to date, ASG at 0, discovery cached
+#   hot   - stack up to date, instance in service
+#
+#   python3 benchmarks/startup.py --latency DescribeStacks=0.5 --launch=40
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rdscli
+
+botocore = rdscli.import_botocore()
+
+# Typical latencies of AWS calls, in seconds
+DEFAULT_LATENCIES = {
+    'GetSecretValue': 0.15,
+    'DescribeDBInstances': 0.3,
+    'DescribeSubnets': 0.2,
+    'DescribeRouteTables': 0.2,
+    'DescribeNetworkAcls': 0.2,
+    'DescribeVpcEndpoints': 0.2,
+    'DescribeImages': 0.2,
+    'DescribeStacks': 0.25,
+    'CreateStack': 0.5,
+    'UpdateStack': 0.5,
+    'DescribeStackEvents': 0.25,
+    'Invoke': 0.3,
+    'DescribeAutoScalingGroups': 0.15,
+    'DescribeInstanceInformation': 0.2,
+    'DescribeInstances': 0.2,
+}
+
+DEFAULT_STACK_CREATE = 120
+DEFAULT_LAUNCH = 20
+DEFAULT_SSM_REGISTER = 8
+DEFAULT_TUNNEL = 1
+
+# What the README promises (2-3 min cold, ~30s warm, under 5s hot), in seconds
+BUDGETS = {
+    'cold': 180,
+    'warm': 40,
+    'hot': 5,
+}
+
+SCENARIOS = ['cold', 'warm', 'hot']
+
+SECRET_ID = 'bench/db'
+DB_HOST = 'bench.abcdefgh1234.eu-west-1.rds.amazonaws.com'
+GROUP_ID = 'sg-0123456789abcdef0'
+SUBNET_ID = 'subnet-0123456789abcdef0'
+VPC_ID = 'vpc-0123456789abcdef0'
+INSTANCE_ID = 'i-0123456789abcdef0'
+
+
+class SimulatedTime:
+    # Replaces the time module for rdscli. Simulated seconds pass `speed` times faster than real ones.
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.real_start = time.time()
+        self.lock = threading.Lock()
+        self.sleeps = 0
+        self.slept = 0
+
+    def time(self):
+        return self.real_start + (time.time() - self.real_start) * self.speed
+
+    def sleep(self, seconds):
+        # Sleeps rdscli makes while waiting for something
+        with self.lock:
+            self.sleeps += 1
+            self.slept += seconds
+        time.sleep(seconds / self.speed)
+
+    def wait(self, seconds):
+        # Time AWS takes to respond, not counted as sleeping
+        time.sleep(seconds / self.speed)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def client_error(code, message, operation):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeAws:
+    # State of the simulated account, shared by all fake clients
+
+    def __init__(self, clock, latencies, stack_create, launch, ssm_register):
+        self.clock = clock
+        self.latencies = latencies
+        self.stack_create = stack_create
+        self.launch = launch
+        self.ssm_register = ssm_register
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stacks = {}
+        self.capacity = 0
+        self.launched_at = None
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.clock.wait(self.latencies.get(operation, 0.1))
+
+    def instance_age(self):
+        if self.capacity == 0 or self.launched_at is None:
+            return None
+        return self.clock.time() - self.launched_at
+
+    def set_capacity(self, capacity):
+        with self.lock:
+            if capacity > 0 and self.capacity == 0:
+                self.launched_at = self.clock.time()
+            self.capacity = capacity
+
+    def make_ready(self):
+        # Stack and instance as they are after a long enough wait
+        for stack in self.stacks.values():
+            stack['ready_at'] = 0
+            stack['operations'] = [(0, 0, operation) for _, _, operation in stack['operations']]
+        if self.capacity > 0:
+            self.launched_at = -self.launch - self.ssm_register
+
+
+class FakeSecrets:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_secret_value(self, SecretId):
+        self.aws.call('GetSecretValue')
+        secret = {'host': DB_HOST, 'port': 3306, 'username': 'admin', 'password': 'secret', 'engine': 'mysql'}
+        return {'ARN': f'arn:aws:secretsmanager:eu-west-1:123456789012:secret:{SecretId}', 'SecretString': json.dumps(secret)}
+
+
+class FakeRds:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_db_instances(self, DBInstanceIdentifier):
+        self.aws.call('DescribeDBInstances')
+        return {'DBInstances': [{
+            'DBInstanceIdentifier': DBInstanceIdentifier,
+            'VpcSecurityGroups': [{'VpcSecurityGroupId': GROUP_ID}],
+            'DBSubnetGroup': {'VpcId': VPC_ID, 'Subnets': [
+                {'SubnetIdentifier': 'subnet-isolated', 'SubnetStatus': 'Active'},
+                {'SubnetIdentifier': SUBNET_ID, 'SubnetStatus': 'Active'},
+            ]},
+        }]}
+
+
+class FakeEc2:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_subnets(self, SubnetIds):
+        self.aws.call('DescribeSubnets')
+        return {'Subnets': [{'SubnetId': i, 'VpcId': VPC_ID, 'State': 'available'} for i in SubnetIds]}
+
+    def describe_route_tables(self, Filters):
+        # Only one of the subnets has a way out, the other one uses the main route table
+        self.aws.call('DescribeRouteTables')
+        local = {'DestinationCidrBlock': '10.0.0.0/16', 'GatewayId': 'local', 'State': 'active'}
+        return {'RouteTables': [
+            {'Associations': [{'Main': True}], 'Routes': [local]},
+            {'Associations': [{'SubnetId': SUBNET_ID}], 'Routes': [
+                local, {'DestinationCidrBlock': '0.0.0.0/0', 'NatGatewayId': 'nat-0123456789abcdef0', 'State': 'active'}
+            ]},
+        ]}
+
+    def describe_network_acls(self, Filters):
+        self.aws.call('DescribeNetworkAcls')
+        return {'NetworkAcls': [{'NetworkAclId': 'acl-0123456789abcdef0', 'IsDefault': True, 'Entries': [
+            {'RuleNumber': 100, 'Protocol': '-1', 'Egress': egress, 'CidrBlock': '0.0.0.0/0', 'RuleAction': 'allow'}
+            for egress in [True, False]
+        ]}]}
+
+    def describe_vpc_endpoints(self, Filters):
+        self.aws.call('DescribeVpcEndpoints')
+        return {'VpcEndpoints': []}
+
+    def describe_images(self, ImageIds):
+        self.aws.call('DescribeImages')
+        return {'Images': [{'ImageId': i, 'RootDeviceName': '/dev/xvda'} for i in ImageIds]}
+
+    def describe_instances(self, InstanceIds):
+        self.aws.call('DescribeInstances')
+        age = self.aws.instance_age()
+        state = 'terminated' if age is None else 'running' if age >= self.aws.launch else 'pending'
+        return {'Reservations': [{'Instances': [{'InstanceId': InstanceIds[0], 'State': {'Name': state}}]}]}
+
+
+class FakeStackEventPaginator:
+    def __init__(self, cf):
+        self.cf = cf
+
+    def paginate(self, StackName):
+        yield self.cf.describe_stack_events(StackName)
+
+
+class FakeCloudFormation:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def find_stack(self, StackName, operation):
+        # Stacks can be referred to by name or by id
+        stack = self.aws.stacks.get(StackName.split('/')[1] if StackName.startswith('arn:') else StackName)
+        if stack is None:
+            raise client_error('ValidationError', f'Stack with id {StackName} does not exist', operation)
+        return stack
+
+    def stack_status(self, stack):
+        in_progress = self.aws.clock.time() < stack['ready_at']
+        return stack['operation'] + ('_IN_PROGRESS' if in_progress else '_COMPLETE')
+
+    def describe_stacks(self, StackName):
+        self.aws.call('DescribeStacks')
+        stack = self.find_stack(StackName, 'DescribeStacks')
+        status = self.stack_status(stack)
+        stack_id = stack['StackName'][len('tcp-proxy-'):]
+        return {'Stacks': [{
+            'StackId': stack['StackId'],
+            'StackName': stack['StackName'],
+            'StackStatus': status,
+            'Parameters': stack['Parameters'],
+            'Tags': stack['Tags'],
+            'Outputs': [] if status.endswith('_IN_PROGRESS') else [
+                {'OutputKey': 'ControlLambdaFunction', 'OutputValue': f'tcp-proxy-control-{stack_id}'},
+                {'OutputKey': 'AutoScalingGroup', 'OutputValue': f'tcp-proxy-asg-{stack_id}'},
+            ],
+        }]}
+
+    def describe_stack_events(self, StackName):
+        self.aws.call('DescribeStackEvents')
+        stack = self.find_stack(StackName, 'DescribeStackEvents')
+        # Every operation has one event when it starts and one when it is done, newest first
+        events = []
+        for number, (started_at, ready_at, operation) in enumerate(stack['operations']):
+            events.append((started_at, f'{number}-start', operation + '_IN_PROGRESS'))
+            if self.aws.clock.time() >= ready_at:
+                events.append((ready_at, f'{number}-end', operation + '_COMPLETE'))
+        return {'StackEvents': [{
+            'EventId': event_id,
+            'Timestamp': datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc),
+            'LogicalResourceId': stack['StackName'],
+            'ResourceStatus': status,
+        } for timestamp, event_id, status in reversed(events)]}
+
+    def get_paginator(self, name):
+        return FakeStackEventPaginator(self)
+
+    def start_operation(self, stack, operation, duration):
+        now = self.aws.clock.time()
+        stack.update({'operation': operation, 'ready_at': now + duration})
+        stack['operations'].append((now, now + duration, operation))
+
+    def create_stack(self, StackName, Parameters, Tags, **kwargs):
+        self.aws.call('CreateStack')
+        stack = self.aws.stacks[StackName] = {
+            'StackId': f'arn:aws:cloudformation:eu-west-1:000000000000:stack/{StackName}/bench',
+            'StackName': StackName,
+            'Parameters': Parameters,
+            'Tags': Tags,
+            'operations': [],
+        }
+        self.start_operation(stack, 'CREATE', self.aws.stack_create)
+        # New ASG starts with one instance
+        self.aws.set_capacity(1)
+        return {'StackId': stack['StackId']}
+
+    def update_stack(self, StackName, Parameters, Tags, **kwargs):
+        self.aws.call('UpdateStack')
+        stack = self.find_stack(StackName, 'UpdateStack')
+        stack.update({'Parameters': Parameters, 'Tags': Tags})
+        self.start_operation(stack, 'UPDATE', self.aws.stack_create / 4)
+
+
+class FakeLambda:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def invoke(self, FunctionName, Payload):
+        self.aws.call('Invoke')
+
+        stack = self.aws.stacks.get('tcp-proxy-' + FunctionName[len('tcp-proxy-control-'):])
+        if stack is None or stack['operation'] == 'CREATE' and self.aws.clock.time() < stack['ready_at']:
+            raise client_error('ResourceNotFoundException', f'Function not found: {FunctionName}', 'Invoke')
+
+        reply = None
+        if json.loads(Payload).get('Action') == 'activate':
+            # Instance that has been up for a while is reported ready, same as the monitor would have it checking in
+            age = self.aws.instance_age()
+            ready = age is not None and age >= self.aws.launch + self.aws.ssm_register
+            self.aws.set_capacity(1)
+            reply = {'Ready': ready}
+            if ready:
+                reply.update({'InstanceId': INSTANCE_ID, 'HealthStatus': 'Healthy', 'LastReport': '2024-01-01 00:00:00'})
+
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(reply).encode())}
+
+
+class FakeAutoScaling:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.aws.call('DescribeAutoScalingGroups')
+        age = self.aws.instance_age()
+        instances = []
+        if age is not None:
+            state = 'InService' if age >= self.aws.launch else 'Pending'
+            instances.append({'InstanceId': INSTANCE_ID, 'LifecycleState': state, 'HealthStatus': 'Healthy'})
+        return {'AutoScalingGroups': [{
+            'AutoScalingGroupName': AutoScalingGroupNames[0],
+            'DesiredCapacity': self.aws.capacity,
+            'Instances': instances,
+        }]}
+
+
+class FakeSsm:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_instance_information(self, Filters):
+        self.aws.call('DescribeInstanceInformation')
+        age = self.aws.instance_age()
+        if age is None or age < self.aws.launch + self.aws.ssm_register:
+            return {'InstanceInformationList': []}
+        return {'InstanceInformationList': [{'InstanceId': INSTANCE_ID, 'PingStatus': 'Online'}]}
+
+
+def install_fakes(aws, tunnel_seconds):
+    rdscli.aws_clients.update({
+        'secretsmanager': FakeSecrets(aws),
+        'rds': FakeRds(aws),
+        'ec2': FakeEc2(aws),
+        'cloudformation': FakeCloudFormation(aws),
+        'lambda': FakeLambda(aws),
+        'autoscaling': FakeAutoScaling(aws),
+        'ssm': FakeSsm(aws),
+    })
+
+    def open_tunnel(instance_id, host, port, method = 'auto', sessions = 1, local_port = 0, on_connection_closed = None):
+        # Stand-in for session-manager-plugin: a process that runs until the tunnel is closed
+        process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(3600)'])
+        aws.clock.wait(tunnel_seconds)
+        return 13306, process
+
+    def close_tunnel(process):
+        process.terminate()
+        process.wait()
+
+    rdscli.open_tunnel = open_tunnel
+    rdscli.close_tunnel = close_tunnel
+
+
+def startup_args(acquire_timeout):
+    return types.SimpleNamespace(
+        secret_id=SECRET_ID,
+        instance_id=None,
+        group_id=None,
+        subnet_id=None,
+        refresh=False,
+        acquire_timeout=acquire_timeout,
+        tunnel='cli',
+        no_agent=True,
+        local_port=None,
+        reader=False,
+        shared_proxy=False,
+        image_id=None,
+        warm_pool=None,
+        state_store=None,
+    )
+
+
+def run_startup(aws, acquire_timeout, verbose):
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        timer = rdscli.start_timer()
+        _, _, tunnel = rdscli.acquire_tunnel(timer, startup_args(acquire_timeout))
+        rdscli.close_tunnel(tunnel)
+    return timer
+
+
+def run_scenario(scenario, args, cache_dir):
+    clock = SimulatedTime(args.speed)
+    rdscli.time = clock
+
+    latencies = dict(DEFAULT_LATENCIES, **args.latency)
+    aws = FakeAws(clock, latencies, args.stack_create, args.launch, args.ssm_register)
+    install_fakes(aws, args.tunnel)
+
+    # Every scenario starts with empty caches
+    rdscli.CACHE_DIR = tempfile.mkdtemp(dir=cache_dir)
+
+    if scenario != 'cold':
+        # Get stack deployed and discovery cached by a run that is not measured
+        run_startup(aws, args.acquire_timeout, False)
+        aws.make_ready()
+        aws.calls = {}
+        if scenario == 'warm':
+            aws.set_capacity(0)
+
+    clock.sleeps = 0
+    clock.slept = 0
+
+    real_start = time.time()
+    start = clock.time()
+    timer = run_startup(aws, args.acquire_timeout, args.verbose)
+
+    return {
+        'scenario': scenario,
+        'wall': clock.time() - start,
+        'real': time.time() - real_start,
+        'path': timer.path(),
+        'calls': dict(aws.calls),
+        'sleeps': clock.sleeps,
+        'slept': clock.slept,
+        'phases': timer.summary(scenario)['phases'],
+    }
+
+
+def parse_latency(text):
+    name, _, value = text.partition('=')
+    return name, float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rdscli startup against simulated AWS')
+
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f'scenarios to run: {", ".join(SCENARIOS)}. All by default')
+    parser.add_argument('--latency', metavar='OPERATION=SECONDS', type=parse_latency, action='append', default=[],
+                        help='latency of an AWS call, e.g. DescribeStacks=0.5, can be repeated')
+    parser.add_argument('--stack-create', metavar='SECONDS', type=float, default=DEFAULT_STACK_CREATE,
+                        help=f'time to create the stack, default is {DEFAULT_STACK_CREATE}s')
+    parser.add_argument('--launch', metavar='SECONDS', type=float, default=DEFAULT_LAUNCH,
+                        help=f'time for an instance to get in service, default is {DEFAULT_LAUNCH}s')
+    parser.add_argument('--ssm-register', metavar='SECONDS', type=float, default=DEFAULT_SSM_REGISTER,
+                        help=f'time for an instance in service to register with SSM, default is {DEFAULT_SSM_REGISTER}s')
+    parser.add_argument('--tunnel', metavar='SECONDS', type=float, default=DEFAULT_TUNNEL,
+                        help=f'time to open the tunnel, default is {DEFAULT_TUNNEL}s')
+    parser.add_argument('--acquire-timeout', metavar='SECONDS', type=int, default=300,
+                        help='how long rdscli waits for an instance')
+    parser.add_argument('--speed', metavar='N', type=float, default=20,
+                        help='how many times faster than real time the simulation runs, default is 20. Real time spent in rdscli itself is scaled up by as much')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show rdscli output')
+
+    args = parser.parse_args()
+    args.latency = dict(args.latency)
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f'unknown scenario: {scenario}')
+
+    os.chdir(ROOT)
+
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for scenario in args.scenarios or SCENARIOS:
+            results.append(run_scenario(scenario, args, cache_dir))
+
+    over_budget = [r['scenario'] for r in results if r['wall'] > BUDGETS[r['scenario']]]
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            calls = sum(r['calls'].values())
+            print(f'{r["scenario"]:<5} {r["wall"]:8.2f}s (budget {BUDGETS[r["scenario"]]}s, real {r["real"]:.2f}s), '
+                  f'{r["path"]} path, {calls} AWS calls, {r["sleeps"]} sleeps for {r["slept"]:.1f}s')
+            for name, duration in sorted(r['phases'].items(), key=lambda p: -p[1]):
+                print(f'      {name:<28} {duration:8.2f}s')
+            for name, count in sorted(r['calls'].items(), key=lambda c: -c[1]):
+                print(f'      {name:<28} {count:5} calls')
+
+    if over_budget:
+        print(f'Over budget: {", ".join(over_budget)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,222 @@
 import os
 import boto3
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 
-autoscaling_client = boto3.client('autoscaling')
-
-asg = os.environ['AUTOSCALING_GROUP']
+# With a warm pool, scaling in hibernates the instance back into the pool instead of terminating it
+warm_pool = os.environ.get('WARM_POOL') == 'true'
 
 TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
 
-def set_asg_tag(name, value):
-    autoscaling_client.create_or_update_tags(
-        Tags=[
-            {
-                'ResourceId': asg,
-                'ResourceType': 'auto-scaling-group',
-                'Key': name,
-                'Value': value,
-                'PropagateAtLaunch': False
-            },
-        ]
-    )
+# Hours (since Unix epoch) when the proxy was requested after a break, as 4-digit base36 numbers.
+# 60 of them fit into a single tag value.
+HISTORY_TAG = 'ActivationHistory'
+HISTORY_DIGITS = 4
+HISTORY_LIMIT = 60
 
+# A request after this long without requests starts a new session and goes into history
+SESSION_GAP_SECONDS = 60 * 60
 
-def get_asg_tags():
-    response = autoscaling_client.describe_tags(
-        Filters=[
-            {'Name': 'auto-scaling-group', 'Values': [asg]},
-        ],
-    )
+# Demand is expected at an hour of the week if there were sessions at that hour in at least
+# PREDICTION_MIN_WEEKS of the last PREDICTION_WEEKS weeks
+PREDICTION_WEEKS = 4
+PREDICTION_MIN_WEEKS = 2
+
+# Cleanup runs every 5 minutes, so the lead has to be longer than that
+PREWARM_LEAD_SECONDS = 10 * 60
+
+HOURS_IN_WEEK = 7 * 24
+
+# Timestamps that only ever move forward are not rewritten unless they moved by at least this much.
+# Idle time is measured with this allowance, so coalescing can delay cleanup but never cause it.
+# Active instance reports every 5 minutes, so LastActivity is written on every other report.
+COALESCE_SECONDS = {
+    'LastActivity': 10 * 60,
+    'LastSession': 10 * 60,
+    'LastRequest': 60,
+}
+
+IDLE_SECONDS = 10 * 60
+
+# Session that moved less than this many bytes since the previous report is open but not used
+IDLE_SESSION_BYTES = 16 * 1024
+
+# Open sessions without traffic keep the instance for this long on top of IDLE_SECONDS
+IDLE_SESSION_SECONDS = 50 * 60
+
+# Instance with sessions reports at least this often
+REPORT_INTERVAL_SECONDS = 5 * 60
+
+# Activation returns an instance as ready to use when its monitor has reported this recently, allowing for
+# a late or lost report, and has been reporting for long enough for the SSM agent to register after boot
+READY_REPORT_AGE_SECONDS = REPORT_INTERVAL_SECONDS + 60
+READY_AFTER_SECONDS = 60
+
+
+_autoscaling_client = None
+
+
+def autoscaling_client():
+    # Created on first use, so that the logic can be imported and tried out without AWS
+    global _autoscaling_client
+    if _autoscaling_client is None:
+        _autoscaling_client = boto3.client('autoscaling')
+    return _autoscaling_client
+
+
+class AsgTagStore:
+    # State kept in tags of the ASG. Tags and capacity are read with a single call per invocation
+    # and changed tags are written with a single call at the end.
+
+    # Time of the last report is only rewritten once it moved by this much, a tag write on every report would undo the
+    # coalescing of the other timestamps. Every third report of an instance with sessions writes it.
+    last_report_coalesce_seconds = 15 * 60
+
+    def __init__(self, asg):
+        self.asg = asg
+        self.values = {}
+        self.changed = {}
+        self.capacity = None
+        self.instances = None
+
+    def load(self):
+        response = autoscaling_client().describe_auto_scaling_groups(AutoScalingGroupNames=[self.asg])
+        group = response['AutoScalingGroups'][0]
+        self.values = {t['Key']: t['Value'] for t in group.get('Tags', [])}
+        self.capacity = group['DesiredCapacity']
+        self.instances = group.get('Instances', [])
+
+    def get_instances(self):
+        # Instances of the ASG, only described when asked for unless they came along with the tags
+        if self.instances is None:
+            response = autoscaling_client().describe_auto_scaling_groups(AutoScalingGroupNames=[self.asg])
+            self.instances = response['AutoScalingGroups'][0].get('Instances', [])
+        return self.instances
+
+    def refresh_capacity(self):
+        # Capacity was read from the ASG along with the tags
+        pass
+
+    def confirm_running(self):
+        # An instance reported, capacity read from the ASG already accounts for it
+        pass
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def put(self, key, value):
+        if self.values.get(key) != value:
+            self.values[key] = value
+            self.changed[key] = value
+
+    def set_capacity(self, capacity):
+        if self.capacity != capacity:
+            autoscaling_client().set_desired_capacity(
+                AutoScalingGroupName=self.asg,
+                DesiredCapacity=capacity,
+            )
+            self.capacity = capacity
+
+    def save(self):
+        if not self.changed:
+            return
+        autoscaling_client().create_or_update_tags(
+            Tags=[
+                {
+                    'ResourceId': self.asg,
+                    'ResourceType': 'auto-scaling-group',
+                    'Key': k,
+                    'Value': v,
+                    'PropagateAtLaunch': False
+                } for k, v in self.changed.items()
+            ]
+        )
+        self.changed = {}
+
+
+class DynamoDbStore(AsgTagStore):
+    # State kept in a DynamoDB item, which is not subject to Auto Scaling API throttling. The item also remembers
+    # the capacity last set, so reports and cleanups do not call the ASG unless they change it. The capacity can
+    # still be changed outside of the lambda, so activation reads it from the ASG and a report proves it is not 0.
+
+    last_report_coalesce_seconds = 0
+
+    def __init__(self, asg, table):
+        super().__init__(asg)
+        self.table = table
+        self.client = boto3.client('dynamodb')
+
+    def load(self):
+        item = self.client.get_item(TableName=self.table, Key={'Id': {'S': self.asg}}, ConsistentRead=True).get('Item', {})
+        self.values = {k: v['S'] for k, v in item.items() if k not in ['Id', 'Capacity']}
+        # Item without capacity means a new stack, which starts with one instance
+        self.capacity = int(item['Capacity']['N']) if 'Capacity' in item else 1
+
+    def remember_capacity(self, capacity):
+        if self.capacity != capacity:
+            self.capacity = capacity
+            self.changed['Capacity'] = capacity
+
+    def refresh_capacity(self):
+        # Instances come along, which activation describes anyway
+        response = autoscaling_client().describe_auto_scaling_groups(AutoScalingGroupNames=[self.asg])
+        group = response['AutoScalingGroups'][0]
+        self.instances = group.get('Instances', [])
+        self.remember_capacity(group['DesiredCapacity'])
+
+    def confirm_running(self):
+        if self.capacity == 0:
+            self.remember_capacity(1)
+
+    def set_capacity(self, capacity):
+        if self.capacity != capacity:
+            super().set_capacity(capacity)
+            self.changed['Capacity'] = capacity
+
+    def save(self):
+        if not self.changed:
+            return
+        names = {f'#k{i}': k for i, k in enumerate(self.changed)}
+        values = {f':v{i}': {'N': str(v)} if k == 'Capacity' else {'S': v} for i, (k, v) in enumerate(self.changed.items())}
+        self.client.update_item(
+            TableName=self.table,
+            Key={'Id': {'S': self.asg}},
+            UpdateExpression='SET ' + ', '.join(f'#k{i} = :v{i}' for i in range(len(self.changed))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+        self.changed = {}
+
+
+class MemoryStore(AsgTagStore):
+    # Keeps state in memory, for trying the logic out without AWS
+
+    last_report_coalesce_seconds = 0
+
+    def __init__(self, values = None, capacity = 0, instances = None):
+        super().__init__(None)
+        self.values = dict(values or {})
+        self.capacity = capacity
+        self.instances = list(instances or [])
+        self.saved = []
+
+    def load(self):
+        pass
 
-    return response.get('Tags')
+    def set_capacity(self, capacity):
+        self.capacity = capacity
 
+    def save(self):
+        self.saved.append(self.changed)
+        self.changed = {}
 
-def find_tag(tags, key):
-    return next((t['Value'] for t in tags if t.get('Key') == key), None)
+
+def open_store():
+    asg = os.environ['AUTOSCALING_GROUP']
+    table = os.environ.get('STATE_TABLE')
+    store = DynamoDbStore(asg, table) if table else AsgTagStore(asg)
+    store.load()
+    return store
 
 
 def utcnow():
@@ -50,73 +232,254 @@ def parse_utc(text):
         return None
 
 
-def format_utc():
-    return utcnow().strftime(TIMESTAMP_FORMAT)
+def format_utc(time):
+    return time.strftime(TIMESTAMP_FORMAT)
+
+
+def hour_number(time):
+    return int(time.timestamp()) // 3600
+
+
+def encode_history(hours):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    for hour in hours:
+        text = ''
+        for _ in range(HISTORY_DIGITS):
+            hour, digit = divmod(hour, 36)
+            text = digits[digit] + text
+        result += text
+    return result
+
+
+def decode_history(text):
+    if not text:
+        return []
+    hours = []
+    for i in range(0, len(text) - HISTORY_DIGITS + 1, HISTORY_DIGITS):
+        try:
+            hours.append(int(text[i:i + HISTORY_DIGITS], 36))
+        except ValueError:
+            pass
+    return hours
+
+
+def record_session(history, hour):
+    # Returns the history with a session started at the hour, oldest sessions are dropped when it is full
+    if hour in history:
+        return history
+    return (history + [hour])[-HISTORY_LIMIT:]
 
 
-def cleanup_if_idle():
-    # If there were no activity for 1 hour and no recent requests, terminate EC2 instance
+def demand_weeks(history, hour):
+    # Number of recent weeks that had a session at the same hour of the week
+    sessions = set(history)
+    return sum(1 for week in range(1, PREDICTION_WEEKS + 1) if hour - week * HOURS_IN_WEEK in sessions)
 
-    tags = get_asg_tags()
 
-    last_activity = parse_utc(find_tag(tags, 'LastActivity'))
-    last_request = parse_utc(find_tag(tags, 'LastRequest'))
-    first_cleanup = parse_utc(find_tag(tags, 'FirstCleanup'))
+def is_demand_expected(history, now, lead_seconds = 0):
+    # Whether a session is likely to start in the hour containing now + lead
+    hour = hour_number(now + timedelta(seconds=lead_seconds))
+    return demand_weeks(history, hour) >= PREDICTION_MIN_WEEKS
 
-    print(f'Activity check: last_activity={last_activity}, last_request={last_request}, first_cleanup={first_cleanup}')
+
+def put_timestamp(store, key, now):
+    # Monotonic timestamps are only rewritten once they moved far enough
+    previous = parse_utc(store.get(key))
+    if previous is None or (now - previous).total_seconds() >= COALESCE_SECONDS.get(key, 0):
+        store.put(key, format_utc(now))
+
+
+def prewarm_if_expected(store, now):
+    # Bring the instance up ahead of the sessions the history predicts
+
+    history = decode_history(store.get(HISTORY_TAG))
+
+    if not is_demand_expected(history, now, PREWARM_LEAD_SECONDS):
+        return False
+
+    if store.capacity == 0:
+        print('Demand expected, prewarming')
+        store.set_capacity(1)
+
+    return True
+
+
+def cleanup_if_idle(store, now):
+    # If there were no activity and no recent requests for a while, terminate EC2 instance
+
+    if prewarm_if_expected(store, now) or is_demand_expected(decode_history(store.get(HISTORY_TAG)), now):
+        # Keep the instance through the hour it is expected to be used
+        return
+
+    if store.capacity == 0:
+        # Nothing to clean up
+        return
+
+    last_activity = parse_utc(store.get('LastActivity'))
+    last_session = parse_utc(store.get('LastSession'))
+    last_request = parse_utc(store.get('LastRequest'))
+    first_cleanup = parse_utc(store.get('FirstCleanup'))
+
+    print(f'Activity check: last_activity={last_activity}, last_session={last_session}, last_request={last_request}, first_cleanup={first_cleanup}')
 
     if first_cleanup is None:
-        set_asg_tag('FirstCleanup', format_utc())
+        store.put('FirstCleanup', format_utc(now))
 
     # When cleanup is triggered on a freshly deployed stack, there may be neither LastActivity nor LastRequest present yet.
     # In that case calculate idle time off FirstCleanup and do not do any cleanup if it is missing too (brand new stack)!
-    times = [t for t in [last_activity, last_request, first_cleanup] if t is not None]               
+    times = [
+        last_activity + timedelta(seconds=COALESCE_SECONDS['LastActivity']) if last_activity else None,
+        last_request + timedelta(seconds=COALESCE_SECONDS['LastRequest']) if last_request else None,
+        first_cleanup,
+    ]
+    times = [t for t in times if t is not None]
     if len(times) == 0:
         return
 
-    activity = max(times) 
+    activity = max(times)
+
+    idle_seconds = (now - activity).total_seconds()
+    print(f'Inactivity estimate: {int(idle_seconds)}s')
 
-    idle_seconds = (utcnow() - activity).seconds
-    print(f'Inactivity estimate: {idle_seconds}s')
+    # Sessions still open, even if nothing goes through them, get more time
+    limit = IDLE_SECONDS
+    if last_session is not None and (now - last_session).total_seconds() < COALESCE_SECONDS['LastSession'] + REPORT_INTERVAL_SECONDS:
+        limit += IDLE_SESSION_SECONDS
 
-    if idle_seconds < 10 * 60:
+    if idle_seconds < limit:
         return
 
-    print('Inactive for too long, terminating EC2 instance')
-    autoscaling_client.set_desired_capacity(
-        AutoScalingGroupName=asg,
-        DesiredCapacity=0,
+    if warm_pool:
+        print('Inactive for too long, returning EC2 instance to warm pool')
+    else:
+        print('Inactive for too long, terminating EC2 instance')
+    store.set_capacity(0)
+
+    # Instance resumed from the warm pool is not ready until it reports again
+    store.put('ReportingInstance', '')
+
+
+def record_request(store, now):
+    # A request after a break starts a session, remember when for demand prediction
+
+    last_request = parse_utc(store.get('LastRequest'))
+    if last_request is not None and (now - last_request).total_seconds() < SESSION_GAP_SECONDS:
+        return
+
+    history = decode_history(store.get(HISTORY_TAG))
+    store.put(HISTORY_TAG, encode_history(record_session(history, hour_number(now))))
+
+
+def record_report(store, instance_id, now):
+    # Which instance checks in, since when and when it last did, older monitors do not tell their instance.
+    # The last report time is coarse where writes are expensive.
+
+    if instance_id is None:
+        return
+
+    last_report = parse_utc(store.get('LastReport'))
+
+    if store.get('ReportingInstance') != instance_id:
+        store.put('ReportingInstance', instance_id)
+        store.put('ReportingSince', format_utc(now))
+        last_report = None
+
+    if last_report is None or (now - last_report).total_seconds() >= store.last_report_coalesce_seconds:
+        store.put('LastReport', format_utc(now))
+
+
+def describe_ready_instance(store, now):
+    # Instance in service with the monitor checking in from it, which the client can open a tunnel to straight away
+    # instead of polling ASG and SSM for it. The last report is allowed to be as old as the store coalesces it.
+
+    instances = [i for i in store.get_instances() if i.get('LifecycleState') == 'InService']
+    if len(instances) != 1:
+        return {'Ready': False}
+
+    instance = instances[0]
+    instance_id = instance.get('InstanceId')
+    health = instance.get('HealthStatus')
+
+    last_report = parse_utc(store.get('LastReport'))
+    reporting_since = parse_utc(store.get('ReportingSince'))
+
+    report_age = READY_REPORT_AGE_SECONDS + store.last_report_coalesce_seconds
+
+    ready = (
+        health == 'Healthy'
+        and store.get('ReportingInstance') == instance_id
+        and last_report is not None and (now - last_report).total_seconds() <= report_age
+        and reporting_since is not None and (now - reporting_since).total_seconds() >= READY_AFTER_SECONDS
     )
 
+    return {
+        'InstanceId': instance_id,
+        'HealthStatus': health,
+        'LastReport': store.get('LastReport') if store.get('ReportingInstance') == instance_id else None,
+        'ReportingSince': store.get('ReportingSince') if store.get('ReportingInstance') == instance_id else None,
+        'Ready': ready,
+    }
 
-def handler(event, context):
-    action = event.get('Action', None)
 
-    print(f'Event: {event}')
+def handle(store, event, now):
+    action = event.get('Action', None)
+    response = None
 
     if action == 'report':
-        # Proxy EC2 instance is checking in reporting number of active sessions.
+        # Proxy EC2 instance is checking in reporting number of active sessions and the traffic since the last report.
+        # Older monitors do not report traffic, their sessions count as used.
 
-        if event.get('ActiveSessions', None) > 0:
-            set_asg_tag('LastActivity', format_utc())
+        # Instance being put into the warm pool runs its monitor until it is stopped. It is not serving anything and
+        # must not take over ReportingInstance from the instance in service, or seem ready once it resumes.
+        if (event.get('LifecycleState') or '').startswith('Warmed:'):
+            print(f'Ignoring report of {event.get("InstanceId")} in {event["LifecycleState"]}')
+            return None
+
+        store.confirm_running()
+        record_report(store, event.get('InstanceId'), now)
+
+        sessions = event.get('ActiveSessions', 0)
+        traffic = event.get('Bytes')
+
+        if sessions > 0 and (traffic is None or traffic >= IDLE_SESSION_BYTES):
+            put_timestamp(store, 'LastActivity', now)
         else:
-            cleanup_if_idle()
+            if sessions > 0:
+                put_timestamp(store, 'LastSession', now)
+            cleanup_if_idle(store, now)
 
     elif action == 'activate':
         # Client-side script requests a tunnel so we need to bring EC2 instance back to life if it was terminated.
+        # Explicit prewarm is not a session, so it does not go into the history.
 
-        set_asg_tag('LastRequest', format_utc())
+        if not event.get('Prewarm', False):
+            record_request(store, now)
 
-        autoscaling_client.set_desired_capacity(
-            AutoScalingGroupName=asg,
-            DesiredCapacity=1,
-        )
+        put_timestamp(store, 'LastRequest', now)
+
+        # An instance can only be ready if there was one already
+        store.refresh_capacity()
+        running = store.capacity > 0
+
+        store.set_capacity(1)
+
+        response = describe_ready_instance(store, now) if running else {'Ready': False}
 
     elif action == 'cleanup':
         # Scheduled operation to check if we still need our resources or it can be released.
         # Triggered from outside of our EC2 instance so gets invoked even when instance is terminated.
-        cleanup_if_idle()
+        cleanup_if_idle(store, now)
 
     else:
         raise Exception(f'Invalid action: {action}')
 
+    store.save()
+
+    return response
+
+
+def handler(event, context):
+    print(f'Event: {event}')
+
+    return handle(open_store(), event, utcnow())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Continuously monitor how many SSM sessions are there and how much traffic they carry, report it to control lambda.
+# Activity is reported as soon as a session appears and every 5 minutes.
+#
+# Sessions are counted by scanning /proc for ssm-session-worker processes, which is a directory listing and a few small
+# reads a second. Traffic is the sum of I/O counters of those processes, so the lambda can tell a session that is used
+# from one that is just left open. Reports name the instance, so the lambda can tell clients which instance is up and
+# checking in, and its lifecycle state, so reports from an instance being put into the warm pool are ignored.
+# Lambda is invoked with boto3 when it is installed. Stock Amazon Linux does not have it, then the request is signed
+# here with the instance role credentials from instance metadata, rather than forking `aws` CLI every time.
+
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+SESSION_WORKER = 'ssm-session-worker'
+
+POLL_INTERVAL = 1
+REPORT_INTERVAL = 300
+
+# Do not report more often than this, however often sessions come and go
+MIN_REPORT_INTERVAL = 10
+
+IMDS_URL = 'http://169.254.169.254/latest'
+
+# Instance role credentials are fetched again this long before they expire
+CREDENTIALS_REFRESH_SECONDS = 5 * 60
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        # Process is gone or not ours to look at
+        return None
+
+
+def find_session_workers(proc_root):
+    pids = []
+    for name in os.listdir(proc_root):
+        if name.isdigit() and (read_file(os.path.join(proc_root, name, 'comm')) or '').strip() == SESSION_WORKER:
+            pids.append(name)
+    return pids
+
+
+def read_io_bytes(proc_root, pid):
+    # Bytes the process has read and written, sockets included
+    text = read_file(os.path.join(proc_root, pid, 'io'))
+    if text is None:
+        return None
+
+    counters = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(':')
+        counters[key.strip()] = int(value.strip() or 0)
+    return counters.get('rchar', 0) + counters.get('wchar', 0)
+
+
+class Monitor:
+
+    def __init__(self, proc_root, report, instance_id = None, lifecycle_state = None):
+        self.proc_root = proc_root
+        self.report = report
+        self.instance_id = instance_id
+        # Returns the auto scaling lifecycle state of the instance, which changes as it goes in and out of the warm pool
+        self.lifecycle_state = lifecycle_state
+        self.last_report = None
+        self.last_report_sessions = 0
+        # Traffic is counted as growth of per-process counters since the last poll
+        self.io_bytes = {}
+        self.traffic = 0
+
+    def poll(self, now):
+        pids = find_session_workers(self.proc_root)
+
+        io_bytes = {}
+        for pid in pids:
+            value = read_io_bytes(self.proc_root, pid)
+            if value is not None:
+                io_bytes[pid] = value
+                self.traffic += max(value - self.io_bytes.get(pid, 0), 0)
+        self.io_bytes = io_bytes
+
+        sessions = len(pids)
+
+        reason = None
+        if self.last_report is None or now - self.last_report >= REPORT_INTERVAL:
+            # Report every 5 minutes regardless if we are active or not
+            reason = 'periodic update'
+        elif sessions >= 1 and self.last_report_sessions < 1 and now - self.last_report >= MIN_REPORT_INTERVAL:
+            # When activity is detected for the first time report it straight away.
+            # This should prevent control lambda from releasing the instance.
+            reason = 'first session after inactivity'
+
+        if reason is None:
+            return None
+
+        payload = {'Action': 'report', 'ActiveSessions': sessions, 'Bytes': self.traffic}
+        if self.instance_id is not None:
+            payload['InstanceId'] = self.instance_id
+        state = self.lifecycle_state() if self.lifecycle_state is not None else None
+        if state is not None:
+            payload['LifecycleState'] = state
+        print(f'Reporting - {reason}: sessions={sessions}, bytes={self.traffic}', flush=True)
+
+        self.last_report = now
+        self.last_report_sessions = sessions
+        self.traffic = 0
+
+        try:
+            self.report(payload)
+        except Exception as e:
+            # Keep monitoring, the next report may well get through
+            print(f'Report failed: {e}', flush=True)
+
+        return payload
+
+
+def get_metadata(*names):
+    # IMDSv2 first, v1 is still enabled on older instances
+    headers = {}
+    try:
+        request = urllib.request.Request(IMDS_URL + '/api/token', method='PUT',
+                                         headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        with urllib.request.urlopen(request, timeout=2) as response:
+            headers['X-aws-ec2-metadata-token'] = response.read().decode()
+    except OSError:
+        pass
+
+    values = []
+    for name in names:
+        request = urllib.request.Request(f'{IMDS_URL}/meta-data/{name}', headers=headers)
+        with urllib.request.urlopen(request, timeout=2) as response:
+            values.append(response.read().decode())
+    return values
+
+
+def read_lifecycle_state():
+    # Target lifecycle state, e.g. InService or Warmed:Hibernated. None outside of an auto scaling group.
+    try:
+        state, = get_metadata('autoscaling/target-lifecycle-state')
+        return state.strip()
+    except OSError:
+        return None
+
+
+class InstanceCredentials:
+    # Temporary credentials of the instance role, kept until they are about to expire
+
+    def __init__(self):
+        self.values = None
+        self.expiration = None
+
+    def get(self, now):
+        if self.values is None or (self.expiration - now).total_seconds() < CREDENTIALS_REFRESH_SECONDS:
+            roles, = get_metadata('iam/security-credentials/')
+            text, = get_metadata('iam/security-credentials/' + roles.split()[0])
+            self.values = json.loads(text)
+            self.expiration = datetime.datetime.strptime(self.values['Expiration'], '%Y-%m-%dT%H:%M:%SZ') \
+                .replace(tzinfo=datetime.timezone.utc)
+        return self.values
+
+
+def sign_request(method, url, headers, body, region, service, credentials, now):
+    # AWS Signature Version 4 for a request without query string, returns headers to send it with
+    parts = urllib.parse.urlsplit(url)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    scope = f'{amz_date[:8]}/{region}/{service}/aws4_request'
+
+    headers = dict(headers, Host=parts.netloc)
+    headers['X-Amz-Date'] = amz_date
+    if credentials.get('Token'):
+        headers['X-Amz-Security-Token'] = credentials['Token']
+
+    canonical_headers = sorted((k.lower(), ' '.join(v.split())) for k, v in headers.items())
+    signed_headers = ';'.join(k for k, _ in canonical_headers)
+    canonical_request = '\n'.join([
+        method,
+        urllib.parse.quote(parts.path or '/'),
+        '',
+        ''.join(f'{k}:{v}\n' for k, v in canonical_headers),
+        signed_headers,
+        hashlib.sha256(body).hexdigest(),
+    ])
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+    key = ('AWS4' + credentials['SecretAccessKey']).encode()
+    for part in scope.split('/'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={credentials["AccessKeyId"]}/{scope}, '
+                                f'SignedHeaders={signed_headers}, Signature={signature}')
+    return headers
+
+
+def make_reporter(function_name, region):
+    try:
+        import boto3
+    except ImportError:
+        boto3 = None
+
+    if boto3 is not None:
+        # One client for the lifetime of the process, it keeps connections and credentials between reports
+        client = boto3.client('lambda', region_name=region)
+
+        def report(payload):
+            client.invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload))
+
+        return report
+
+    url = f'https://lambda.{region}.amazonaws.com/2015-03-31/functions/{urllib.parse.quote(function_name)}/invocations'
+    credentials = InstanceCredentials()
+
+    def report_signed(payload):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        body = json.dumps(payload).encode()
+        headers = sign_request('POST', url, {'Content-Type': 'application/json', 'X-Amz-Invocation-Type': 'Event'},
+                               body, region, 'lambda', credentials.get(now), now)
+        request = urllib.request.Request(url, data=body, method='POST', headers=headers)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    return report_signed
+
+
+def main():
+    function_name = os.environ.get('CONTROL_FUNCTION')
+    if not function_name:
+        print('CONTROL_FUNCTION is not set', file=sys.stderr)
+        sys.exit(1)
+
+    region, instance_id = get_metadata('placement/region', 'instance-id')
+
+    monitor = Monitor('/proc', make_reporter(function_name, region), instance_id, read_lifecycle_state)
+
+    while True:
+        monitor.poll(time.monotonic())
+        time.sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
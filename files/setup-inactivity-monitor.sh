@@ -1,18 +1,16 @@
 #!/bin/bash
 
-MONITOR_SCRIPT=/root/inactivity-monitor.sh
+MONITOR_SCRIPT=/root/inactivity-monitor.py
 
 SYSTEMD_DIR=/etc/systemd/system
 SYSTEMD_UNIT=inactivity-monitor.service
 
 (
 cat <<'EOF'
-{{INCLUDE:inactivity-monitor.sh}}
+{{INCLUDE:inactivity-monitor.py}}
 EOF
 ) > $MONITOR_SCRIPT
 
-sed -i 's/tcp-proxy-control/tcp-proxy-control-${StackId}/' $MONITOR_SCRIPT
-
 if [ -f $MONITOR_SCRIPT ]; then
     chmod +x $MONITOR_SCRIPT
 else
@@ -28,7 +26,15 @@ EOF
 
 systemctl daemon-reload
 
-systemctl start $SYSTEMD_UNIT
+# Start on every boot, so that the monitor keeps running after instance is stopped and started again
+systemctl enable $SYSTEMD_UNIT
+
+if [ -f /etc/default/inactivity-monitor ]; then
+    systemctl restart $SYSTEMD_UNIT
+else
+    # Not launched by a proxy stack, so this must be an image build. Stop to let the image be taken.
+    shutdown -h now
+fi
 
 exit 0
 
@@ -1,5 +1,6 @@
-import boto3
-import botocore
+import concurrent.futures
+import hashlib
+import threading
 import time
 import signal
 import subprocess
@@ -8,54 +9,125 @@ import json
 import shlex
 import os
 import argparse
+import asyncio
+import base64
+import contextlib
+import csv
+import datetime
+import decimal
+import gzip
+import io
+import itertools
+import ipaddress
+import math
+import queue
+import random
+import shutil
+import socket
+import struct
 import sys
+import uuid
+import zlib
 
 # Amazon Linux 2
 DEFAULT_PROXY_AMI = 'ami-01d7b3abeb9d86b41'
 
-# TODO
-# botocore.exceptions.ClientError: An error occurred (ValidationError) when calling the UpdateStack operation: Stack:arn:aws:cloudformation:eu-west-1:..... is in ROLLBACK_COMPLETE state and can not be updated.
+CACHE_DIR = os.path.expanduser('~/.cache/rdscli')
 
+# How long discovered security group/subnet are reused before discovery runs again
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
 
-# TODO: when stack fails to update:
-# botocore.exceptions.WaiterError: Waiter StackUpdateComplete failed: Waiter encountered a terminal failure state: For expression "Stacks[].StackStatus" we matched expected path: "UPDATE_ROLLBACK_COMPLETE" at least once
+# Stack tag holding a hash of the template and parameters the stack was last deployed with
+DEPLOY_HASH_TAG = 'DeployHash'
 
-# TODO: terminated instance while still marked InService in ASG, running command results in
-# botocore.exceptions.WaiterError: Waiter CommandExecuted failed: Max attempts exceeded. Previously accepted state: For expression "Status" we matched expected path: "Pending"
+# Stack states in which the stack matches the template it is tagged with.
+# UPDATE_ROLLBACK_COMPLETE is fine too as the tags are rolled back along with everything else.
+STABLE_STACK_STATES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
 
-# TODO:
-# Tunnel ready. Local port: None
-# (no idea how I got to this state. redeployed stack, probably instances were restarting)
-# ah! `aws ssm` failed with:
-#   Setting up data channel with id dmitry.andrianov-0b03f8eab18ff00ca failed: failed to create websocket for datachannel with error: CreateDataChannel failed with no output or error: createDataChannel request failed: unexpected response from the service Server authentication failed: <UnauthorizedRequest><message>Forbidden.</message></UnauthorizedRequest>
+# How long to wait for a proxy instance to come up and register with SSM
+DEFAULT_ACQUIRE_TIMEOUT = 90
 
+# Polling delay while waiting for the instance grows from min to max unless something changes
+ACQUIRE_MIN_DELAY = 0.5
+ACQUIRE_MAX_DELAY = 3
 
-ssm_client = None
-cf_client = None
-autoscaling_client = None
-rds_client = None
+# EC2 instance states the instance is never going to be usable as a proxy from
+DEAD_INSTANCE_STATES = ['shutting-down', 'terminated', 'stopping', 'stopped']
 
-def init_clients():
-    global ssm_client, cf_client, autoscaling_client, rds_client
+# Stack states left behind by a failed creation or deletion. There is no working proxy in them,
+# so nothing is lost by deleting the stack and creating it again.
+RECREATE_STACK_STATES = ['ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'CREATE_FAILED', 'DELETE_FAILED']
 
-    ssm_client = boto3.client('ssm')
-    cf_client = boto3.client('cloudformation')
-    autoscaling_client = boto3.client('autoscaling')
-    rds_client = boto3.client('rds')
+# How many times a broken stack is recovered before giving up
+MAX_STACK_RECOVERIES = 2
+
+# How long to wait for a stack operation. Creation itself times out after 5 minutes, rollback takes a while too.
+STACK_OPERATION_TIMEOUT = 15 * 60
+STACK_POLL_DELAY = 2
+
+# AWS clients are created on first use and shared by all threads. They come straight from botocore:
+# importing boto3 would also import s3transfer, which takes several times longer than botocore itself.
+# botocore is imported along with the session, so that commands not talking to AWS do not pay for it.
+botocore = None
+
+CLIENT_CONFIG = {
+    'max_pool_connections': 32,
+    'retries': {'mode': 'standard', 'max_attempts': 5},
+    'tcp_keepalive': True,
+    'connect_timeout': 5,
+}
+
+aws_session = None
+aws_clients = {}
+aws_clients_lock = threading.RLock()
+
+
+def import_botocore():
+    global botocore
+    if botocore is None:
+        import botocore.config
+        import botocore.exceptions
+        import botocore.session
+    return botocore
+
+
+def new_session(profile = None):
+    return import_botocore().session.Session(profile=profile)
+
+
+def get_session():
+    global aws_session
+    with aws_clients_lock:
+        if aws_session is None:
+            aws_session = new_session()
+        return aws_session
+
+
+def aws_client(name):
+    # Creating clients is not thread safe, using them is
+    with aws_clients_lock:
+        client = aws_clients.get(name)
+        if client is None:
+            session = get_session()
+            config = botocore.config.Config(**CLIENT_CONFIG)
+            client = aws_clients[name] = trace_api_calls(session.create_client(name, config=config))
+        return client
 
 
 def delete_stack(stack_name):
-    cf_client.delete_stack(
-        StackName=stack_name
-    )
-    waiter = cf_client.get_waiter('stack_delete_complete')
-    print("...waiting for stack to be deleted...")
-    waiter.wait(StackName=stack_name)
+    stack = get_stack(stack_name)
+    if stack is None:
+        return
+
+    last_event_id = latest_stack_event_id(stack['StackId'])
+    aws_client('cloudformation').delete_stack(StackName=stack['StackId'])
+    print(f'Deleting stack {stack_name}')
+    wait_for_stack(stack['StackId'], last_event_id, ['DELETE_COMPLETE'])
 
 
 def get_stack(stack_name):
     try:
-        stacks = cf_client.describe_stacks(StackName=stack_name).get('Stacks')
+        stacks = aws_client('cloudformation').describe_stacks(StackName=stack_name).get('Stacks')
         return stacks[0] if len(stacks) > 0 else None
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Message'] == f'Stack with id {stack_name} does not exist':
@@ -63,69 +135,210 @@ def get_stack(stack_name):
         raise
 
 
-def ensure_stack(stack_name, template, parameters):
+def find_tag(tags, key):
+    return next((t['Value'] for t in tags or [] if t.get('Key') == key), None)
 
-    parameters = [{'ParameterKey': k, 'ParameterValue': v} for k, v in parameters.items()]
 
-    stack = get_stack(stack_name)
+def deploy_hash(template, parameters):
+    data = json.dumps({'template': template, 'parameters': parameters}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def resolve_parameters(stack, parameters, defaults):
+    # Parameters that are None keep the value the stack was deployed with. A new stack gets them from defaults,
+    # or from the template when there is no default either. Callable parameters are given all the previous values
+    # to work the value out from.
+
+    previous = {p['ParameterKey']: p['ParameterValue'] for p in stack.get('Parameters') or []} if stack else defaults or {}
+
+    resolved = {}
+    for k, v in parameters.items():
+        if callable(v):
+            v = v(previous)
+        if v is None:
+            v = previous.get(k)
+        if v is not None:
+            resolved[k] = v
+    return resolved
+
+
+def latest_stack_event_id(stack_id):
+    events = aws_client('cloudformation').describe_stack_events(StackName=stack_id)['StackEvents']
+    return events[0]['EventId'] if events else None
+
+
+def new_stack_events(stack_id, last_event_id):
+    # Returns events that came after the given one, oldest first. Events are listed newest first,
+    # so only the first page is normally read.
+    events = []
+    for page in aws_client('cloudformation').get_paginator('describe_stack_events').paginate(StackName=stack_id):
+        for event in page['StackEvents']:
+            if event['EventId'] == last_event_id:
+                return events[::-1]
+            events.append(event)
+    return events[::-1]
+
+
+def print_stack_event(event):
+    reason = event.get('ResourceStatusReason')
+    print(f'#   {event["Timestamp"]:%H:%M:%S} {event["LogicalResourceId"]:<32} {event["ResourceStatus"]}'
+          + (f' - {reason}' if reason else ''))
+
+
+def is_stack_busy(status):
+    return status.endswith('_IN_PROGRESS')
+
+
+def wait_for_stack(stack_id, last_event_id, target_states = None):
+    # Waits for the stack to reach one of target states, or any settled state when None, printing its events as they come.
+    # A stack heading anywhere else fails straight away, naming the resource that failed first. Rolling back counts as
+    # heading elsewhere, unless a rollback is what is being waited for.
+
+    deadline = time.time() + STACK_OPERATION_TIMEOUT
+    failure = None
+
+    while True:
+        stack = aws_client('cloudformation').describe_stacks(StackName=stack_id)['Stacks'][0]
+        status = stack['StackStatus']
+
+        for event in new_stack_events(stack_id, last_event_id):
+            last_event_id = event['EventId']
+            print_stack_event(event)
+            # Resources that were cancelled did not fail on their own
+            if failure is None and event['ResourceStatus'].endswith('_FAILED') \
+                    and 'cancelled' not in (event.get('ResourceStatusReason') or ''):
+                failure = event
+
+        if target_states is None:
+            if not is_stack_busy(status):
+                return stack
+        elif status in target_states:
+            return stack
+        elif not is_stack_busy(status) or ('ROLLBACK' in status and not any('ROLLBACK' in t for t in target_states)):
+            message = f'stack {stack["StackName"]} is {status}'
+            if failure is not None:
+                message += f': {failure["LogicalResourceId"]} {failure["ResourceStatus"]} - {failure.get("ResourceStatusReason")}'
+            raise Exception(message)
+
+        if time.time() > deadline:
+            raise Exception(f'timed out waiting for stack {stack["StackName"]}, it is {status}')
+
+        time.sleep(STACK_POLL_DELAY)
+
+
+def settle_stack(stack_name):
+    # Returns the stack once it can be updated, or None when there is no stack (any more).
+    # Waits for operations started elsewhere to finish and gets rid of what is left from failed ones.
+
+    for _ in range(MAX_STACK_RECOVERIES + 1):
+        stack = get_stack(stack_name)
+        if stack is None:
+            return None
+
+        stack_id = stack['StackId']
+        status = stack['StackStatus']
+
+        if status in STABLE_STACK_STATES:
+            return stack
+
+        if is_stack_busy(status):
+            print(f'Stack {stack_name} is {status}, waiting for it to finish')
+            wait_for_stack(stack_id, latest_stack_event_id(stack_id))
+
+        elif status == 'UPDATE_ROLLBACK_FAILED':
+            print(f'Stack {stack_name} is {status}, continuing rollback')
+            last_event_id = latest_stack_event_id(stack_id)
+            aws_client('cloudformation').continue_update_rollback(StackName=stack_id)
+            wait_for_stack(stack_id, last_event_id, ['UPDATE_ROLLBACK_COMPLETE'])
+            note_timing('stack', 'updated')
+
+        elif status in RECREATE_STACK_STATES:
+            print(f'Stack {stack_name} is {status}, deleting it to start over')
+            last_event_id = latest_stack_event_id(stack_id)
+            aws_client('cloudformation').delete_stack(StackName=stack_id)
+            wait_for_stack(stack_id, last_event_id, ['DELETE_COMPLETE'])
+
+        else:
+            raise Exception(f'stack {stack_name} is {status}, cannot deploy it')
+
+    raise Exception(f'stack {stack_name} is still {status} after {MAX_STACK_RECOVERIES} attempts to recover it')
+
+
+def ensure_stack(stack_name, template, parameters, defaults = None, wait_for_update = True):
+    # Without wait_for_update, an update is only started and the stack is returned as it was before it
+
+    stack = settle_stack(stack_name)
+
+    parameters = resolve_parameters(stack, parameters, defaults)
+
+    template_hash = deploy_hash(template, parameters)
+
+    parameters = [{'ParameterKey': k, 'ParameterValue': v} for k, v in parameters.items()]
+    tags = [{'Key': DEPLOY_HASH_TAG, 'Value': template_hash}]
 
     if stack is None:
 
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation/client/create_stack.html
 
         print(f'Creating stack {stack_name}')
+        note_timing('stack', 'created')
 
-        cf_client.create_stack(
+        stack_id = aws_client('cloudformation').create_stack(
             StackName=stack_name,
             TemplateBody=template,
             Parameters=parameters,
+            Tags=tags,
             TimeoutInMinutes=5,
             Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
-        )
+        )['StackId']
 
-        waiter = cf_client.get_waiter('stack_create_complete')
+        last_event_id = None
+        target_state = 'CREATE_COMPLETE'
+
+    elif find_tag(stack.get('Tags'), DEPLOY_HASH_TAG) == template_hash:
+
+        # Deployed from exactly the same template and parameters, nothing to do
+        print(f"Stack {stack_name} is up to date.")
+        note_timing('stack', 'unchanged')
+        return stack
 
     else:
 
         # Stack already exists, update it
         print(f'Stack {stack_name} already exists, updating')
 
+        stack_id = stack['StackId']
+        last_event_id = latest_stack_event_id(stack_id)
+
         try:
-            cf_client.update_stack(
-                StackName=stack_name,
+            aws_client('cloudformation').update_stack(
+                StackName=stack_id,
                 TemplateBody=template,
                 Parameters=parameters,
+                Tags=tags,
                 Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
             )
-
-            waiter = cf_client.get_waiter('stack_update_complete')
+            note_timing('stack', 'updated')
 
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Message'] != 'No updates are to be performed.':
                 raise
 
             print(f"Stack {stack_name} is up to date.")
-            return
+            note_timing('stack', 'unchanged')
+            return stack
 
-    print("Waiting for stack to be ready...")
-    waiter.wait(
-        StackName=stack_name,
-        WaiterConfig={
-            'Delay': 1,
-            'MaxAttempts': 5 * 60,
-        }
-    )
+        if not wait_for_update:
+            return stack
 
+        target_state = 'UPDATE_COMPLETE'
 
-def show_stack_events(stack_name):
-    r = cf_client.describe_stack_events(StackName=stack_name)
-    for i in r['StackEvents']:
-      print('-----------------------------------')
-      print(i.get('Timestamp'), i.get('LogicalResourceId'), i.get('ResourceStatus'), i.get('ResourceStatusReason'))
+    print("Waiting for stack to be ready...")
+    return wait_for_stack(stack_id, last_event_id, [target_state])
 
 
 def get_stack_outputs(stack_name):
-    stacks = cf_client.describe_stacks(StackName=stack_name).get('Stacks')
+    stacks = aws_client('cloudformation').describe_stacks(StackName=stack_name).get('Stacks')
     if len(stacks) != 1:
         raise Exception(f'Wrong number of stacks: {len(stacks)}')
 
@@ -136,7 +349,48 @@ def find_output(outputs, key):
     return next((o['OutputValue'] for o in outputs if o.get('OutputKey') == key), None)
 
 
-def acquire_instance(stack_name):
+def get_ssm_ping_status(instance_id):
+    response = aws_client('ssm').describe_instance_information(
+        Filters=[{'Key': 'InstanceIds', 'Values': [instance_id]}]
+    )
+
+    # Instance that has not registered with SSM yet is not listed at all
+    info = response.get('InstanceInformationList')
+    return info[0].get('PingStatus') if info else None
+
+
+def get_instance_state(instance_id):
+    response = aws_client('ec2').describe_instances(InstanceIds=[instance_id])
+    for reservation in response['Reservations']:
+        for instance in reservation['Instances']:
+            return instance['State']['Name']
+    return None
+
+
+def check_instance(instance):
+    # Returns a text describing what we are waiting for, or None when instance is ready to be used
+
+    instance_id = instance.get('InstanceId')
+
+    if instance.get('HealthStatus') == 'Unhealthy':
+        raise Exception(f'Instance {instance_id} is unhealthy')
+
+    ping_status = get_ssm_ping_status(instance_id)
+
+    if ping_status == 'Online' or ping_status == 'ConnectionLost':
+        # SSM keeps reporting Online for a while after instance is gone, and ASG may still list it as InService,
+        # so confirm with EC2 before using it. Neither will an instance that lost connection come back if it is dead.
+        state = get_instance_state(instance_id)
+        if state in DEAD_INSTANCE_STATES:
+            raise Exception(f'Instance {instance_id} is {state}')
+
+        if ping_status == 'Online' and state == 'running':
+            return None
+
+    return f'Waiting for {instance_id} to respond'
+
+
+def acquire_instance(asg, timeout = DEFAULT_ACQUIRE_TIMEOUT):
 
     last_announce = None
 
@@ -147,15 +401,18 @@ def acquire_instance(stack_name):
                 print()
             print(f'{text}: ', end='', flush=True)
             last_announce = text
+            return True
+        return False
 
-    outputs = get_stack_outputs(stack_name)
-
-    asg = find_output(outputs, 'AutoScalingGroup')
-
-    start = time.time()
+    deadline = time.time() + timeout
+    delay = ACQUIRE_MIN_DELAY
+    polls = 0
 
     while True:
-        response = autoscaling_client.describe_auto_scaling_groups(
+        polls += 1
+        note_timing('acquire_polls', polls)
+
+        response = aws_client('autoscaling').describe_auto_scaling_groups(
             AutoScalingGroupNames=[asg],
         )
 
@@ -168,75 +425,40 @@ def acquire_instance(stack_name):
         instances = [i for i in instances if i.get('LifecycleState') == 'InService']
 
         if len(instances) == 0:
-            announce_waiting(f'Waiting for an instance in ASG')
+            waiting_for = 'Waiting for an instance in ASG'
 
         elif len(instances) > 1:
             raise Exception(f'Unexpected number of instances: {len(instances)}')
 
         else:
+            waiting_for = check_instance(instances[0])
 
-            instance_id = instances[0].get('InstanceId')
+            if waiting_for is None:
+                if last_announce is not None:
+                    print()
+                return instances[0].get('InstanceId')
 
-            announce_waiting(f'Waiting for {instance_id} to respond')
-
-            if ping_instance(instance_id):
-                print()
-                return instance_id
+        # Poll more often right after the state has changed as the next change is likely to follow soon
+        if announce_waiting(waiting_for):
+            delay = ACQUIRE_MIN_DELAY
+        else:
+            delay = min(delay * 1.5, ACQUIRE_MAX_DELAY)
 
-        time_spent = int(time.time() - start)
-        if time_spent > 90:
+        remaining = deadline - time.time()
+        if remaining <= 0:
             raise Exception('Timed out waiting for a proxy instance')
 
         print('.', end='', flush=True)
-        time.sleep(1)
-
-
-def run_command(instance_id, commands, timeout_seconds = 60):
-    response = ssm_client.send_command(
-        InstanceIds=[instance_id],
-        DocumentName='AWS-RunShellScript',
-        TimeoutSeconds=timeout_seconds,
-        Parameters={
-            'commands': commands
-        }
-    )
-
-    command_id = response.get('Command').get('CommandId')
-
-    waiter = ssm_client.get_waiter('command_executed')
-    waiter.wait(
-        CommandId=command_id,
-        InstanceId=instance_id,
-        WaiterConfig={
-            'Delay': 0.5
-        }
-    )
-
-    response = ssm_client.get_command_invocation(
-        CommandId=command_id,
-        InstanceId=instance_id
-    )
-
-
-def ping_instance(instance_id):
-    try:
-        run_command(instance_id, ['echo'], timeout_seconds = 30)
-        return True
-    except ssm_client.exceptions.InvalidInstanceId as e:
-        # When instance hasn't fully initialised, we get this:
-        #     An error occurred (InvalidInstanceId) when calling the SendCommand operation: Instances [[i-0123456789abcdef0]] not in a valid state for account 123456789012
-        return False 
+        time.sleep(min(delay, remaining))
 
 
 def get_secret(secret_name):
-    client = boto3.client('secretsmanager')
-    response = client.get_secret_value(SecretId=secret_name)
-    return response['SecretString']
+    response = aws_client('secretsmanager').get_secret_value(SecretId=secret_name)
+    return response
 
 
 def invoke_function(function_name, payload):
-    lambda_client = boto3.client('lambda')
-    response = lambda_client.invoke(
+    response = aws_client('lambda').invoke(
         FunctionName=function_name,
         Payload=json.dumps(payload),
     )
@@ -264,16 +486,16 @@ def invoke_function(function_name, payload):
         raise Exception(f'unsuccessful lambda invocation: StatusCode={status_code}, FunctionError={function_error}, errorMessage={response_data.get("errorMessage")}')
 
     if parse_error is not None:
-        raise Exception(f'invalid lambda response: {payload}') from payload_parse_error
+        raise Exception(f'invalid lambda response: {payload}') from parse_error
 
     return response_data
 
 
-def open_tunnel_cli(instance_id, host, port):
+def open_tunnel_cli(instance_id, host, port, local_port = 0):
     parameters = {
         'host': [host],
         'portNumber': [str(port)],
-        'localPortNumber': ['0'],
+        'localPortNumber': [str(local_port)],
     }
 
     cmdline = ['aws',
@@ -294,11 +516,24 @@ def open_tunnel_cli(instance_id, host, port):
             local_port = int(match.group(1))
             break
 
+    if local_port is None:
+        close_tunnel_cli(proc)
+        raise Exception('failed to open tunnel, see aws output above')
+
+    # Plugin keeps printing a line per connection, a tunnel held by the agent for long would otherwise fill
+    # the pipe and block the plugin
+    threading.Thread(target=drain_output, args=(proc.stdout,), daemon=True).start()
+
     print(f'Tunnel ready. Local port: {local_port}')
 
     return local_port, proc
 
 
+def drain_output(stream):
+    for _ in stream:
+        pass
+
+
 def close_tunnel_cli(proc):
     # Kill the tunnel - proc.terminate() is not enough as it just kills 'ssm start-session' process,
     # but not 'session-manager-plugin' it spawns, so kill the entire process group.
@@ -306,275 +541,4093 @@ def close_tunnel_cli(proc):
     os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
 
 
-# TODO
-# botocore.exceptions.ClientError: An error occurred (ValidationError) when calling the UpdateStack operation: Stack:arn:aws:cloudformation:eu-west-1:000000000000:stack/tcp-proxy-5f7ede3a-325b8157/932764c0-1e89-11ef-a547-026fe946cb4b is in ROLLBACK_FAILED state and can not be updated.
+###########################################
+# Native SSM port forwarding
+#
+# Implements the client side of the Session Manager data channel the same way session-manager-plugin does
+# (https://github.com/aws/session-manager-plugin), so that a tunnel can be opened without starting `aws` and
+# the plugin. Every message on the data channel websocket is a binary frame with a fixed big-endian header:
+#
+#   HeaderLength(4) MessageType(32) SchemaVersion(4) CreatedDate(8) SequenceNumber(8) Flags(8)
+#   MessageId(16) PayloadDigest(32) PayloadType(4) PayloadLength(4) Payload(PayloadLength)
+
+SSM_MESSAGE_HEADER = struct.Struct('>I32sIQqQ16s32sI')
+
+INPUT_STREAM_MESSAGE = 'input_stream_data'
+OUTPUT_STREAM_MESSAGE = 'output_stream_data'
+ACKNOWLEDGE_MESSAGE = 'acknowledge'
+CHANNEL_CLOSED_MESSAGE = 'channel_closed'
+START_PUBLICATION_MESSAGE = 'start_publication'
+PAUSE_PUBLICATION_MESSAGE = 'pause_publication'
+
+PAYLOAD_OUTPUT = 1
+PAYLOAD_HANDSHAKE_REQUEST = 5
+PAYLOAD_HANDSHAKE_RESPONSE = 6
+PAYLOAD_HANDSHAKE_COMPLETE = 7
+PAYLOAD_FLAG = 10
+
+FLAG_DISCONNECT_TO_PORT = 1
+FLAG_TERMINATE_SESSION = 2
+FLAG_CONNECT_TO_PORT_ERROR = 3
+
+# Agent multiplexes port forwarding sessions for plugin versions 1.1.70 and later, which would need smux on top
+# of the data channel. Reporting an older version gets a plain session carrying one TCP connection at a time.
+SSM_CLIENT_VERSION = '1.1.61'
+
+# Same chunk size the plugin uses for input stream data
+SSM_STREAM_CHUNK_SIZE = 1024
+
+# Maximum number of sent messages waiting for acknowledgement before sending is paused
+SSM_SEND_WINDOW = 256
+
+# Messages that were not acknowledged in that time are sent again
+SSM_RESEND_TIMEOUT = 1
+
+SSM_HANDSHAKE_TIMEOUT = 15
+
+# How often a native tunnel checks it still has a session, doubled after every failed attempt to reopen it
+TUNNEL_RECONNECT_DELAY = 5
+TUNNEL_MAX_RECONNECT_DELAY = 60
+
+# Tunnels held by the agent are closed after not being used for that long
+DEFAULT_AGENT_IDLE_TIMEOUT = 15 * 60
+
+AGENT_SOCKET = 'agent.sock'
+
+
+def encode_ssm_message(message_type, sequence_number, flags, payload_type, payload):
+    message_id = uuid.uuid4().bytes
+
+    header = SSM_MESSAGE_HEADER.pack(
+        SSM_MESSAGE_HEADER.size,
+        message_type.encode().ljust(32),
+        1,
+        int(time.time() * 1000),
+        sequence_number,
+        flags,
+        # Message ID goes with least significant half first
+        message_id[8:] + message_id[:8],
+        hashlib.sha256(payload).digest(),
+        payload_type,
+    )
 
-def mysql_cli(local_port, username, password, database, args):
-    cmdline = ['mysql',
-        f'--host=127.0.0.1',
-        f'--port={local_port}',
-        f'--user={username}',
-        f'--password={password}',
-        *args,
-        database
-    ]
+    return header + struct.pack('>I', len(payload)) + payload
 
-    filtered_cmdline = ['--password=...' if i.startswith('--password=') else i for i in cmdline]
-    logcmd = ' '.join(map(shlex.quote, filtered_cmdline))
-    print(f'# {logcmd}')
 
-    # Prevent Python from handling Ctrl+C, let the mysql itself deal with it
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+def decode_ssm_message(frame):
+    (header_length, message_type, _, _, sequence_number, flags, message_id, _, payload_type) = \
+        SSM_MESSAGE_HEADER.unpack_from(frame)
 
-    subprocess.run(cmdline)
+    (payload_length,) = struct.unpack_from('>I', frame, header_length)
+    payload = frame[header_length + 4:header_length + 4 + payload_length]
 
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    return {
+        'MessageType': message_type.decode().strip(' \0'),
+        'SequenceNumber': sequence_number,
+        'Flags': flags,
+        'MessageId': str(uuid.UUID(bytes=message_id[8:] + message_id[:8])),
+        'PayloadType': payload_type,
+        'Payload': payload,
+    }
 
 
-def rds_id_from_host(host):
-    # <databaseid>.abcdefgwgxg2.eu-west-1.rds.amazonaws.com
-    match = re.search(r'^ (.*) \. [a-z0-9]+ \. [a-z0-9-]+ \.rds\.amazonaws\.com\.? $', host, re.VERBOSE)
-    return match.group(1) if match else None
+def import_websockets():
+    try:
+        import websockets
+        return websockets
+    except ImportError:
+        return None
+
+
+class SsmDataChannel:
+    # One Session Manager session: delivers what agent sends as output stream data into `received` queue
+    # (None marks the end of the current connection), sends input with acknowledgements and flow control.
+
+    def __init__(self, stream_url, token):
+        self.stream_url = stream_url
+        self.token = token
+        self.websocket = None
+        self.tasks = []
+        self.received = asyncio.Queue()
+        self.next_sequence = 0
+        self.expected_sequence = 0
+        self.out_of_order = {}
+        self.unacknowledged = {}
+        self.window_available = asyncio.Event()
+        self.publishing = asyncio.Event()
+        self.publishing.set()
+        self.handshake_complete = None
+        self.closed = None
+        self.error = None
+
+    async def open(self, timeout = SSM_HANDSHAKE_TIMEOUT):
+        websockets = import_websockets()
+        if websockets is None:
+            raise Exception('websockets package is required for native SSM tunnel')
+
+        loop = asyncio.get_running_loop()
+        self.handshake_complete = loop.create_future()
+        self.closed = loop.create_future()
 
+        try:
+            self.websocket = await websockets.connect(self.stream_url, max_size=None)
+        except Exception as e:
+            raise Exception(f'failed to connect to SSM data channel: {e}') from e
+
+        await self.websocket.send(json.dumps({
+            'MessageSchemaVersion': '1.0',
+            'RequestId': str(uuid.uuid4()),
+            'TokenValue': self.token,
+            'ClientId': str(uuid.uuid4()),
+            'ClientVersion': SSM_CLIENT_VERSION,
+        }))
+
+        self.tasks = [
+            asyncio.create_task(self.read_loop()),
+            asyncio.create_task(self.resend_loop()),
+        ]
 
-def is_rds_host(host):
-    return rds_id_from_host(host) is not None
+        try:
+            await asyncio.wait_for(asyncio.shield(self.handshake_complete), timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise Exception('timed out waiting for SSM session handshake')
+        except Exception:
+            await self.close()
+            raise
+
+    def is_open(self):
+        return self.closed is not None and not self.closed.done()
+
+    async def read_loop(self):
+        try:
+            async for frame in self.websocket:
+                if isinstance(frame, bytes):
+                    await self.handle_message(decode_ssm_message(frame))
+            self.finish('SSM data channel closed')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.finish(f'SSM data channel failed: {e}')
+
+    async def resend_loop(self):
+        while True:
+            await asyncio.sleep(SSM_RESEND_TIMEOUT / 2)
+            now = time.time()
+            for entry in list(self.unacknowledged.values()):
+                if now - entry[0] >= SSM_RESEND_TIMEOUT:
+                    entry[0] = now
+                    await self.websocket.send(entry[1])
+
+    def finish(self, reason):
+        if self.closed.done():
+            return
 
+        self.closed.set_result(reason)
+        if not self.handshake_complete.done():
+            self.handshake_complete.set_exception(Exception(reason))
+
+        self.received.put_nowait(None)
+        self.window_available.set()
+        self.publishing.set()
+
+    async def handle_message(self, message):
+        message_type = message['MessageType']
+
+        if message_type == OUTPUT_STREAM_MESSAGE:
+            await self.acknowledge(message)
+
+            sequence_number = message['SequenceNumber']
+            if sequence_number < self.expected_sequence:
+                # Retransmission of something we have already got
+                return
+
+            self.out_of_order[sequence_number] = message
+            while self.expected_sequence in self.out_of_order:
+                await self.process_output(self.out_of_order.pop(self.expected_sequence))
+                self.expected_sequence += 1
+
+        elif message_type == ACKNOWLEDGE_MESSAGE:
+            ack = json.loads(message['Payload'])
+            self.unacknowledged.pop(ack.get('AcknowledgedMessageSequenceNumber'), None)
+            if len(self.unacknowledged) < SSM_SEND_WINDOW:
+                self.window_available.set()
+
+        elif message_type == PAUSE_PUBLICATION_MESSAGE:
+            self.publishing.clear()
+
+        elif message_type == START_PUBLICATION_MESSAGE:
+            self.publishing.set()
+
+        elif message_type == CHANNEL_CLOSED_MESSAGE:
+            reason = json.loads(message['Payload']).get('Output') if message['Payload'] else None
+            self.finish(f'SSM session closed by agent: {reason}' if reason else 'SSM session closed by agent')
+
+    async def process_output(self, message):
+        payload_type = message['PayloadType']
+        payload = message['Payload']
+
+        if payload_type == PAYLOAD_OUTPUT:
+            self.received.put_nowait(payload)
+
+        elif payload_type == PAYLOAD_HANDSHAKE_REQUEST:
+            await self.handle_handshake(json.loads(payload))
+
+        elif payload_type == PAYLOAD_HANDSHAKE_COMPLETE:
+            if not self.handshake_complete.done():
+                self.handshake_complete.set_result(True)
+
+        elif payload_type == PAYLOAD_FLAG:
+            (flag,) = struct.unpack('>I', payload[:4])
+            if flag == FLAG_CONNECT_TO_PORT_ERROR:
+                self.error = 'proxy instance failed to connect to the remote port'
+                print(f'Tunnel error: {self.error}', file=sys.stderr)
+                self.received.put_nowait(None)
+
+    async def handle_handshake(self, request):
+        processed = []
+        errors = []
+
+        for action in request.get('RequestedClientActions', []):
+            action_type = action.get('ActionType')
+            if action_type == 'SessionType':
+                processed.append({'ActionType': action_type, 'ActionStatus': 1})
+            else:
+                # KMSEncryption is the only other action and is not supported here
+                error = f'{action_type} is not supported'
+                processed.append({'ActionType': action_type, 'ActionStatus': 2, 'Error': error})
+                errors.append(error)
+
+        response = {
+            'ClientVersion': SSM_CLIENT_VERSION,
+            'ProcessedClientActions': processed,
+            'Errors': errors,
+        }
 
-def resolve_custom_db_host(host):
-    import dns.resolver
+        await self.send_input(PAYLOAD_HANDSHAKE_RESPONSE, json.dumps(response).encode())
 
-    answer = dns.resolver.resolve(host, 'CNAME')
+        if errors:
+            self.finish(f'SSM session handshake failed: {", ".join(errors)}')
 
-    # query() will throw when there are no records so we are checking for > 1 here really
-    if len(answer) != 1:
-        raise Exception(f'cannot resolve #{host} into RDS hostname')
+    async def acknowledge(self, message):
+        ack = {
+            'AcknowledgedMessageType': message['MessageType'],
+            'AcknowledgedMessageId': message['MessageId'],
+            'AcknowledgedMessageSequenceNumber': message['SequenceNumber'],
+            'IsSequentialMessage': True,
+        }
+        await self.websocket.send(encode_ssm_message(ACKNOWLEDGE_MESSAGE, 0, 3, 0, json.dumps(ack).encode()))
 
-    return str(answer[0])
+    async def send_input(self, payload_type, payload):
+        # Agent asks to stop sending when it cannot keep up, and we do not send too far ahead of acknowledgements
+        await self.publishing.wait()
+        while len(self.unacknowledged) >= SSM_SEND_WINDOW and self.is_open():
+            self.window_available.clear()
+            await self.window_available.wait()
 
+        if not self.is_open():
+            raise Exception(self.closed.result())
 
-def find_target_rds(host):
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds/client/describe_db_instances.html
+        sequence_number = self.next_sequence
+        self.next_sequence += 1
 
-    # We could iterate through all instances looking at their Endpoint.Address but lets save time using the fact that
-    # DB hostname looks like
-    #   <databaseid>.abcdefgwgxg2.eu-west-1.rds.amazonaws.com
-    rds_instance_id = rds_id_from_host(host)
-    if rds_instance_id is None:
-        raise Exception(f'{host} is not an RDS hostname')
+        frame = encode_ssm_message(INPUT_STREAM_MESSAGE, sequence_number, 0, payload_type, payload)
+        self.unacknowledged[sequence_number] = [time.time(), frame]
+        await self.websocket.send(frame)
 
-    response = rds_client.describe_db_instances(DBInstanceIdentifier=rds_instance_id)
+    async def send(self, data):
+        for i in range(0, len(data), SSM_STREAM_CHUNK_SIZE):
+            await self.send_input(PAYLOAD_OUTPUT, data[i:i + SSM_STREAM_CHUNK_SIZE])
 
-    if len(response['DBInstances']) != 1:
-        raise Exception(f'could not find RDS {rds_instance_id}')
+    async def send_flag(self, flag):
+        await self.send_input(PAYLOAD_FLAG, struct.pack('>I', flag))
 
-    return response['DBInstances'][0]
+    async def close(self):
+        if self.is_open():
+            try:
+                await self.send_flag(FLAG_TERMINATE_SESSION)
+            except Exception:
+                pass
+            self.finish('SSM data channel closed')
 
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
-def find_security_group(rds):
-    vpc_sgs = rds.get('VpcSecurityGroups')
-    if vpc_sgs is None or len(vpc_sgs) < 1:
-        raise Exception(f'RDS does no have VpcSecurityGroups')
+        if self.websocket is not None:
+            await self.websocket.close()
 
-    if len(vpc_sgs) > 1:
-        raise Exception(f'multiple groups in RDS VpcSecurityGroups')
 
-    return vpc_sgs[0]['VpcSecurityGroupId']
+async def forward_connection(channel, reader, writer, stats):
+    # Pipes one local connection through the data channel until either side closes, counting bytes both ways
 
+    # Anything left from the previous connection is of no use
+    while not channel.received.empty():
+        channel.received.get_nowait()
 
-def find_subnet(rds):
-    subnets = rds['DBSubnetGroup']['Subnets']
-    subnets = [s for s in subnets if s.get('SubnetStatus') == 'Active']
-
-    # In my case I have got two subnets but in one of them proxy EC2 instance does not work.
-    # The only difference is that one of subnets has default route 0.0.0.0/0 via NAT
-    # and can talk to SSM and the other does not.
-    # So my filtering here just searches for a subnet with default route.
-    # Unfortunately, other setups can be completely different:
-    #   * default route is not really required
-    #   * ACL may also play a role
-    # But I have no idea how to make anything universal (or just "more universal" here).
-
-    ec2_client = boto3.client('ec2')
-
-    for subnet in subnets:
-
-        response = ec2_client.describe_route_tables(
-            Filters=[
-                {
-                    'Name': 'association.subnet-id',
-                    'Values': [ subnet['SubnetIdentifier'] ]
-                }
-            ]
-        )
+    async def pump_to_local():
+        while (data := await channel.received.get()) is not None:
+            if stats['first_response'] is None and stats['first_sent'] is not None:
+                stats['first_response'] = time.time() - stats['first_sent']
+            stats['received'] += len(data)
+            writer.write(data)
+            await writer.drain()
+        writer.close()
 
-        for rt in response['RouteTables']:
-            for route in rt['Routes']:
-                if route['DestinationCidrBlock'] == '0.0.0.0/0':
-                    # This RT has a default route, use it
-                    return subnet['SubnetIdentifier']
+    pump = asyncio.create_task(pump_to_local())
+    try:
+        while channel.is_open() and (data := await reader.read(SSM_STREAM_CHUNK_SIZE)):
+            if stats['first_sent'] is None:
+                stats['first_sent'] = time.time()
+            stats['sent'] += len(data)
+            await channel.send(data)
+
+        # Agent drops its connection to the remote port and opens a new one when the next data arrives
+        if channel.is_open():
+            await channel.send_flag(FLAG_DISCONNECT_TO_PORT)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        pump.cancel()
+        writer.close()
+
+
+def format_connection_stats(stats):
+    first_response = '-' if stats['first_response'] is None else f'{stats["first_response"] * 1000:.0f}ms'
+    return (f'{stats["client"]}: {stats["sent"]} bytes sent, {stats["received"]} received, '
+            f'waited {stats["wait"] * 1000:.0f}ms for a session, first response in {first_response}, '
+            f'open for {stats["closed"] - stats["opened"]:.1f}s')
+
+
+class NativeTunnel:
+    # Local listener forwarding connections over SSM sessions, running its own event loop in a background thread.
+    # A session carries one connection at a time, so concurrent connections get sessions of their own, up to
+    # max_sessions, any more have to wait for a session to become free.
+    # One session is kept open while there are no connections, sessions that drop are reopened in the background
+    # so that the next connection does not have to wait for it.
+    # Messages from the background thread go to stderr, stdout may be carrying query results by then.
+
+    def __init__(self, open_channel, max_sessions = 1, on_connection_closed = None):
+        self.open_channel = open_channel
+        self.max_sessions = max_sessions
+        self.on_connection_closed = on_connection_closed
+        self.channels = []
+        self.idle_channels = None
+        self.server = None
+        self.keeper = None
+        self.active_connections = 0
+        self.last_used = time.time()
+        # Counters of connections being forwarded and totals of all connections so far
+        self.connections = {}
+        self.totals = {'connections': 0, 'sent': 0, 'received': 0, 'reconnects': 0}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self, local_port = 0):
+        self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start_async(local_port), self.loop).result()
+
+    async def start_async(self, local_port):
+        self.idle_channels = asyncio.Queue()
+
+        # Open the first session straight away so that problems show up before anything tries to connect
+        self.release_channel(await self.acquire_channel())
+
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', local_port)
+        self.keeper = asyncio.create_task(self.keep_session())
+        return self.server.sockets[0].getsockname()[1]
+
+    async def acquire_channel(self):
+        while True:
+            if self.max_sessions == 0:
+                raise Exception('tunnel is closed')
+
+            if self.idle_channels.empty() and len(self.channels) < self.max_sessions:
+                # Reserve the slot while the session is being opened
+                self.channels.append(None)
+                try:
+                    channel = await self.open_channel()
+                finally:
+                    self.channels.remove(None)
+                self.channels.append(channel)
+                return channel
+
+            channel = await self.idle_channels.get()
+            if channel is not None and channel.is_open():
+                return channel
+
+            if channel is not None:
+                self.discard_channel(channel)
+
+    def release_channel(self, channel):
+        if channel.is_open():
+            self.idle_channels.put_nowait(channel)
+        else:
+            self.discard_channel(channel)
+
+    def discard_channel(self, channel):
+        self.channels.remove(channel)
+        # Wake up whoever waits for a free session, they can open a new one now
+        self.idle_channels.put_nowait(None)
+
+    async def keep_session(self):
+        delay = TUNNEL_RECONNECT_DELAY
+        while self.max_sessions > 0:
+            await asyncio.sleep(delay)
+
+            # Sessions closed by the agent or the network while idle are of no use. Wake-up tokens go back along with
+            # the open sessions, connections waiting for a free session still need them.
+            idle = []
+            while not self.idle_channels.empty():
+                idle.append(self.idle_channels.get_nowait())
+            for channel in idle:
+                if channel is None or channel.is_open():
+                    self.idle_channels.put_nowait(channel)
+                else:
+                    self.discard_channel(channel)
+
+            if self.max_sessions == 0 or any(c is None or c.is_open() for c in self.channels):
+                delay = TUNNEL_RECONNECT_DELAY
+                continue
+
+            print('Tunnel session lost, reconnecting', file=sys.stderr)
+            try:
+                self.release_channel(await self.acquire_channel())
+                self.totals['reconnects'] += 1
+                delay = TUNNEL_RECONNECT_DELAY
+            except Exception as e:
+                # Instance may be gone for good, do not hammer SSM
+                delay = min(delay * 2, TUNNEL_MAX_RECONNECT_DELAY)
+                print(f'Tunnel reconnect failed, next attempt in {delay}s: {e}', file=sys.stderr)
+
+    async def serve(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        stats = {
+            'client': f'{peer[0]}:{peer[1]}' if peer else 'client',
+            'opened': time.time(), 'closed': None, 'wait': 0,
+            'sent': 0, 'received': 0, 'first_sent': None, 'first_response': None,
+        }
+        self.active_connections += 1
+        self.connections[id(stats)] = stats
+        try:
+            channel = await self.acquire_channel()
+            stats['wait'] = time.time() - stats['opened']
+            try:
+                await forward_connection(channel, reader, writer, stats)
+            finally:
+                self.release_channel(channel)
+        except Exception as e:
+            print(f'Tunnel error: {e}', file=sys.stderr)
+            writer.close()
+        finally:
+            self.active_connections -= 1
+            self.last_used = stats['closed'] = time.time()
+            del self.connections[id(stats)]
+            self.totals['connections'] += 1
+            self.totals['sent'] += stats['sent']
+            self.totals['received'] += stats['received']
+            if self.on_connection_closed is not None:
+                self.on_connection_closed(stats)
+
+    def stats(self):
+        return {
+            'sessions': sum(1 for c in list(self.channels) if c is not None and c.is_open()),
+            'connections': [dict(c) for c in list(self.connections.values())],
+            'totals': dict(self.totals),
+        }
 
-    raise Exception(f'unable to find a suitable subnet')
+    def is_alive(self):
+        return any(c is not None and c.is_open() for c in self.channels)
+
+    async def close_async(self):
+        self.max_sessions = 0
+        if self.keeper is not None:
+            self.keeper.cancel()
+        if self.server is not None:
+            self.server.close()
+        for channel in list(self.channels):
+            if channel is not None:
+                await channel.close()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.close_async(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def start_port_forwarding_session(instance_id, host, port):
+    response = aws_client('ssm').start_session(
+        Target=instance_id,
+        DocumentName='AWS-StartPortForwardingSessionToRemoteHost',
+        Parameters={
+            'host': [host],
+            'portNumber': [str(port)],
+            'localPortNumber': ['0'],
+        },
+    )
 
+    print(f'# SSM session {response["SessionId"]}')
 
-def make_stack_id(group_id, subnet_id):
-    return re.sub(r'^sg-', '', group_id) + '-' + re.sub(r'^subnet-', '', subnet_id)
+    return response
 
 
-###########################################
+async def open_port_forwarding_channel(instance_id, host, port):
+    response = await asyncio.to_thread(start_port_forwarding_session, instance_id, host, port)
 
-def read_file(file_name):
-    with open(file_name) as f:
-        return f.readlines()
+    channel = SsmDataChannel(response['StreamUrl'], response['TokenValue'])
+    channel.session_id = response['SessionId']
 
+    try:
+        await channel.open()
+    except Exception:
+        await asyncio.to_thread(aws_client('ssm').terminate_session, SessionId=channel.session_id)
+        raise
 
-def resolve_includes(line):
-    match = re.search(r'^ (.*) \{\{ INCLUDE : (\S+) \}\} (.*) $', line, re.VERBOSE)
-    if not match:
-        return line
+    return channel
 
-    indent = match.group(1)
-    file_name = match.group(2)
-    trailer = match.group(3)
 
-    if trailer != '':
-        raise Exception(f'Invalid use of INCLUDE for {file_name}: must be at the end of line')
+def open_tunnel_native(instance_id, host, port, sessions = 1, local_port = 0, on_connection_closed = None):
+    tunnel = NativeTunnel(lambda: open_port_forwarding_channel(instance_id, host, port), sessions, on_connection_closed)
 
-    if not re.match(r'^\s*$', indent):
-        raise Exception(f'Invalid use of INCLUDE for {file_name}: only indent whitespace must precede')
+    try:
+        local_port = tunnel.start(local_port)
+    except Exception:
+        tunnel.close()
+        raise
 
-    if '/' in file_name:
-        raise Exception(f'Invalid use of INCLUDE for {file_name}: no directory path is allowed')
+    print(f'Tunnel ready. Local port: {local_port}')
 
-    file_name = 'files/' + file_name
-    if not os.path.isfile(file_name):
-        raise Exception(f'Invalid use of INCLUDE for {file_name}: file not found')
+    return local_port, tunnel
 
-    return read_file_with_includes(file_name, indent)
 
+def close_tunnel_native(tunnel):
+    session_ids = [c.session_id for c in tunnel.channels if c is not None]
+    tunnel.close()
+    for session_id in session_ids:
+        aws_client('ssm').terminate_session(SessionId=session_id)
 
-def read_file_with_includes(file_name, indent = ''):
-    result = ''
-    for i in read_file(file_name):
-        result += resolve_includes(indent + i)
-    return result
+
+def open_tunnel(instance_id, host, port, method = 'auto', sessions = 1, local_port = 0, on_connection_closed = None):
+    # Number of sessions limits how many connections a native tunnel carries at the same time.
+    # Plugin started by the CLI multiplexes connections over a single session.
+    # Local port 0 lets the system pick a free one.
+    if method == 'native' or (method == 'auto' and import_websockets() is not None):
+        return open_tunnel_native(instance_id, host, port, sessions, local_port, on_connection_closed)
+    return open_tunnel_cli(instance_id, host, port, local_port)
+
+
+def close_tunnel(tunnel):
+    if isinstance(tunnel, NativeTunnel):
+        close_tunnel_native(tunnel)
+    else:
+        close_tunnel_cli(tunnel)
 
 
 ###########################################
+# Tunnel agent
+#
+# Long running process owning tunnels so that consecutive rdscli runs do not have to build a new SSM session each time.
+# Talks JSON lines over a Unix socket in the cache directory. While agent holds a tunnel, there is an SSM session
+# on the proxy instance so its inactivity monitor keeps reporting it as active.
 
-def main():
+def agent_request(request, timeout = 60):
+    path = cache_path(AGENT_SOCKET)
+    if not os.path.exists(path):
+        return None
 
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            # Opening a new tunnel can take a while
+            s.settimeout(timeout)
+            s.connect(path)
+            s.sendall(json.dumps(request).encode() + b'\n')
+            reply = s.makefile().readline()
+    except (ConnectionRefusedError, FileNotFoundError):
+        # Socket left behind by an agent that is not running anymore
+        return None
+
+    if not reply:
+        return None
+
+    reply = json.loads(reply)
+    if reply.get('error'):
+        raise Exception(f'agent: {reply["error"]}')
+
+    return reply
+
+
+class TunnelAgent:
+
+    def __init__(self, idle_timeout, method):
+        self.idle_timeout = idle_timeout
+        self.method = method
+        # (instance_id, host, port) -> {'tunnel', 'port', 'aliases', 'last_used'}
+        self.tunnels = {}
+        self.locks = {}
+
+    def is_alive(self, entry):
+        tunnel = entry['tunnel']
+        if isinstance(tunnel, NativeTunnel):
+            return tunnel.is_alive()
+        return tunnel.poll() is None
+
+    def is_idle(self, entry, now):
+        tunnel = entry['tunnel']
+        last_used = entry['last_used']
+        if isinstance(tunnel, NativeTunnel):
+            # Native tunnel knows when its connections were used, CLI tunnel is only known to be used when handed out
+            if tunnel.active_connections > 0:
+                return False
+            last_used = max(last_used, tunnel.last_used)
+        return now - last_used > self.idle_timeout
+
+    async def close_tunnel(self, key):
+        entry = self.tunnels.pop(key)
+        print(f'Closing tunnel to {key[1]}:{key[2]} via {key[0]}, local port {entry["port"]}')
+        try:
+            await asyncio.to_thread(close_tunnel, entry['tunnel'])
+        except Exception as e:
+            print(f'Failed to close tunnel: {e}')
+
+    async def open(self, request):
+        key = (request['instance_id'], request['host'], int(request['port']))
+
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            entry = self.tunnels.get(key)
+
+            if entry is not None and not self.is_alive(entry):
+                await self.close_tunnel(key)
+                entry = None
+
+            sessions = int(request.get('sessions', 1))
+
+            if entry is None:
+                print(f'Opening tunnel to {key[1]}:{key[2]} via {key[0]}')
+                local_port, tunnel = await asyncio.to_thread(open_tunnel, *key, self.method, sessions)
+                entry = {'tunnel': tunnel, 'port': local_port, 'aliases': set()}
+                self.tunnels[key] = entry
+
+            elif isinstance(entry['tunnel'], NativeTunnel):
+                entry['tunnel'].max_sessions = max(entry['tunnel'].max_sessions, sessions)
+
+            entry['aliases'].update(request.get('aliases', []))
+            entry['last_used'] = time.time()
+
+            return {'port': entry['port'], 'instance_id': key[0]}
+
+    def find(self, request):
+        # Any live tunnel to that database will do, whichever instance it goes through
+        for key, entry in self.tunnels.items():
+            if (request['host'] == key[1] or request['host'] in entry['aliases']) and int(request['port']) == key[2]:
+                if self.is_alive(entry):
+                    entry['last_used'] = time.time()
+                    return {'port': entry['port'], 'instance_id': key[0]}
+        return {}
+
+    def list(self):
+        tunnels = []
+        for k, e in self.tunnels.items():
+            tunnel = {'instance_id': k[0], 'host': k[1], 'port': k[2], 'local_port': e['port'], 'alive': self.is_alive(e)}
+            if isinstance(e['tunnel'], NativeTunnel):
+                tunnel.update(e['tunnel'].stats())
+            tunnels.append(tunnel)
+        return {'tunnels': tunnels}
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            op = request.get('op')
+
+            if op == 'ping':
+                reply = {'pid': os.getpid()}
+            elif op == 'open':
+                reply = await self.open(request)
+            elif op == 'find':
+                reply = self.find(request)
+            elif op == 'list':
+                reply = self.list()
+            else:
+                reply = {'error': f'invalid op: {op}'}
+
+        except Exception as e:
+            reply = {'error': str(e)}
+
+        writer.write(json.dumps(reply).encode() + b'\n')
+        await writer.drain()
+        writer.close()
+
+    async def close_idle(self):
+        while True:
+            await asyncio.sleep(min(30, self.idle_timeout))
+            now = time.time()
+            for key, entry in list(self.tunnels.items()):
+                if not self.is_alive(entry) or self.is_idle(entry, now):
+                    await self.close_tunnel(key)
+
+    async def run(self):
+        path = cache_path(AGENT_SOCKET)
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if os.path.exists(path):
+            if await asyncio.to_thread(agent_request, {'op': 'ping'}) is not None:
+                raise Exception('agent is already running')
+            os.unlink(path)
+
+        server = await asyncio.start_unix_server(self.handle, path)
+        os.chmod(path, 0o600)
+
+        print(f'Agent listening on {path}, closing tunnels idle for {self.idle_timeout}s')
+
+        stop = asyncio.Event()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+
+        closer = asyncio.create_task(self.close_idle())
+
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            closer.cancel()
+            for key in list(self.tunnels):
+                await self.close_tunnel(key)
+            os.unlink(path)
+
+
+def agent_main(argv):
     parser = argparse.ArgumentParser(
-        description='Command-line client for RDS'
+        prog=f'{sys.argv[0]} agent',
+        description='Keep tunnels open and share them between rdscli runs'
     )
 
-    parser.add_argument('--secret-id', metavar='VALUE', required=True,
-                        help='name of a secret in AWS Secrets Manager with RDS credentials')
-    parser.add_argument('--instance-id', metavar='VALUE',
-                        help='optional ID of an EC2 instance that will be used for tunnelling trafffic.')
-    parser.add_argument('--group-id', metavar='VALUE',
-                        help='ID of a security group for proxy EC2 instance. When omitted, try to infer it from RDS')
-    parser.add_argument('--subnet-id', metavar='VALUE',
-                        help='ID of a subnet to place proxy EC2 instance into. When omitted, try to infer it from RDS')
-    parser.add_argument('args', nargs=argparse.REMAINDER,
-                        help='additional arguments to pass to client')
+    parser.add_argument('--idle-timeout', metavar='SECONDS', type=int, default=DEFAULT_AGENT_IDLE_TIMEOUT,
+                        help=f'close tunnels not used for that long, default is {DEFAULT_AGENT_IDLE_TIMEOUT}s')
+    parser.add_argument('--tunnel', choices=['auto', 'native', 'cli'], default='auto',
+                        help='how to open SSM tunnels, see main command')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    mysql_args = args.args
-    if mysql_args and mysql_args[0] == '--':
-        mysql_args = mysql_args[1:]
+    asyncio.run(TunnelAgent(args.idle_timeout, args.tunnel).run())
 
-    init_clients()
 
-    secret_id = args.secret_id
+def mysql_cmdline(local_port, username, password, database, args):
+    cmdline = ['mysql',
+        f'--host=127.0.0.1',
+        f'--port={local_port}',
+        f'--user={username}',
+        f'--password={password}',
+        *args,
+        database
+    ]
 
-    print(f'Reading RDS credentials: {secret_id}')
-    db = json.loads(get_secret(secret_id))
+    filtered_cmdline = ['--password=...' if i.startswith('--password=') else i for i in cmdline]
+    logcmd = ' '.join(map(shlex.quote, filtered_cmdline))
 
-    # Make sure all the properties we need are present
-    for n in ['host', 'username', 'password']:
-        if db.get(n) is None:
-            raise Exception(f'{secret_id} does not contain {n} attribute')
+    return cmdline, logcmd
 
-    db_host = db['host']
-    db_port = db.get('port', 3306)
-    db_username = db['username']
-    db_password = db['password']
-    db_name = db.get('dbname', 'mysql')
-    db_engine = db.get('engine')
 
-    if db_engine is not None and db_engine != 'mysql':
-        raise Exception(f'{secret_id} points to non-MySQL RDS')
+def mysql_cli(local_port, username, password, database, args):
+    cmdline, logcmd = mysql_cmdline(local_port, username, password, database, args)
+    print(f'# {logcmd}')
 
-    print(f'DB host: {db_host}')
+    # Prevent Python from handling Ctrl+C, let the mysql itself deal with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    instance_id = args.instance_id
-    if instance_id is None:
-        # Instance ID was not provided, need to deploy our own
+    subprocess.run(cmdline)
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-        group_id = args.group_id
-        subnet_id = args.subnet_id
 
-        if group_id is None or subnet_id is None:
-            if not is_rds_host(db_host):
-                db_host = resolve_custom_db_host(db_host)
-                if not is_rds_host(db_host):
-                    raise Exception(f'resolved {host} is still not an RDS hostname')
+def mysql_batch(local_port, username, password, database, args, script):
+    # Runs mysql non-interactively with the script fed to its stdin, returns exit code and everything it printed
+    cmdline, _ = mysql_cmdline(local_port, username, password, database, args)
 
-            print(f'Resolved DB host: {db_host}')
+    result = subprocess.run(cmdline, input=script, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-            rds = find_target_rds(db_host)
+    return result.returncode, result.stdout
 
-            if group_id is None:
-                group_id = find_security_group(rds)
-                print(f'Security group: {group_id}')
 
-            if subnet_id is None:
-                subnet_id = find_subnet(rds)
-                print(f'Subnet: {subnet_id}')
+###########################################
+# Direct queries
+#
+# Talks MySQL protocol over the tunnel with PyMySQL instead of running mysql client, to stream results
+# in formats suitable for further processing.
 
-            print(f'Shortcut command:')
-            print(f'#   {sys.argv[0]} --secret-id {secret_id} --group-id {group_id} --subnet-id {subnet_id}')
+DEFAULT_QUERY_BATCH_SIZE = 1000
 
+# How often progress is reported while streaming results
+QUERY_PROGRESS_INTERVAL = 5
 
-        start = time.time()
-        print('Deploying proxy service')
 
-        template = read_file_with_includes('files/template.yaml')
+def import_pymysql():
+    try:
+        import pymysql
+        import pymysql.cursors
+        return pymysql
+    except ImportError:
+        raise Exception('PyMySQL package is required for this command: pip3 install pymysql')
+
+
+def connect_mysql(local_port, db, database = None, **kwargs):
+    pymysql = import_pymysql()
+    return pymysql.connect(
+        host='127.0.0.1',
+        port=local_port,
+        user=db['username'],
+        password=db['password'],
+        database=database or db['dbname'],
+        charset='utf8mb4',
+        **kwargs
+    )
 
-        stack_id = make_stack_id(group_id, subnet_id)
-        stack_name = f'tcp-proxy-{stack_id}'
 
-        stack_params = {
-            'StackId': stack_id,
-            'SecurityGroupId': group_id,
-            'SubnetId': subnet_id,
-            'ImageId': DEFAULT_PROXY_AMI,
-        }
+def query_batches(connection, sql, params, batch_size):
+    # Unbuffered cursor makes server stream rows as they are fetched, so only one batch is ever held in memory.
+    # Returns column names, a generator of row batches and column types: MySQL type code, length, scale and whether
+    # the column is unsigned. Description does not carry column flags, they come from the result's field packets.
+    pymysql = import_pymysql()
+
+    cursor = connection.cursor(pymysql.cursors.SSCursor)
+    cursor.execute(sql, params or None)
 
-        ensure_stack(stack_name, template, stack_params)
+    fields = getattr(getattr(cursor, '_result', None), 'fields', None) or []
+    unsigned = [bool(f.flags & MYSQL_UNSIGNED_FLAG) for f in fields]
 
-        print(f'Service deployed in {int(time.time() - start)}s')
+    columns = [d[0] for d in cursor.description or []]
+    types = [[d[1], d[4], d[5], unsigned[i] if i < len(unsigned) else False] for i, d in enumerate(cursor.description or [])]
 
-        outputs = get_stack_outputs(stack_name)
+    def batches():
+        try:
+            while rows := cursor.fetchmany(batch_size):
+                yield rows
+        finally:
+            cursor.close()
+
+    return columns, batches(), types
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def write_jsonl(out, columns, batches, types = None):
+    for rows in batches:
+        out.write(''.join(json.dumps(dict(zip(columns, row)), default=json_value) + '\n' for row in rows).encode())
+        yield len(rows)
+
+
+def write_csv(out, columns, batches, types = None):
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for rows in batches:
+        # Binary values are base64 encoded, same as in JSON
+        writer.writerows([base64.b64encode(v).decode() if isinstance(v, (bytes, bytearray)) else v for v in row] for row in rows)
+        yield len(rows)
+    text.detach()
+
+
+# MySQL column type codes (pymysql.constants.FIELD_TYPE) by the Python values PyMySQL returns for them
+MYSQL_INTEGER_TYPES = [1, 2, 3, 8, 9, 13]
+# BIGINT, unsigned ones go beyond int64
+MYSQL_LONGLONG_TYPE = 8
+
+# Column flag (pymysql.constants.FLAG.UNSIGNED)
+MYSQL_UNSIGNED_FLAG = 32
+MYSQL_FLOAT_TYPES = [4, 5]
+MYSQL_DECIMAL_TYPES = [0, 246]
+MYSQL_DATETIME_TYPES = [7, 12]
+MYSQL_DATE_TYPES = [10, 14]
+MYSQL_TIME_TYPES = [11]
+MYSQL_NULL_TYPES = [6]
+MYSQL_BIT_TYPES = [16]
+
+
+def arrow_type(pyarrow, column_type, values):
+    # Arrow type of a column from its MySQL type. Text and blobs share type codes, so the values tell them apart,
+    # text it is when there are none. Without a MySQL type (results cached by older versions) the type is inferred.
+    # Types cached before the unsigned flag was kept are taken as signed.
+    code, length, scale, unsigned = (list(column_type or []) + [None, None, None, False])[:4]
+    sample = next((v for v in values if v is not None), None)
+
+    if code == MYSQL_LONGLONG_TYPE and unsigned:
+        return pyarrow.uint64()
+    if code in MYSQL_INTEGER_TYPES:
+        return pyarrow.int64()
+    if code in MYSQL_FLOAT_TYPES:
+        return pyarrow.float64()
+    if code in MYSQL_DECIMAL_TYPES:
+        # Length counts the sign and the decimal point too, which leaves room enough for all the digits
+        precision = min(max(length or 0, scale or 0, 1), 76)
+        return pyarrow.decimal128(precision, scale or 0) if precision <= 38 else pyarrow.decimal256(precision, scale or 0)
+    if code in MYSQL_DATETIME_TYPES:
+        return pyarrow.timestamp('us')
+    if code in MYSQL_DATE_TYPES:
+        return pyarrow.date32()
+    if code in MYSQL_TIME_TYPES:
+        return pyarrow.duration('us')
+    if code in MYSQL_NULL_TYPES:
+        return pyarrow.null()
+    if code in MYSQL_BIT_TYPES:
+        return pyarrow.binary()
+
+    if code is None and sample is not None and not isinstance(sample, (str, bytes, bytearray)):
+        return pyarrow.array(values).type
+    return pyarrow.binary() if isinstance(sample, (bytes, bytearray)) else pyarrow.string()
+
+
+def write_arrow(out, columns, batches, types = None):
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise Exception('pyarrow package is required for arrow output: pip3 install pyarrow')
 
-        control_function = find_output(outputs, 'ControlLambdaFunction')
+    # Schema comes from column types, with a look at the first batch for text and blobs. It is written even when
+    # there are no rows, so that the stream is always valid.
+    batches = iter(batches)
+    first = next(batches, None)
 
-        print('Requesting proxy activation')
-        invoke_function(control_function, {'Action': 'activate'})
+    values = list(zip(*first)) if first else [[] for _ in columns]
+    schema = pyarrow.schema([
+        pyarrow.field(name, arrow_type(pyarrow, column_type, v))
+        for name, column_type, v in zip(columns, types or [None] * len(columns), values)
+    ])
 
-        start = time.time()
+    writer = pyarrow.ipc.new_stream(out, schema)
+
+    for rows in itertools.chain([first] if first else [], batches):
+        values = list(zip(*rows))
+        writer.write_batch(pyarrow.record_batch([pyarrow.array(v, type=f.type) for v, f in zip(values, schema)], schema=schema))
+        yield len(rows)
+
+    writer.close()
+
+
+QUERY_WRITERS = {
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+    'arrow': write_arrow,
+}
+
+
+class CountingWriter(io.RawIOBase):
+    # Binary stream counting bytes written through it
+
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+
+    def writable(self):
+        return True
 
-        instance_id = acquire_instance(stack_name)
-        print(f'Instance {instance_id} acquired in {int(time.time() - start)}s')
+    def write(self, data):
+        self.count += len(data)
+        return self.out.write(data)
 
+    def flush(self):
+        self.out.flush()
 
-    local_port, proc = open_tunnel_cli(instance_id, db_host, db_port)
 
-    mysql_cli(local_port, db_username, db_password, db_name, mysql_args)
+class Progress:
+    # Thread safe counter of rows and bytes reporting throughput every now and then
 
-    close_tunnel_cli(proc)
+    def __init__(self, log = sys.stdout):
+        self.log = log
+        self.start = time.time()
+        self.last_report = self.start
+        self.rows = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, rows, nbytes):
+        with self.lock:
+            self.rows += rows
+            self.bytes += nbytes
+            if time.time() - self.last_report >= QUERY_PROGRESS_INTERVAL:
+                self.last_report = time.time()
+                self.report(False)
+
+    def report(self, final = True):
+        elapsed = max(time.time() - self.start, 0.001)
+        text = f'{self.rows} rows, {self.bytes} bytes in {elapsed:.1f}s: ' \
+               f'{self.rows / elapsed:.0f} rows/s, {self.bytes / elapsed / 1024 / 1024:.2f} MB/s'
+        print(('Done: ' if final else 'Progress: ') + text, file=self.log, flush=True)
+
+
+def write_results(columns, batches, output_format, out, log = sys.stderr, types = None):
+    # Writes row batches to a binary stream, reporting progress to log. Returns number of rows and bytes written.
+
+    counter = CountingWriter(out)
+    progress = Progress(log)
+
+    for n in QUERY_WRITERS[output_format](counter, columns, batches, types):
+        progress.add(n, counter.count - progress.bytes)
+
+    # Writers may finish the output after the last batch, like the end of an Arrow stream
+    progress.add(0, counter.count - progress.bytes)
+
+    counter.flush()
+    progress.report()
+
+    return progress.rows, progress.bytes
+
+
+def run_query(connection, sql, params, output_format, batch_size, out, log = sys.stderr, cache = None):
+    # Streams query results to a binary stream, keeping them in the cache too when given one
+
+    columns, batches, types = query_batches(connection, sql, params, batch_size)
+
+    if cache is None:
+        return write_results(columns, batches, output_format, out, log, types)
+
+    try:
+        result = write_results(columns, cache.tee(batches), output_format, out, log, types)
+        cache.commit(columns, types)
+        return result
+    finally:
+        cache.discard()
+
+
+###########################################
+# Query result cache
+#
+# Results of read-only queries can be kept locally for a while, so that the same report run again is answered from disk
+# without going to AWS or the database at all. Entries are keyed by the normalized SQL, its parameters, the database
+# and the secret (along with the profile and region it is read from). Rows are stored as they are fetched, in pages of
+# one batch each holding the values column by column as compressed JSON. Values JSON has no type for are tagged, so that
+# reading a page never runs anything from the file. An index next to the pages keeps entry expiry and last use, and the
+# least recently used entries are evicted once the pages take too much space.
+
+QUERY_CACHE_DIR = 'queries'
+QUERY_CACHE_INDEX = 'queries.json'
+
+DEFAULT_QUERY_CACHE_SIZE = 512
+
+QUERY_CACHE_PAGE_HEADER = struct.Struct('>I')
+QUERY_CACHE_COMPRESSION_LEVEL = 3
+
+# Entries of other formats are ignored and overwritten
+QUERY_CACHE_FORMAT = 'json'
+
+SQL_TOKEN = re.compile(r'''
+      (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`)
+    | (?P<comment>--(?=\s|$)[^\n]*|\#[^\n]*|/\*(?!!).*?\*/)
+    | (?P<space>\s+)
+    | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+    | (?P<code>[^'"`\s\-\#/A-Za-z_]+|.)
+''', re.VERBOSE | re.DOTALL)
+
+# Words that make a SELECT lock rows, write somewhere or otherwise have side effects (FOR UPDATE, LOCK IN SHARE MODE,
+# FOR SHARE, INTO OUTFILE or variables), or make a WITH statement something else than a SELECT
+SQL_WRITE_WORDS = ['INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'INTO', 'LOCK', 'SHARE']
+SQL_SIDE_EFFECT_FUNCTIONS = ['GET_LOCK', 'RELEASE_LOCK', 'RELEASE_ALL_LOCKS', 'SLEEP', 'BENCHMARK']
+
+
+def tokenize_sql(sql):
+    # Tells string literals and quoted identifiers from code, so that neither whitespace nor keywords inside them count
+    return [(m.lastgroup, m.group()) for m in SQL_TOKEN.finditer(sql)]
+
+
+def normalize_sql(sql):
+    # Comments and runs of whitespace outside literals become a single space, trailing semicolons are dropped
+    parts = []
+    for kind, text in tokenize_sql(sql):
+        if kind in ['space', 'comment']:
+            text = ' '
+            if parts and parts[-1] == ' ':
+                continue
+        parts.append(text)
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def check_cacheable(sql):
+    # Only plain SELECTs have results that can be served again without running them
+    # Strings, quoted identifiers and comments are left out, keywords are whole words. Versioned comments (/*! */) are
+    # run by MySQL, so their content counts as code.
+    tokens = tokenize_sql(normalize_sql(sql))
+    words = [text.upper() for kind, text in tokens if kind == 'word']
+    code = [text for kind, text in tokens if kind == 'code']
+
+    reason = None
+    if not words or words[0] not in ['SELECT', 'WITH']:
+        reason = 'is not a SELECT'
+    elif any(';' in text for text in code):
+        reason = 'has more than one statement'
+    elif any(':=' in text for text in code):
+        reason = 'assigns variables'
+    elif any(w in SQL_WRITE_WORDS for w in words):
+        reason = f'uses {next(w for w in words if w in SQL_WRITE_WORDS)}'
+    elif any(w in SQL_SIDE_EFFECT_FUNCTIONS for w in words):
+        reason = f'calls {next(w for w in words if w in SQL_SIDE_EFFECT_FUNCTIONS)}'
+
+    if reason is not None:
+        raise Exception(f'only plain SELECT statements can be cached, this one {reason}')
+
+
+def query_cache_key(secret_id, database, reader, sql, params):
+    data = json.dumps({
+        'target': discovery_cache_key(secret_id),
+        'database': database,
+        'reader': reader,
+        'sql': normalize_sql(sql),
+        'params': params,
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def query_cache_file(key):
+    return os.path.join(cache_path(QUERY_CACHE_DIR), f'{key}.pages')
+
+
+def lookup_query_cache(key, ttl):
+    # Returns the entry when results of the query are not older than ttl seconds, marking it as used
+    with cache_lock:
+        index = load_cache(QUERY_CACHE_INDEX)
+        entry = index.get(key)
+        if entry is None or entry.get('format') != QUERY_CACHE_FORMAT or time.time() - entry['created'] > ttl \
+                or not os.path.exists(query_cache_file(key)):
+            return None
+
+        entry['used'] = time.time()
+        save_cache(QUERY_CACHE_INDEX, index)
+        return entry
+
+
+def evict_query_cache(index, max_bytes):
+    # Drops expired entries, then the least recently used ones until the rest fits
+
+    def drop(key):
+        index.pop(key)
+        try:
+            os.remove(query_cache_file(key))
+        except FileNotFoundError:
+            pass
+
+    now = time.time()
+    for key, entry in list(index.items()):
+        if entry['expires'] < now:
+            drop(key)
+
+    total = sum(entry['bytes'] for entry in index.values())
+    for key in sorted(index, key=lambda k: index[k]['used']):
+        if total <= max_bytes:
+            break
+        total -= index[key]['bytes']
+        drop(key)
+
+
+def encode_cached_value(value):
+    # Single key objects, tagged with the type the value comes back as. Rows never hold objects themselves.
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'time': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'timedelta': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytes': base64.b64encode(value).decode()}
+    raise TypeError(f'{type(value).__name__} values cannot be cached')
+
+
+CACHED_VALUE_DECODERS = {
+    'datetime': datetime.datetime.fromisoformat,
+    'date': datetime.date.fromisoformat,
+    'time': datetime.time.fromisoformat,
+    'timedelta': lambda parts: datetime.timedelta(*parts),
+    'decimal': decimal.Decimal,
+    'bytes': base64.b64decode,
+}
+
+
+def decode_cached_value(tagged):
+    ((tag, value),) = tagged.items()
+    return CACHED_VALUE_DECODERS[tag](value)
+
+
+def cached_batches(key):
+    with open(query_cache_file(key), 'rb') as f:
+        while header := f.read(QUERY_CACHE_PAGE_HEADER.size):
+            (length,) = QUERY_CACHE_PAGE_HEADER.unpack(header)
+            columns = json.loads(zlib.decompress(f.read(length)), object_hook=decode_cached_value)
+            yield list(zip(*columns))
+
+
+def replay_query(key, entry, output_format, out, log = sys.stderr):
+    print(f'Using results cached {time.time() - entry["created"]:.0f}s ago', file=log)
+    return write_results(entry['columns'], cached_batches(key), output_format, out, log, entry.get('types'))
+
+
+class QueryCacheWriter:
+    # Writes pages of results as they stream by, they become a cache entry once the query has completed
+
+    def __init__(self, key, ttl, max_bytes):
+        self.key = key
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.size = 0
+
+        os.makedirs(cache_path(QUERY_CACHE_DIR), exist_ok=True)
+        self.tmp_name = f'{query_cache_file(key)}.{os.getpid()}'
+        self.file = open(self.tmp_name, 'wb')
+
+    def add(self, rows):
+        if self.file is None:
+            return
+
+        try:
+            data = json.dumps(list(zip(*rows)), default=encode_cached_value, separators=(',', ':')).encode()
+        except TypeError as e:
+            print(f'Results cannot be cached: {e}', file=sys.stderr)
+            self.discard()
+            return
+
+        page = zlib.compress(data, QUERY_CACHE_COMPRESSION_LEVEL)
+
+        self.size += QUERY_CACHE_PAGE_HEADER.size + len(page)
+        if self.size > self.max_bytes:
+            print('Results are too large to be cached', file=sys.stderr)
+            self.discard()
+            return
+
+        self.file.write(QUERY_CACHE_PAGE_HEADER.pack(len(page)))
+        self.file.write(page)
+        self.rows += len(rows)
+
+    def tee(self, batches):
+        for rows in batches:
+            self.add(rows)
+            yield rows
+
+    def commit(self, columns, types = None):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_name, query_cache_file(self.key))
+
+        now = time.time()
+        with cache_lock:
+            index = load_cache(QUERY_CACHE_INDEX)
+            index[self.key] = {
+                'format': QUERY_CACHE_FORMAT,
+                'columns': columns,
+                'types': types,
+                'rows': self.rows,
+                'bytes': self.size,
+                'created': now,
+                'expires': now + self.ttl,
+                'used': now,
+            }
+            evict_query_cache(index, self.max_bytes)
+            save_cache(QUERY_CACHE_INDEX, index)
+
+    def discard(self):
+        # Results that did not make it to the end are not kept
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+        os.remove(self.tmp_name)
+
+
+###########################################
+# Dump and restore
+#
+# Tables are dumped over several connections at once. Tables with an integer primary key are split into chunks
+# by key ranges, so that a large table is dumped by several connections too. Every chunk goes into its own
+# compressed file of INSERT statements, one statement per line, and all chunks are restored in parallel as well.
+
+DEFAULT_DUMP_JOBS = 4
+DEFAULT_DUMP_CHUNK_ROWS = 100000
+
+# Limits for a single INSERT statement, so that it fits into max_allowed_packet
+DUMP_INSERT_ROWS = 1000
+DUMP_INSERT_BYTES = 1024 * 1024
+
+DUMP_MANIFEST = 'manifest.json'
+
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'none': '',
+}
+
+INTEGER_TYPES = ['tinyint', 'smallint', 'mediumint', 'int', 'bigint']
+
+
+def open_compressed(path, mode, compression):
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=3) if 'w' in mode else gzip.open(path, mode)
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstandard package is required for zstd compression: pip3 install zstandard')
+
+        f = open(path, mode)
+        if 'w' in mode:
+            return zstandard.ZstdCompressor(level=3).stream_writer(f, closefd=True)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=True))
+
+    return open(path, mode)
+
+
+def quote_identifier(name):
+    return '`' + name.replace('`', '``') + '`'
+
+
+def execute(connection, sql, params = None):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def start_snapshots(coordinator, workers, tables):
+    # Each worker gets its own transaction snapshot. For all of them to see the same data, nothing should be written
+    # while they are started. FLUSH TABLES WITH READ LOCK is not permitted on RDS, so the coordinator takes a read
+    # lock on just the dumped tables instead. It must not start a transaction itself, that would release the lock.
+    # Without the lock only the first worker is used, its snapshot is consistent on its own.
+    # Returns workers to dump with.
+
+    locked = False
+    if len(workers) > 1 and tables:
+        try:
+            execute(coordinator, 'LOCK TABLES ' + ', '.join(f'{quote_identifier(t)} READ' for t in tables))
+            locked = True
+        except Exception as e:
+            print(f'Warning: cannot lock tables ({e}), dumping over a single connection to keep the dump consistent')
+            workers = workers[:1]
+
+    try:
+        for connection in workers:
+            execute(connection, 'SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            execute(connection, 'START TRANSACTION WITH CONSISTENT SNAPSHOT')
+    finally:
+        if locked:
+            execute(coordinator, 'UNLOCK TABLES')
+
+    return workers
+
+
+def list_tables(connection, names):
+    rows = execute(connection, """
+        SELECT TABLE_NAME, COALESCE(TABLE_ROWS, 0) FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'
+        ORDER BY DATA_LENGTH DESC
+    """)
+
+    if names:
+        missing = set(names) - set(r[0] for r in rows)
+        if missing:
+            raise Exception(f'tables not found: {", ".join(sorted(missing))}')
+        rows = [r for r in rows if r[0] in names]
+
+    return rows
+
+
+def integer_primary_key(connection, table):
+    rows = execute(connection, """
+        SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_KEY = 'PRI'
+    """, (table,))
+
+    if len(rows) == 1 and rows[0][1].lower() in INTEGER_TYPES:
+        return rows[0][0]
+
+    return None
+
+
+def dump_columns(connection, table):
+    # Generated columns are computed by the server and cannot be inserted into, so they are left out
+    rows = execute(connection, """
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+          AND EXTRA NOT LIKE '%%VIRTUAL GENERATED%%' AND EXTRA NOT LIKE '%%STORED GENERATED%%'
+        ORDER BY ORDINAL_POSITION
+    """, (table,))
+    return [r[0] for r in rows]
+
+
+def plan_chunks(connection, table, estimated_rows, chunk_rows):
+    # Returns WHERE conditions splitting the table into chunks of roughly chunk_rows rows, None for the whole table
+
+    key = integer_primary_key(connection, table)
+    if key is None or estimated_rows <= chunk_rows:
+        return [None]
+
+    key = quote_identifier(key)
+    ((low, high),) = execute(connection, f'SELECT MIN({key}), MAX({key}) FROM {quote_identifier(table)}')
+    if low is None:
+        return [None]
+
+    count = math.ceil(estimated_rows / chunk_rows)
+    step = max(math.ceil((high - low + 1) / count), 1)
+    bounds = list(range(low + step, high + 1, step))
+
+    # First and last chunks are open ended, row count estimate and the key range can be off
+    conditions = []
+    previous = None
+    for bound in bounds:
+        conditions.append(f'{key} < {bound}' if previous is None else f'{key} >= {previous} AND {key} < {bound}')
+        previous = bound
+    conditions.append(f'{key} >= {previous}' if previous is not None else None)
+
+    return conditions
+
+
+def dump_chunk(connection, table, columns, condition, path, compression, progress):
+    pymysql = import_pymysql()
+
+    column_list = ', '.join(quote_identifier(c) for c in columns)
+
+    sql = f'SELECT {column_list} FROM {quote_identifier(table)}'
+    if condition is not None:
+        sql += f' WHERE {condition}'
+
+    insert = f'INSERT INTO {quote_identifier(table)} ({column_list}) VALUES '
+    rows = 0
+
+    with connection.cursor(pymysql.cursors.SSCursor) as cursor, open_compressed(path, 'wb', compression) as out:
+        cursor.execute(sql)
+
+        values = []
+        size = 0
+
+        def flush():
+            line = (insert + ','.join(values) + ';\n').encode()
+            out.write(line)
+            progress.add(len(values), len(line))
+
+        while batch := cursor.fetchmany(DUMP_INSERT_ROWS):
+            for row in batch:
+                value = '(' + ','.join(connection.escape(v) for v in row) + ')'
+                values.append(value)
+                size += len(value)
+                rows += 1
+
+                if len(values) >= DUMP_INSERT_ROWS or size >= DUMP_INSERT_BYTES:
+                    flush()
+                    values = []
+                    size = 0
+
+        if values:
+            flush()
+
+    return rows
+
+
+def run_workers(connections, tasks, work):
+    # Every connection works through the shared list of tasks in its own thread
+
+    task_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+
+    def worker(connection):
+        while True:
+            try:
+                task = task_queue.get_nowait()
+            except queue.Empty:
+                return
+            work(connection, *task)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(connections)) as executor:
+        futures = [executor.submit(worker, c) for c in connections]
+        for future in futures:
+            future.result()
+
+
+def dump_database(connections, output_dir, tables, chunk_rows, compression):
+    # The first connection plans the work and holds the lock while the others start their snapshots. With just one
+    # connection it dumps too, there is nothing to line its snapshot up with.
+    coordinator = connections[0]
+    workers = connections[1:] or connections
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest = {
+        'compression': compression,
+        'consistent': True,
+        'tables': [],
+    }
+
+    tasks = []
+
+    listed = list_tables(coordinator, tables)
+    workers = start_snapshots(coordinator, workers, [t for t, _ in listed])
+
+    for table, estimated_rows in listed:
+        ((_, create_table),) = execute(coordinator, f'SHOW CREATE TABLE {quote_identifier(table)}')
+
+        schema_file = f'{table}.schema.sql'
+        with open(os.path.join(output_dir, schema_file), 'w') as f:
+            f.write(create_table + ';\n')
+
+        columns = dump_columns(coordinator, table)
+
+        chunks = []
+        for n, condition in enumerate(plan_chunks(coordinator, table, estimated_rows, chunk_rows)):
+            chunk_file = f'{table}.{n:05d}.sql{COMPRESSION_EXTENSIONS[compression]}'
+            chunks.append(chunk_file)
+            tasks.append((table, columns, condition, chunk_file))
+
+        manifest['tables'].append({'name': table, 'schema': schema_file, 'chunks': chunks})
+        print(f'{table}: ~{estimated_rows} rows in {len(chunks)} chunks')
+
+    progress = Progress()
+
+    def work(connection, table, columns, condition, chunk_file):
+        dump_chunk(connection, table, columns, condition, os.path.join(output_dir, chunk_file), compression, progress)
+
+    # Tables come largest first, so the longest chunks start early
+    run_workers(workers, tasks, work)
+
+    progress.report()
+
+    with open(os.path.join(output_dir, DUMP_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def restore_chunk(connection, path, compression, progress):
+    with connection.cursor() as cursor, open_compressed(path, 'rb', compression) as f:
+        for line in f:
+            cursor.execute(line.decode())
+            progress.add(cursor.rowcount, len(line))
+    connection.commit()
+
+
+def restore_database(connections, input_dir, tables, drop_existing):
+    with open(os.path.join(input_dir, DUMP_MANIFEST)) as f:
+        manifest = json.load(f)
+
+    compression = manifest['compression']
+
+    selected = [t for t in manifest['tables'] if not tables or t['name'] in tables]
+
+    # Tables are created first, as data may come in any order foreign key checks are off while loading
+    for connection in connections:
+        execute(connection, 'SET SESSION FOREIGN_KEY_CHECKS = 0')
+        execute(connection, 'SET SESSION UNIQUE_CHECKS = 0')
+
+    coordinator = connections[0]
+    for table in selected:
+        if drop_existing:
+            execute(coordinator, f'DROP TABLE IF EXISTS {quote_identifier(table["name"])}')
+        with open(os.path.join(input_dir, table['schema'])) as f:
+            execute(coordinator, f.read())
+        print(f'Created {table["name"]}')
+
+    tasks = [(os.path.join(input_dir, c),) for t in selected for c in t['chunks']]
+    tasks.sort(key=lambda t: os.path.getsize(t[0]), reverse=True)
+
+    progress = Progress()
+
+    def work(connection, path):
+        restore_chunk(connection, path, compression, progress)
+
+    run_workers(connections, tasks, work)
+
+    progress.report()
+
+
+###########################################
+# Tunnel benchmark
+#
+# Measures what connections through the tunnel get: time to connect and log in, round trip of `SELECT 1` and throughput
+# of a large result, with and without MySQL protocol compression. PyMySQL does not do compression, so results are
+# transferred by `mysql` client. With --offline, the same runs go to a MySQL protocol stand-in on localhost instead, which
+# gives a baseline without AWS to compare runs through proxies on different instance types against.
+
+DEFAULT_BENCH_CONNECTS = 10
+DEFAULT_BENCH_PINGS = 100
+DEFAULT_BENCH_ROWS = 100000
+DEFAULT_BENCH_RUNS = 3
+
+BENCH_PERCENTILES = [50, 90, 99]
+
+# Digits 0-9, cross joined with itself once per digit of the number of rows to generate them on any MySQL version
+BENCH_DIGITS = '(' + ' UNION ALL '.join(f'SELECT {d} AS d' for d in range(10)) + ')'
+
+# Stand-in finds the number of rows to generate at the end of the query
+BENCH_ROWS_PATTERN = re.compile(r'WHERE n < (\d+)$')
+
+MYSQL_CLIENT_COMPRESS = 0x20
+MYSQL_CAPABILITIES = 0x1 | 0x4 | 0x8 | MYSQL_CLIENT_COMPRESS | 0x200 | 0x2000 | 0x8000 | 0x80000
+MYSQL_STATUS_AUTOCOMMIT = 0x2
+MYSQL_UTF8MB4 = 45
+MYSQL_TYPE_VAR_STRING = 0xfd
+
+MYSQL_COM_QUIT = 0x01
+MYSQL_COM_QUERY = 0x03
+
+# Compressed protocol packs packets into frames of up to that many bytes, frames shorter than the minimum are
+# sent as they are, same as MySQL does
+STANDIN_FRAME_SIZE = 16 * 1024
+STANDIN_MIN_COMPRESS_LENGTH = 50
+
+
+def bench_query(rows):
+    # Rows are generated by the server: numbers, hashes and repetitive text, compressible about as well as typical data
+    digits = len(str(max(rows - 1, 1)))
+    numbers = ' + '.join(f'{10 ** i} * d{i}.d' for i in range(digits))
+    tables = ', '.join(f'{BENCH_DIGITS} AS d{i}' for i in range(digits))
+    return f"SELECT n, MD5(n) AS hash, REPEAT(CONCAT('row ', n, ' '), 16) AS text " \
+           f"FROM (SELECT {numbers} AS n FROM {tables}) numbers WHERE n < {rows}"
+
+
+def bench_rows(rows):
+    # Rows of the bench query as MySQL returns them
+    for n in range(rows):
+        yield str(n), hashlib.md5(str(n).encode()).hexdigest(), f'row {n} ' * 16
+
+
+def mysql_lenenc_int(n):
+    if n < 251:
+        return bytes([n])
+    if n < 1 << 16:
+        return b'\xfc' + n.to_bytes(2, 'little')
+    if n < 1 << 24:
+        return b'\xfd' + n.to_bytes(3, 'little')
+    return b'\xfe' + n.to_bytes(8, 'little')
+
+
+def mysql_lenenc_str(data):
+    return mysql_lenenc_int(len(data)) + data
+
+
+class MysqlStandInConnection:
+    # Server side of a single client connection
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.sequence = 0
+        self.compressed = False
+        self.compressed_sequence = 0
+        # Data of compressed frames not read yet, and packets not sent yet
+        self.input = b''
+        self.output = bytearray()
+
+    def read_exactly(self, n):
+        data = self.reader.read(n)
+        if len(data) < n:
+            raise EOFError()
+        return data
+
+    def read(self, n):
+        if not self.compressed:
+            return self.read_exactly(n)
+
+        while len(self.input) < n:
+            header = self.read_exactly(7)
+            self.compressed_sequence = (header[3] + 1) % 256
+            payload = self.read_exactly(int.from_bytes(header[:3], 'little'))
+            self.input += zlib.decompress(payload) if int.from_bytes(header[4:], 'little') else payload
+
+        data, self.input = self.input[:n], self.input[n:]
+        return data
+
+    def read_packet(self):
+        header = self.read(4)
+        self.sequence = (header[3] + 1) % 256
+        return self.read(int.from_bytes(header[:3], 'little'))
+
+    def write_packet(self, payload):
+        self.output += len(payload).to_bytes(3, 'little') + bytes([self.sequence]) + payload
+        self.sequence = (self.sequence + 1) % 256
+        if len(self.output) >= STANDIN_FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = bytes(self.output)
+        self.output.clear()
+
+        if not self.compressed:
+            self.sock.sendall(data)
+            return
+
+        for i in range(0, len(data), STANDIN_FRAME_SIZE):
+            chunk = data[i:i + STANDIN_FRAME_SIZE]
+            if len(chunk) < STANDIN_MIN_COMPRESS_LENGTH:
+                payload, length = chunk, 0
+            else:
+                payload, length = zlib.compress(chunk), len(chunk)
+            header = len(payload).to_bytes(3, 'little') + bytes([self.compressed_sequence]) + length.to_bytes(3, 'little')
+            self.compressed_sequence = (self.compressed_sequence + 1) % 256
+            self.sock.sendall(header + payload)
+
+    def ok(self):
+        self.write_packet(b'\x00' + mysql_lenenc_int(0) + mysql_lenenc_int(0) +
+                          MYSQL_STATUS_AUTOCOMMIT.to_bytes(2, 'little') + bytes(2))
+
+    def eof(self):
+        self.write_packet(b'\xfe' + bytes(2) + MYSQL_STATUS_AUTOCOMMIT.to_bytes(2, 'little'))
+
+    def error(self, code, message, state = 'HY000'):
+        self.write_packet(b'\xff' + code.to_bytes(2, 'little') + b'#' + state.encode() + message.encode())
+
+    def handshake(self):
+        # Anyone gets in, with whatever password and auth plugin
+        salt = bytes(random.randint(1, 127) for _ in range(20))
+        self.write_packet(
+            b'\x0a' + b'8.0.0-rdscli-stand-in\x00' + (1).to_bytes(4, 'little') + salt[:8] + b'\x00' +
+            (MYSQL_CAPABILITIES & 0xffff).to_bytes(2, 'little') + bytes([MYSQL_UTF8MB4]) +
+            MYSQL_STATUS_AUTOCOMMIT.to_bytes(2, 'little') + (MYSQL_CAPABILITIES >> 16).to_bytes(2, 'little') +
+            bytes([len(salt) + 1]) + bytes(10) + salt[8:] + b'\x00' + b'mysql_native_password\x00'
+        )
+        self.flush()
+
+        capabilities = int.from_bytes(self.read_packet()[:4], 'little')
+        self.ok()
+        self.flush()
+
+        # Everything after the handshake is compressed when the client asked for it
+        self.compressed = bool(capabilities & MYSQL_CLIENT_COMPRESS)
+
+    def result(self, columns, rows, types = None):
+        # Values are text as MySQL sends them, None is NULL. Types are (type code, flags, length, decimals) of each
+        # column, strings by default.
+        self.write_packet(mysql_lenenc_int(len(columns)))
+        for name, (type_code, flags, length, decimals) in zip(columns, types or [(MYSQL_TYPE_VAR_STRING, 0, 1 << 16, 0)] * len(columns)):
+            self.write_packet(
+                mysql_lenenc_str(b'def') + mysql_lenenc_str(b'') * 3 + mysql_lenenc_str(name.encode()) * 2 +
+                b'\x0c' + MYSQL_UTF8MB4.to_bytes(2, 'little') + length.to_bytes(4, 'little') +
+                bytes([type_code]) + flags.to_bytes(2, 'little') + bytes([decimals]) + bytes(2)
+            )
+        self.eof()
+        for row in rows:
+            self.write_packet(b''.join(b'\xfb' if value is None else mysql_lenenc_str(value.encode()) for value in row))
+        self.eof()
+
+    def query(self, sql):
+        match = BENCH_ROWS_PATTERN.search(sql.strip())
+        if match:
+            self.result(['n', 'hash', 'text'], bench_rows(int(match.group(1))))
+        elif sql.lstrip().upper().startswith('SELECT'):
+            self.result(['1'], [('1',)])
+        else:
+            # Session settings clients send after logging in
+            self.ok()
+
+    def serve(self):
+        self.handshake()
+        while True:
+            packet = self.read_packet()
+            if packet[0] == MYSQL_COM_QUIT:
+                return
+            if packet[0] == MYSQL_COM_QUERY:
+                self.query(packet[1:].decode())
+            else:
+                self.ok()
+            self.flush()
+
+
+class MysqlStandIn:
+    # Just enough of a MySQL server for the benchmark, listening on localhost. Connections are served by instances
+    # of connection_class, which can answer other queries too.
+
+    def __init__(self, connection_class = MysqlStandInConnection):
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.connection_class = connection_class
+
+    def start(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        return self.server.getsockname()[1]
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                # Closed
+                return
+            # Same as MySQL, small packets go out straight away
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        with sock:
+            try:
+                self.connection_class(sock).serve()
+            except (EOFError, OSError):
+                pass
+
+    def close(self):
+        self.server.close()
+
+
+def summarize_bench(values, digits = 3):
+    values = [round(v, digits) for v in values]
+    return {
+        'count': len(values),
+        'min': min(values),
+        **{f'p{p}': percentile(values, p) for p in BENCH_PERCENTILES},
+        'max': max(values),
+    }
+
+
+def bench_connects(connect, count):
+    times = []
+    for _ in range(count):
+        start = time.time()
+        connection = connect()
+        times.append((time.time() - start) * 1000)
+        connection.close()
+    return times
+
+
+def bench_pings(connection, count):
+    times = []
+    with connection.cursor() as cursor:
+        for _ in range(count):
+            start = time.time()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            times.append((time.time() - start) * 1000)
+    return times
+
+
+def bench_transfer_cli(local_port, db, database, sql, compress):
+    # Returns bytes of result printed by mysql, seconds to the first of them and to the last one
+    args = ['--batch', '--quick', '--skip-column-names', '-e', sql] + (['--compress'] if compress else [])
+    cmdline, _ = mysql_cmdline(local_port, db['username'], db['password'], database or db['dbname'], args)
+
+    start = time.time()
+    first = None
+    nbytes = 0
+
+    process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    while chunk := process.stdout.read1(1024 * 1024):
+        if first is None:
+            first = time.time() - start
+        nbytes += len(chunk)
+    error = process.stderr.read()
+
+    if process.wait() != 0:
+        raise Exception(f'mysql failed: {error.decode().strip()}')
+
+    return nbytes, first or 0, time.time() - start
+
+
+def bench_transfer_pymysql(connection, sql):
+    # Same as bench_transfer_cli, counting bytes as mysql would print them
+    start = time.time()
+    _, batches, _ = query_batches(connection, sql, None, DEFAULT_QUERY_BATCH_SIZE)
+    first = time.time() - start
+
+    nbytes = 0
+    for rows in batches:
+        nbytes += sum(len('\t'.join(map(str, row)).encode()) + 1 for row in rows)
+
+    return nbytes, first, time.time() - start
+
+
+def run_bench(local_port, db, database, connects, pings, rows, runs):
+
+    def connect():
+        return connect_mysql(local_port, db, database)
+
+    print(f'Connecting {connects} times')
+    connect_times = bench_connects(connect, connects)
+
+    print(f'Sending {pings} pings')
+    connection = connect()
+    try:
+        ping_times = bench_pings(connection, pings)
+    finally:
+        connection.close()
+
+    sql = bench_query(rows)
+    client = 'mysql' if shutil.which('mysql') else 'pymysql'
+    transfer = {'client': client, 'rows': rows}
+
+    for mode in ['plain', 'compressed']:
+        if mode == 'compressed' and client != 'mysql':
+            transfer[mode] = {'skipped': 'needs mysql client, PyMySQL does not support compression'}
+            continue
+
+        results = []
+        for run in range(runs):
+            print(f'Transferring {rows} rows, {mode}, run {run + 1} of {runs}')
+            if client == 'mysql':
+                results.append(bench_transfer_cli(local_port, db, database, sql, mode == 'compressed'))
+            else:
+                connection = connect()
+                try:
+                    results.append(bench_transfer_pymysql(connection, sql))
+                finally:
+                    connection.close()
+
+        transfer[mode] = {
+            'bytes': results[0][0],
+            'first_byte_ms': summarize_bench([first * 1000 for _, first, _ in results]),
+            'mb_per_s': summarize_bench([nbytes / max(total - first, 0.001) / 1024 / 1024 for nbytes, first, total in results]),
+        }
+
+    return {
+        'connect_ms': summarize_bench(connect_times),
+        'ping_ms': summarize_bench(ping_times),
+        'transfer': transfer,
+    }
+
+
+def parse_rds_host(host):
+    # Returns kind of the endpoint and identifier of what it points to, None when it is not an RDS hostname:
+    #   <instanceid>.abcdefgwgxg2.eu-west-1.rds.amazonaws.com              - instance
+    #   <clusterid>.cluster-abcdefgwgxg2.eu-west-1.rds.amazonaws.com       - Aurora cluster (writer) endpoint
+    #   <clusterid>.cluster-ro-abcdefgwgxg2.eu-west-1.rds.amazonaws.com    - Aurora reader endpoint
+    #   <endpointid>.cluster-custom-abcdefgwgxg2.eu-west-1.rds.amazonaws.com - Aurora custom endpoint
+    match = re.search(r'^ ([^.]+) \. (cluster-(?:(ro|custom)-)?)? [a-z0-9]+ \. [a-z0-9-]+ \.rds\.amazonaws\.com\.? $',
+                      host, re.VERBOSE)
+    if not match:
+        return None
+
+    if match.group(2) is None:
+        return 'instance', match.group(1)
+    return {None: 'cluster', 'ro': 'reader', 'custom': 'custom'}[match.group(3)], match.group(1)
+
+
+def is_rds_host(host):
+    return parse_rds_host(host) is not None
+
+
+def resolve_custom_db_host(host):
+    import dns.resolver
+
+    answer = dns.resolver.resolve(host, 'CNAME')
+
+    # query() will throw when there are no records so we are checking for > 1 here really
+    if len(answer) != 1:
+        raise Exception(f'cannot resolve #{host} into RDS hostname')
+
+    return str(answer[0])
+
+
+def describe_instance(instance_id):
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds/client/describe_db_instances.html
+    response = aws_client('rds').describe_db_instances(DBInstanceIdentifier=instance_id)
+
+    if len(response['DBInstances']) != 1:
+        raise Exception(f'could not find RDS {instance_id}')
+
+    return response['DBInstances'][0]
+
+
+def describe_cluster(cluster_id):
+    response = aws_client('rds').describe_db_clusters(DBClusterIdentifier=cluster_id)
+
+    if len(response['DBClusters']) != 1:
+        raise Exception(f'could not find Aurora cluster {cluster_id}')
+
+    return response['DBClusters'][0]
+
+
+def find_target_cluster(host):
+    # Returns the Aurora cluster behind a cluster, reader or custom endpoint and the custom endpoint itself if any
+    kind, identifier = parse_rds_host(host)
+
+    if kind != 'custom':
+        return describe_cluster(identifier), None
+
+    endpoints = aws_client('rds').describe_db_cluster_endpoints(DBClusterEndpointIdentifier=identifier)['DBClusterEndpoints']
+    if len(endpoints) != 1:
+        raise Exception(f'could not find Aurora endpoint {identifier}')
+
+    return describe_cluster(endpoints[0]['DBClusterIdentifier']), endpoints[0]
+
+
+def find_target_rds(host):
+    # Returns an instance the host leads to, which is where security group and subnets are looked up.
+    # Instances of a cluster share them, so the writer will do for any cluster endpoint.
+
+    # We could iterate through all instances looking at their Endpoint.Address but lets save time using the fact that
+    # DB hostname contains the identifier
+    target = parse_rds_host(host)
+    if target is None:
+        raise Exception(f'{host} is not an RDS hostname')
+
+    kind, identifier = target
+    if kind == 'instance':
+        return describe_instance(identifier)
+
+    cluster, _ = find_target_cluster(host)
+    members = sorted(cluster.get('DBClusterMembers', []), key=lambda m: not m.get('IsClusterWriter'))
+    if not members:
+        raise Exception(f'Aurora cluster {cluster["DBClusterIdentifier"]} has no instances')
+
+    return describe_instance(members[0]['DBInstanceIdentifier'])
+
+
+def find_security_group(rds):
+    vpc_sgs = rds.get('VpcSecurityGroups')
+    if vpc_sgs is None or len(vpc_sgs) < 1:
+        raise Exception(f'RDS does no have VpcSecurityGroups')
+
+    if len(vpc_sgs) > 1:
+        raise Exception(f'multiple groups in RDS VpcSecurityGroups')
+
+    return vpc_sgs[0]['VpcSecurityGroupId']
+
+
+def make_stack_id(group_id, subnet_id, vpc_id = None):
+    # Proxy shared by the databases of a VPC is named after the VPC
+    if vpc_id is not None:
+        return 'vpc-' + re.sub(r'^vpc-', '', vpc_id)
+    return re.sub(r'^sg-', '', group_id) + '-' + re.sub(r'^subnet-', '', subnet_id)
+
+
+###########################################
+# Read replicas
+#
+# With --reader, the tunnel goes to a replica instead of the host in the secret: an Aurora reader or an RDS read replica.
+# Replicas are looked up once in a while and cached, the least loaded one is picked by its current number of
+# connections in CloudWatch, a random one when these are not available. Replicas out of reach of the proxy are skipped.
+
+TOPOLOGY_CACHE_TTL = 10 * 60
+TOPOLOGY_CACHE = 'topology.json'
+
+# Connections are averaged over that many last seconds
+READER_LOAD_PERIOD = 5 * 60
+
+
+def cluster_reader_ids(cluster, endpoint):
+    # Custom endpoint limits readers to its members
+    reader_ids = [m['DBInstanceIdentifier'] for m in cluster.get('DBClusterMembers', []) if not m.get('IsClusterWriter')]
+    if endpoint is not None and endpoint.get('StaticMembers'):
+        return [i for i in reader_ids if i in endpoint['StaticMembers']]
+    if endpoint is not None:
+        return [i for i in reader_ids if i not in endpoint.get('ExcludedMembers', [])]
+    return reader_ids
+
+
+def security_group_ids(rds):
+    return set(g['VpcSecurityGroupId'] for g in rds.get('VpcSecurityGroups', []))
+
+
+def unreachable_reason(replica, source_vpc, source_groups):
+    # Proxy is placed for the database, it can only reach replicas in the same VPC that let its security group in.
+    # Members of a cluster are in the VPC of the cluster, which is only known from its instances.
+    vpc_id = replica.get('DBSubnetGroup', {}).get('VpcId')
+    if source_vpc is not None and vpc_id != source_vpc:
+        return f'it is in {vpc_id}, not in {source_vpc} of the database'
+    if source_groups and not security_group_ids(replica) & source_groups:
+        return 'it shares no security group with the database'
+    return None
+
+
+def list_readers(host):
+    # Returns replicas of whatever the host points to, with their endpoints and status, and why the proxy cannot
+    # reach them if it cannot
+    kind, identifier = parse_rds_host(host)
+
+    if kind != 'instance':
+        cluster, endpoint = find_target_cluster(host)
+        replica_ids = cluster_reader_ids(cluster, endpoint)
+        source_vpc, source_groups = None, security_group_ids(cluster)
+    else:
+        instance = describe_instance(identifier)
+        source_vpc, source_groups = instance['DBSubnetGroup']['VpcId'], security_group_ids(instance)
+        if instance.get('DBClusterIdentifier') is not None:
+            # Instance endpoint of an Aurora cluster member
+            replica_ids = cluster_reader_ids(describe_cluster(instance['DBClusterIdentifier']), None)
+        elif instance.get('ReadReplicaSourceDBInstanceIdentifier') is not None:
+            # Already a replica
+            replica_ids = [identifier]
+        else:
+            replica_ids = instance.get('ReadReplicaDBInstanceIdentifiers', [])
+
+    if not replica_ids:
+        return []
+
+    instances = aws_client('rds').describe_db_instances(
+        Filters=[{'Name': 'db-instance-id', 'Values': replica_ids}]
+    )['DBInstances']
+
+    return [{
+        'id': i['DBInstanceIdentifier'],
+        'host': i.get('Endpoint', {}).get('Address'),
+        'status': i['DBInstanceStatus'],
+        'zone': i.get('AvailabilityZone'),
+        'unreachable': unreachable_reason(i, source_vpc, source_groups),
+    } for i in instances]
+
+
+def lookup_readers(host, refresh):
+    entry = load_cache(TOPOLOGY_CACHE).get(host)
+    if not refresh and entry is not None and time.time() - entry.get('timestamp', 0) <= TOPOLOGY_CACHE_TTL:
+        return entry['readers']
+
+    readers = list_readers(host)
+    with cache_lock:
+        cache = load_cache(TOPOLOGY_CACHE)
+        cache[host] = {'readers': readers, 'timestamp': int(time.time())}
+        save_cache(TOPOLOGY_CACHE, cache)
+    return readers
+
+
+def get_connection_counts(instance_ids):
+    # Returns average number of connections of each instance recently, or None when CloudWatch cannot tell
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        response = aws_client('cloudwatch').get_metric_data(
+            MetricDataQueries=[{
+                'Id': f'm{n}',
+                'Label': instance_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/RDS',
+                        'MetricName': 'DatabaseConnections',
+                        'Dimensions': [{'Name': 'DBInstanceIdentifier', 'Value': instance_id}],
+                    },
+                    'Period': 60,
+                    'Stat': 'Average',
+                },
+            } for n, instance_id in enumerate(instance_ids)],
+            StartTime=now - datetime.timedelta(seconds=READER_LOAD_PERIOD),
+            EndTime=now,
+        )
+    except botocore.exceptions.ClientError as e:
+        print(f'Cannot get connection counts from CloudWatch: {e.response["Error"]["Code"]}', file=sys.stderr)
+        return None
+
+    counts = {}
+    for result in response['MetricDataResults']:
+        if result['Values']:
+            counts[result['Label']] = sum(result['Values']) / len(result['Values'])
+    return counts
+
+
+def choose_reader(readers, connections):
+    # Least loaded of the available replicas. Replicas without data points are taken as idle, which new ones are.
+    available = [r for r in readers if r['status'] == 'available' and r['host']]
+    if not available:
+        return None
+
+    if not connections:
+        return random.choice(available)
+
+    least = min(connections.get(r['id'], 0) for r in available)
+    return random.choice([r for r in available if connections.get(r['id'], 0) == least])
+
+
+def pick_reader(host, refresh = False):
+    readers = []
+    for reader in lookup_readers(host, refresh):
+        if reader.get('unreachable'):
+            print(f'Warning: skipping reader {reader["id"]}, {reader["unreachable"]}', file=sys.stderr)
+        else:
+            readers.append(reader)
+
+    available = [r for r in readers if r['status'] == 'available']
+    connections = get_connection_counts([r['id'] for r in available]) if len(available) > 1 else {}
+
+    reader = choose_reader(readers, connections)
+    if reader is None:
+        raise Exception(f'no available read replicas of {host}')
+
+    load = '' if not connections else f', {connections.get(reader["id"], 0):.0f} connections'
+    print(f'Reader: {reader["id"]} in {reader["zone"]}{load}')
+    return reader['host']
+
+
+###########################################
+# Subnet selection
+#
+# Proxy instance needs to talk to SSM (ssm, ssmmessages and ec2messages services) over HTTPS, which it can do either
+# via a default route to a NAT or an internet gateway or via VPC interface endpoints of these services.
+# Everything needed to tell that is fetched for the whole VPC at once, subnets are then evaluated by pure functions
+# working on the describe_* responses.
+
+SSM_ENDPOINT_SERVICES = ['ssm', 'ssmmessages', 'ec2messages']
+
+HTTPS_PORT = 443
+
+# Any port from the range Linux picks local ports from, responses come back to it
+EPHEMERAL_PORT = 49152
+
+INTERNET = '0.0.0.0/0'
+
+
+def fetch_network(vpc_id, subnet_ids):
+    # Four calls for the whole VPC, run concurrently, instead of a call or more per subnet
+    vpc_filter = [{'Name': 'vpc-id', 'Values': [vpc_id]}]
+    calls = {
+        'Subnets': lambda: aws_client('ec2').describe_subnets(SubnetIds=subnet_ids)['Subnets'],
+        'RouteTables': lambda: aws_client('ec2').describe_route_tables(Filters=vpc_filter)['RouteTables'],
+        'NetworkAcls': lambda: aws_client('ec2').describe_network_acls(Filters=vpc_filter)['NetworkAcls'],
+        'VpcEndpoints': lambda: aws_client('ec2').describe_vpc_endpoints(Filters=vpc_filter)['VpcEndpoints'],
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = {key: executor.submit(call) for key, call in calls.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+
+def subnet_route_table(route_tables, subnet_id):
+    # Subnet without a route table of its own uses the main route table of the VPC
+    main = None
+    for rt in route_tables:
+        for association in rt.get('Associations', []):
+            if association.get('SubnetId') == subnet_id:
+                return rt
+            if association.get('Main'):
+                main = rt
+    return main
+
+
+def subnet_network_acl(acls, subnet_id):
+    default = None
+    for acl in acls:
+        for association in acl.get('Associations', []):
+            if association.get('SubnetId') == subnet_id:
+                return acl
+        if acl.get('IsDefault'):
+            default = acl
+    return default
+
+
+def vpc_cidr(route_table):
+    # Every route table has a local route for the VPC range
+    for route in route_table.get('Routes', []):
+        if route.get('GatewayId') == 'local' and route.get('DestinationCidrBlock'):
+            return route['DestinationCidrBlock']
+    return None
+
+
+def internet_route(route_table):
+    # Returns what the default route goes through, None when there is no working one
+    for route in route_table.get('Routes', []):
+        if route.get('DestinationCidrBlock') == INTERNET and route.get('State', 'active') == 'active':
+            return (route.get('NatGatewayId') or route.get('GatewayId') or route.get('TransitGatewayId')
+                    or route.get('NetworkInterfaceId') or route.get('InstanceId') or 'unknown target')
+    return None
+
+
+def ssm_endpoints(endpoints):
+    # SSM services reachable via interface endpoints. Without private DNS the agent would still go for public addresses.
+    services = set()
+    for endpoint in endpoints:
+        service = endpoint.get('ServiceName', '').split('.')[-1]
+        if (service in SSM_ENDPOINT_SERVICES and endpoint.get('VpcEndpointType') == 'Interface'
+                and endpoint.get('State', '').lower() == 'available' and endpoint.get('PrivateDnsEnabled')):
+            services.add(service)
+    return services
+
+
+def acl_allows(acl, egress, port, cidr):
+    # Network ACL rules are evaluated in order of rule numbers, the first rule matching the traffic decides
+    network = ipaddress.ip_network(cidr)
+    entries = sorted((e for e in acl.get('Entries', []) if e.get('Egress') == egress and 'CidrBlock' in e),
+                     key=lambda e: e['RuleNumber'])
+    for entry in entries:
+        if entry['Protocol'] not in ['-1', '6']:
+            continue
+        port_range = entry.get('PortRange')
+        if entry['Protocol'] == '6' and port_range is not None and not port_range['From'] <= port <= port_range['To']:
+            continue
+        if not network.subnet_of(ipaddress.ip_network(entry['CidrBlock'])):
+            continue
+        return entry['RuleAction'] == 'allow'
+    return False
+
+
+def evaluate_subnet(subnet, network):
+    # Returns whether the proxy instance in the subnet would reach SSM and why
+    subnet_id = subnet['SubnetId']
+
+    if subnet.get('State', 'available') != 'available':
+        return False, [f'subnet is {subnet["State"]}']
+
+    route_table = subnet_route_table(network['RouteTables'], subnet_id)
+    if route_table is None:
+        return False, ['no route table']
+
+    reasons = []
+    paths = []
+
+    gateway = internet_route(route_table)
+    if gateway is not None and gateway.startswith('igw-') and not subnet.get('MapPublicIpOnLaunch'):
+        reasons.append(f'default route via {gateway} but instances get no public IP')
+    elif gateway is not None:
+        paths.append((f'default route via {gateway}', INTERNET))
+
+    endpoints = ssm_endpoints(network['VpcEndpoints'])
+    missing = [s for s in SSM_ENDPOINT_SERVICES if s not in endpoints]
+    if not missing:
+        paths.append(('VPC endpoints for ' + ', '.join(SSM_ENDPOINT_SERVICES), vpc_cidr(route_table) or INTERNET))
+
+    if not paths:
+        if endpoints:
+            reasons.append('no VPC endpoints for ' + ', '.join(missing))
+        elif gateway is None:
+            reasons.append('no default route and no SSM VPC endpoints')
+        else:
+            reasons.append('no SSM VPC endpoints')
+        return False, reasons
+
+    acl = subnet_network_acl(network['NetworkAcls'], subnet_id)
+
+    for path, destination in paths:
+        if acl is not None and not acl_allows(acl, True, HTTPS_PORT, destination):
+            reasons.append(f'{path} but network ACL {acl["NetworkAclId"]} blocks outbound HTTPS to {destination}')
+        elif acl is not None and not acl_allows(acl, False, EPHEMERAL_PORT, destination):
+            reasons.append(f'{path} but network ACL {acl["NetworkAclId"]} blocks responses from {destination}')
+        else:
+            reasons.append(path)
+            return True, reasons
+
+    return False, reasons
+
+
+def rank_subnets(subnet_ids, network):
+    # Subnets able to reach SSM come first, otherwise the order of the DB subnet group is kept
+    subnets = {s['SubnetId']: s for s in network['Subnets']}
+    ranking = []
+    for subnet_id in subnet_ids:
+        if subnet_id in subnets:
+            usable, reasons = evaluate_subnet(subnets[subnet_id], network)
+        else:
+            usable, reasons = False, ['subnet not found']
+        ranking.append({'SubnetId': subnet_id, 'Usable': usable, 'Reasons': reasons})
+    return sorted(ranking, key=lambda r: not r['Usable'])
+
+
+def find_subnet(rds):
+    subnet_group = rds['DBSubnetGroup']
+    subnet_ids = [s['SubnetIdentifier'] for s in subnet_group['Subnets'] if s.get('SubnetStatus') == 'Active']
+    if not subnet_ids:
+        raise Exception(f'DB subnet group {subnet_group.get("DBSubnetGroupName")} has no active subnets')
+
+    ranking = rank_subnets(subnet_ids, fetch_network(subnet_group['VpcId'], subnet_ids))
+
+    for r in ranking:
+        print(f'Subnet {r["SubnetId"]}: {"usable" if r["Usable"] else "unusable"} - {"; ".join(r["Reasons"])}')
+
+    if not ranking[0]['Usable']:
+        raise Exception('unable to find a subnet that can reach SSM')
+
+    return ranking[0]['SubnetId']
+
+
+###########################################
+# Proxy image
+#
+# Prebaked image has the inactivity monitor installed and enabled, so that a new proxy instance only needs to tell it
+# which function to report to. It is built by running the same setup script as UserData of the stock image does.
+# Without the monitor config the script shuts the instance down when done, which is when the image is taken.
+
+BUILD_IMAGE_TIMEOUT = 15 * 60
+
+
+def get_root_device_name(image_id):
+    images = aws_client('ec2').describe_images(ImageIds=[image_id]).get('Images')
+    if len(images) != 1:
+        raise Exception(f'Image not found: {image_id}')
+    return images[0]['RootDeviceName']
+
+
+def build_image(base_image_id, subnet_id, group_id):
+    start = time.time()
+
+    user_data = read_file_with_includes('files/setup-inactivity-monitor.sh')
+
+    params = {
+        'ImageId': base_image_id,
+        'InstanceType': 't3a.nano',
+        'MinCount': 1,
+        'MaxCount': 1,
+        'UserData': user_data,
+        'InstanceInitiatedShutdownBehavior': 'stop',
+        'TagSpecifications': [{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': 'Name', 'Value': 'tcp-proxy - image build'}, {'Key': 'Role', 'Value': 'tcp-proxy'}],
+        }],
+    }
+    if subnet_id is not None:
+        params['SubnetId'] = subnet_id
+    if group_id is not None:
+        params['SecurityGroupIds'] = [group_id]
+
+    instance_id = aws_client('ec2').run_instances(**params)['Instances'][0]['InstanceId']
+    print(f'Launched {instance_id} from {base_image_id}')
+
+    try:
+        print('Waiting for setup to finish...')
+        aws_client('ec2').get_waiter('instance_stopped').wait(
+            InstanceIds=[instance_id],
+            WaiterConfig={'Delay': 5, 'MaxAttempts': BUILD_IMAGE_TIMEOUT // 5},
+        )
+
+        name = 'tcp-proxy-' + time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        image_id = aws_client('ec2').create_image(
+            InstanceId=instance_id,
+            Name=name,
+            Description=f'TCP proxy with inactivity monitor, based on {base_image_id}',
+        )['ImageId']
+        print(f'Creating image {image_id} ({name})...')
+
+        aws_client('ec2').get_waiter('image_available').wait(
+            ImageIds=[image_id],
+            WaiterConfig={'Delay': 5, 'MaxAttempts': BUILD_IMAGE_TIMEOUT // 5},
+        )
+    finally:
+        aws_client('ec2').terminate_instances(InstanceIds=[instance_id])
+
+    print(f'Image built in {int(time.time() - start)}s')
+
+    return image_id
+
+
+###########################################
+# Fleet status
+#
+# Every profile/region pair is looked at in its own thread with its own session, so a sweep across many regions
+# takes about as long as the slowest of them.
+
+STATUS_JOBS = 16
+
+# describe_auto_scaling_groups accepts up to 50 names per call
+ASG_BATCH_SIZE = 50
+
+# batch_get_item accepts up to 100 keys per call
+STATE_BATCH_SIZE = 100
+
+
+def list_proxy_stacks(cf):
+    stacks = []
+    for page in cf.get_paginator('describe_stacks').paginate():
+        for stack in page['Stacks']:
+            if stack['StackName'].startswith('tcp-proxy-') and stack['StackStatus'] != 'DELETE_COMPLETE':
+                stacks.append(stack)
+    return stacks
+
+
+def describe_groups(autoscaling, names):
+    groups = {}
+    for i in range(0, len(names), ASG_BATCH_SIZE):
+        batch = names[i:i + ASG_BATCH_SIZE]
+        for page in autoscaling.get_paginator('describe_auto_scaling_groups').paginate(AutoScalingGroupNames=batch):
+            for group in page['AutoScalingGroups']:
+                groups[group['AutoScalingGroupName']] = group
+    return groups
+
+
+def read_state_items(dynamodb, keys):
+    # Takes ASG name of each state table, returns the state item of each table that has one
+    items = {}
+    tables = list(keys.items())
+    for i in range(0, len(tables), STATE_BATCH_SIZE):
+        request = {table: {'Keys': [{'Id': {'S': asg}}]} for table, asg in tables[i:i + STATE_BATCH_SIZE]}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for table, found in response['Responses'].items():
+                for item in found:
+                    items[table] = [{'Key': k, 'Value': v['S']} for k, v in item.items() if 'S' in v]
+            request = response.get('UnprocessedKeys')
+    return items
+
+
+def region_status(profile, region, session):
+    # Returns status of every proxy stack in the region.
+    # ASG carries both the instances and the activity tags, so one call per 50 stacks covers them all.
+    # Stacks keeping their state in DynamoDB have the activity read from their tables, one call per 100 stacks.
+
+    stacks = list_proxy_stacks(session.create_client('cloudformation', region_name=region))
+
+    asg_names = {}
+    state_tables = {}
+    for stack in stacks:
+        name = find_output(stack.get('Outputs') or [], 'AutoScalingGroup')
+        if name is not None:
+            asg_names[stack['StackName']] = name
+            parameters = {p['ParameterKey']: p['ParameterValue'] for p in stack.get('Parameters') or []}
+            if parameters.get('StateStore') == 'dynamodb':
+                state_tables[stack['StackName']] = state_table_name(parameters['StackId'])
+
+    groups = describe_groups(session.create_client('autoscaling', region_name=region), list(asg_names.values())) if asg_names else {}
+
+    state_items = read_state_items(
+        session.create_client('dynamodb', region_name=region),
+        {table: asg_names[stack_name] for stack_name, table in state_tables.items()}
+    ) if state_tables else {}
+
+    result = []
+    for stack in stacks:
+        group = groups.get(asg_names.get(stack['StackName']), {})
+        tags = group.get('Tags')
+        if stack['StackName'] in state_tables:
+            tags = state_items.get(state_tables[stack['StackName']])
+        instances = group.get('Instances', [])
+
+        result.append({
+            'profile': profile,
+            'region': region,
+            'stack': stack['StackName'],
+            'stack_status': stack['StackStatus'],
+            'desired_capacity': group.get('DesiredCapacity'),
+            'instances': [f'{i["InstanceId"]} {i["LifecycleState"]}' for i in instances],
+            'last_activity': find_tag(tags, 'LastActivity'),
+            'last_request': find_tag(tags, 'LastRequest'),
+        })
+
+    return result
+
+
+def fleet_status(targets):
+    # Takes (profile, region, session) of every region to look at, each with a session of its own.
+    # Returns stacks of all of them and errors of the regions that could not be looked at.
+
+    stacks = []
+    errors = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=STATUS_JOBS) as executor:
+        futures = {executor.submit(region_status, *target): target for target in targets}
+        for future, (profile, region, _) in futures.items():
+            try:
+                stacks += future.result()
+            except Exception as e:
+                errors.append({'profile': profile, 'region': region, 'error': str(e)})
+
+    return stacks, errors
+
+
+def print_table(rows, columns):
+    widths = [max([len(c)] + [len(r[i]) for r in rows]) for i, c in enumerate(columns)]
+    for row in [columns] + rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+
+###########################################
+
+# Cache files are loaded, modified and saved again by worker threads too (exec), each such sequence holds this lock
+# so that threads do not lose each other's changes
+cache_lock = threading.RLock()
+
+
+def cache_path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def load_cache(name):
+    try:
+        with open(cache_path(name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(name, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # Write to a temporary file first so concurrent runs never see a half-written cache
+    tmp_name = cache_path(f'.{name}.{os.getpid()}.{threading.get_ident()}')
+    with open(tmp_name, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_name, cache_path(name))
+
+
+def account_from_arn(arn):
+    # arn:aws:secretsmanager:eu-west-1:123456789012:secret:name-AbCdEf
+    parts = arn.split(':')
+    return parts[4] if len(parts) > 4 else None
+
+
+def discovery_cache_key(secret_id):
+    # Secret names are only unique within an account and region. The account is not known without an extra
+    # STS call, so key on the profile and region here and check the account when the secret is read.
+    session = get_session()
+    return f'{session.profile}/{session.get_config_variable("region")}/{secret_id}'
+
+
+def lookup_discovery(key):
+    entry = load_cache('discovery.json').get(key)
+    if entry is None:
+        return None
+
+    if time.time() - entry.get('timestamp', 0) > DISCOVERY_CACHE_TTL:
+        return None
+
+    return entry
+
+
+def is_discovery_valid(entry, account, host):
+    # Secret could have been changed to point to another database since the discovery
+    return entry.get('account') == account and entry.get('host') == host
+
+
+def store_discovery(key, entry):
+    with cache_lock:
+        cache = load_cache('discovery.json')
+        cache[key] = {**entry, 'timestamp': int(time.time())}
+        save_cache('discovery.json', cache)
+
+
+def invalidate_discovery(key):
+    with cache_lock:
+        cache = load_cache('discovery.json')
+        if cache.pop(key, None) is not None:
+            print('Discarding cached discovery results')
+            save_cache('discovery.json', cache)
+
+
+###########################################
+# Shared proxy registry
+#
+# Which proxy shared by the databases of a VPC runs where and which databases it serves, so that a database new
+# to rdscli but in a VPC with a proxy already gets to that proxy without looking for a subnet, and a database
+# the proxy serves already (say, under another secret) does not need to be looked up in RDS at all.
+
+SHARED_PROXY_REGISTRY = 'proxies.json'
+
+# Network interface of an instance takes 5 security groups unless the quota is raised
+MAX_SHARED_PROXY_GROUPS = 5
+
+
+def shared_proxy_key(vpc_id):
+    # Same as discovery results, keyed by where the stacks are deployed to
+    session = get_session()
+    return f'{session.profile}/{session.get_config_variable("region")}/{vpc_id}'
+
+
+def lookup_shared_proxy(vpc_id):
+    entry = load_cache(SHARED_PROXY_REGISTRY).get(shared_proxy_key(vpc_id))
+    if entry is None or entry.get('subnet_id') is None:
+        return None
+    return entry
+
+
+def lookup_shared_database(host):
+    # Returns VPC, security group and shared proxy entry of a database served by a shared proxy, None if there is none
+    prefix = shared_proxy_key('')
+    for key, entry in load_cache(SHARED_PROXY_REGISTRY).items():
+        if key.startswith(prefix) and entry.get('subnet_id') is not None and host in entry.get('databases', {}):
+            return key[len(prefix):], entry['databases'][host], entry
+    return None
+
+
+def register_shared_proxy(vpc_id, stack_id, subnet_id, group_ids):
+    with cache_lock:
+        registry = load_cache(SHARED_PROXY_REGISTRY)
+        entry = registry.setdefault(shared_proxy_key(vpc_id), {'databases': {}})
+        entry.update({
+            'stack_id': stack_id,
+            'subnet_id': subnet_id,
+            'group_ids': group_ids,
+            'timestamp': int(time.time()),
+        })
+        save_cache(SHARED_PROXY_REGISTRY, registry)
+
+
+def register_shared_database(vpc_id, host, group_id):
+    with cache_lock:
+        registry = load_cache(SHARED_PROXY_REGISTRY)
+        entry = registry.setdefault(shared_proxy_key(vpc_id), {'databases': {}})
+        entry['databases'][host] = group_id
+        save_cache(SHARED_PROXY_REGISTRY, registry)
+
+
+###########################################
+# Deployed proxies
+#
+# Outputs of stacks recently found up to date, keyed by a signature of what they were deployed from. While the
+# template and the deploy options stay the same, the next run does not look at the stack at all and goes straight
+# to the control lambda, whose name it knows from the cache.
+
+DEPLOYED_PROXY_CACHE = 'stacks.json'
+DEPLOYED_PROXY_TTL = 60 * 60
+
+
+def deployed_proxy_key(signature):
+    session = get_session()
+    return f'{session.profile}/{session.get_config_variable("region")}/{signature}'
+
+
+def proxy_signature(template, stack_id, group_id, image_id, warm_pool, state_store):
+    return deploy_hash(template, {
+        'StackId': stack_id,
+        'SecurityGroupId': group_id,
+        'ImageId': image_id,
+        'WarmPool': warm_pool,
+        'StateStore': state_store,
+    })
+
+
+def lookup_deployed_proxy(signature):
+    entry = load_cache(DEPLOYED_PROXY_CACHE).get(deployed_proxy_key(signature))
+    if entry is None or time.time() - entry.get('timestamp', 0) > DEPLOYED_PROXY_TTL:
+        return None
+    return entry
+
+
+def store_deployed_proxy(signature, stack_id, outputs):
+    now = int(time.time())
+    with cache_lock:
+        cache = {k: v for k, v in load_cache(DEPLOYED_PROXY_CACHE).items() if now - v.get('timestamp', 0) <= DEPLOYED_PROXY_TTL}
+        cache[deployed_proxy_key(signature)] = {'stack_id': stack_id, 'outputs': outputs, 'timestamp': now}
+        save_cache(DEPLOYED_PROXY_CACHE, cache)
+
+
+def forget_deployed_proxy(signature):
+    with cache_lock:
+        cache = load_cache(DEPLOYED_PROXY_CACHE)
+        if cache.pop(deployed_proxy_key(signature), None) is not None:
+            save_cache(DEPLOYED_PROXY_CACHE, cache)
+
+
+###########################################
+
+def read_file(file_name):
+    with open(file_name) as f:
+        return f.readlines()
+
+
+def resolve_includes(line, included = None):
+    match = re.search(r'^ (.*) \{\{ INCLUDE : (\S+) \}\} (.*) $', line, re.VERBOSE)
+    if not match:
+        return line
+
+    indent = match.group(1)
+    file_name = match.group(2)
+    trailer = match.group(3)
+
+    if trailer != '':
+        raise Exception(f'Invalid use of INCLUDE for {file_name}: must be at the end of line')
+
+    if not re.match(r'^\s*$', indent):
+        raise Exception(f'Invalid use of INCLUDE for {file_name}: only indent whitespace must precede')
+
+    if '/' in file_name:
+        raise Exception(f'Invalid use of INCLUDE for {file_name}: no directory path is allowed')
+
+    file_name = 'files/' + file_name
+    if not os.path.isfile(file_name):
+        raise Exception(f'Invalid use of INCLUDE for {file_name}: file not found')
+
+    return read_file_with_includes(file_name, indent, included)
+
+
+def read_file_with_includes(file_name, indent = '', included = None):
+    if included is not None:
+        included.append(file_name)
+
+    result = ''
+    for i in read_file(file_name):
+        result += resolve_includes(indent + i, included)
+    return result
+
+
+def file_sha256(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def is_file_unchanged(file_name, state):
+    try:
+        if os.stat(file_name).st_mtime == state['mtime']:
+            return True
+        # Touched but possibly not modified (e.g. git checkout), compare the content
+        return file_sha256(file_name) == state['sha256']
+    except FileNotFoundError:
+        return False
+
+
+def render_template(file_name):
+    # Template is rendered from a number of included files on every run, keep the result on disk
+    # and only render it again when any of the files that went into it has changed.
+    key = os.path.abspath(file_name)
+
+    entry = load_cache('templates.json').get(key)
+    if entry is not None and all(is_file_unchanged(f, state) for f, state in entry['files'].items()):
+        return entry['template']
+
+    included = []
+    template = read_file_with_includes(file_name, included=included)
+
+    with cache_lock:
+        cache = load_cache('templates.json')
+        cache[key] = {
+            'files': {
+                os.path.abspath(f): {'mtime': os.stat(f).st_mtime, 'sha256': file_sha256(f)} for f in included
+            },
+            'template': template,
+        }
+        save_cache('templates.json', cache)
+
+    return template
+
+
+###########################################
+
+class StaleDiscoveryError(Exception):
+    pass
+
+
+# History of startup timings, one JSON line per run, trimmed to the latest half when it grows too large
+HISTORY_FILE = 'history.jsonl'
+HISTORY_MAX_BYTES = 1024 * 1024
+
+# Timer of the command being run, AWS calls made from any thread are recorded into it
+current_timer = None
+
+
+class PhaseTimer:
+    # Records when each startup phase and AWS call started and ended, relative to the moment the timer was created
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.api_calls = []
+        self.notes = {}
+        self.lock = threading.Lock()
+
+    def run(self, name, fn, *args):
+        with self.span(name):
+            return fn(*args)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append((name, started - self.start, time.time() - self.start))
+
+    def record_api_call(self, name, started, ended):
+        with self.lock:
+            self.api_calls.append((name, started - self.start, ended - self.start))
+
+    def note(self, key, value):
+        # Remembers what happened along the way, which tells cold, warm and hot starts apart
+        with self.lock:
+            self.notes[key] = value
+
+    def path(self):
+        if self.notes.get('stack') in ['created', 'updated']:
+            return 'cold'
+        if self.notes.get('acquire_polls', 1) > 1:
+            return 'warm'
+        return 'hot'
+
+    def report(self, detailed = False):
+        print(f'Startup phases ({self.path()} start, {time.time() - self.start:.3f}s):')
+        for name, started, ended in sorted(self.phases, key=lambda p: p[1]):
+            print(f'#   {name:<12} {started:7.3f}s - {ended:7.3f}s  ({ended - started:.3f}s)')
+
+        if not detailed:
+            return
+
+        print(f'AWS calls ({len(self.api_calls)}):')
+        for name, started, ended in sorted(self.api_calls, key=lambda p: p[1]):
+            print(f'#   {name:<48} {started:7.3f}s - {ended:7.3f}s  ({(ended - started) * 1000:.0f}ms)')
+
+        counts = {}
+        for name, _, _ in self.api_calls:
+            counts[name] = counts.get(name, 0) + 1
+        for name, count in sorted(counts.items(), key=lambda c: -c[1]):
+            print(f'#   {count:4} {name}')
+
+    def summary(self, command):
+        phases = {}
+        for name, started, ended in self.phases:
+            phases[name] = max(phases.get(name, 0), round(ended - started, 3))
+
+        return {
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'command': command,
+            'path': self.path(),
+            'total': round(time.time() - self.start, 3),
+            'phases': phases,
+            'api_calls': len(self.api_calls),
+        }
+
+    def trace(self):
+        return {
+            'phases': [{'name': n, 'start': round(s, 3), 'end': round(e, 3)} for n, s, e in self.phases],
+            'api_calls': [{'name': n, 'start': round(s, 3), 'end': round(e, 3)} for n, s, e in self.api_calls],
+            'notes': self.notes,
+        }
+
+
+def start_timer():
+    global current_timer
+    current_timer = PhaseTimer()
+    return current_timer
+
+
+def note_timing(key, value):
+    if current_timer is not None:
+        current_timer.note(key, value)
+
+
+def timed(name, fn, *args):
+    # Runs fn as a phase of the current timer, if any
+    if current_timer is None:
+        return fn(*args)
+    return current_timer.run(name, fn, *args)
+
+
+def trace_api_calls(client):
+    # Records every call made with the client into the current timer, retries included
+
+    def before_call(context, **kwargs):
+        context['trace_started'] = time.time()
+
+    def after_call(context, event_name, **kwargs):
+        # Failed calls get no operation model, the operation is the last part of the event name either way
+        started = context.get('trace_started')
+        if current_timer is not None and started is not None:
+            operation = event_name.rsplit('.', 1)[-1]
+            current_timer.record_api_call(f'{client.meta.service_model.service_name}.{operation}', started, time.time())
+
+    client.meta.events.register('before-call.*.*', before_call)
+    client.meta.events.register('after-call.*.*', after_call)
+    client.meta.events.register('after-call-error.*.*', after_call)
+
+    return client
+
+
+def append_history(summary):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(HISTORY_FILE)
+
+    try:
+        if os.path.getsize(path) > HISTORY_MAX_BYTES:
+            with open(path) as f:
+                lines = f.readlines()
+            with open(path + '.tmp', 'w') as f:
+                f.writelines(lines[len(lines) // 2:])
+            os.replace(path + '.tmp', path)
+    except FileNotFoundError:
+        pass
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(summary) + '\n')
+
+
+def load_history():
+    try:
+        with open(cache_path(HISTORY_FILE)) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+
+    history = []
+    for line in lines:
+        try:
+            history.append(json.loads(line))
+        except json.JSONDecodeError:
+            pass
+    return history
+
+
+def finish_timer(timer, args, command):
+    # Called once the tunnel is ready, which is what the startup time is measured to
+    timer.report(args.timings)
+
+    if args.trace is not None:
+        with open(args.trace, 'w') as f:
+            json.dump(dict(timer.summary(command), **timer.trace()), f, indent=2)
+
+    try:
+        append_history(timer.summary(command))
+    except OSError as e:
+        print(f'Warning: cannot record timings: {e}')
+
+
+def percentile(values, p):
+    # Nearest rank percentile
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * p / 100) - 1, 0)]
+
+
+def read_db_secret(secret_id):
+    print(f'Reading RDS credentials: {secret_id}')
+    secret = get_secret(secret_id)
+    db = json.loads(secret['SecretString'])
+
+    # Make sure all the properties we need are present
+    for n in ['host', 'username', 'password']:
+        if db.get(n) is None:
+            raise Exception(f'{secret_id} does not contain {n} attribute')
+
+    db_engine = db.get('engine')
+    if db_engine is not None and db_engine not in ['mysql', 'aurora-mysql', 'aurora']:
+        raise Exception(f'{secret_id} points to non-MySQL RDS')
+
+    print(f'DB host: {db["host"]}')
+
+    return {
+        'account': account_from_arn(secret['ARN']),
+        'host': db['host'],
+        'port': db.get('port', 3306),
+        'username': db['username'],
+        'password': db['password'],
+        'dbname': db.get('dbname', 'mysql'),
+    }
+
+
+def discover_network(db, discovery_key, group_id, subnet_id, shared = False):
+    # Returns host to tunnel to, security group, subnet and VPC of the database.
+    # Shared proxy already running in the VPC is placed well enough for any database there, so its subnet is reused.
+    discovered = {'account': db['account'], 'host': db['host']}
+
+    db_host = db['host']
+    if not is_rds_host(db_host):
+        db_host = timed('dns', resolve_custom_db_host, db_host)
+        if not is_rds_host(db_host):
+            raise Exception(f'resolved {db_host} is still not an RDS hostname')
+
+        discovered['resolved_host'] = db_host
+
+    print(f'Resolved DB host: {db_host}')
+
+    known = lookup_shared_database(db['host']) if shared else None
+
+    if known is not None:
+        vpc_id, known_group_id, proxy = known
+        print(f'Database is served by shared proxy {proxy["stack_id"]}')
+    else:
+        rds = timed('rds lookup', find_target_rds, db_host)
+        vpc_id = rds['DBSubnetGroup']['VpcId']
+
+    discovered['vpc_id'] = vpc_id
+
+    if group_id is None:
+        group_id = known_group_id if known is not None else find_security_group(rds)
+        discovered['group_id'] = group_id
+
+    proxy = lookup_shared_proxy(vpc_id) if shared else None
+
+    if subnet_id is None and proxy is not None:
+        subnet_id = proxy['subnet_id']
+        discovered['subnet_id'] = subnet_id
+        print(f'Using subnet of shared proxy {proxy["stack_id"]}')
+    elif subnet_id is None:
+        subnet_id = timed('subnet', find_subnet, rds)
+        discovered['subnet_id'] = subnet_id
+
+    store_discovery(discovery_key, discovered)
+
+    if shared:
+        register_shared_database(vpc_id, db['host'], group_id)
+
+    return db_host, group_id, subnet_id, vpc_id
+
+
+def control_function_name(stack_id):
+    # Has to match the function name in the template
+    return f'tcp-proxy-control-{stack_id}'
+
+
+def state_table_name(stack_id):
+    # Has to match the table name in the template
+    return f'tcp-proxy-state-{stack_id}'
+
+
+def shared_proxy_groups(parameters):
+    groups = [parameters.get('SecurityGroupId')] + (parameters.get('ExtraSecurityGroupIds') or '').split(',')
+    return [g for g in groups if g]
+
+
+def attach_security_groups(asg_name, group_ids):
+    # Launch template only applies to instances launched later, the ones there already get the groups directly
+    reservations = aws_client('ec2').describe_instances(Filters=[
+        {'Name': 'tag:aws:autoscaling:groupName', 'Values': [asg_name]},
+        {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']},
+    ])['Reservations']
+
+    for reservation in reservations:
+        for instance in reservation['Instances']:
+            print(f'Attaching security groups {", ".join(group_ids)} to {instance["InstanceId"]}')
+            aws_client('ec2').modify_instance_attribute(InstanceId=instance['InstanceId'], Groups=group_ids)
+
+
+def deploy_proxy(group_id, subnet_id, image_id = None, warm_pool = None, state_store = None, vpc_id = None):
+    # Image, warm pool and state store settings that are None stay as the stack has them, so they only need to be given once.
+    # With vpc_id, the proxy is shared by databases of the VPC: it keeps its subnet and gets the group added to its groups.
+    start = time.time()
+    print('Deploying proxy service')
+
+    template = render_template('files/template.yaml')
+
+    stack_id = make_stack_id(group_id, subnet_id, vpc_id)
+    stack_name = f'tcp-proxy-{stack_id}'
+    signature = proxy_signature(template, stack_id, group_id, image_id, warm_pool, state_store)
+
+    # Groups of the shared proxy once deployed, and whether the group is new to it
+    shared_groups = []
+    added_groups = []
+
+    def extra_groups(previous):
+        groups = shared_proxy_groups(previous)
+        if not groups or group_id in groups:
+            shared_groups.extend(groups or [group_id])
+            return previous.get('ExtraSecurityGroupIds')
+        if len(groups) >= MAX_SHARED_PROXY_GROUPS:
+            raise Exception(f'shared proxy {stack_id} already has {len(groups)} security groups, cannot add {group_id}')
+        shared_groups.extend(groups + [group_id])
+        added_groups.append(group_id)
+        return ','.join(groups[1:] + [group_id])
+
+    stack_params = {
+        'StackId': stack_id,
+        'SecurityGroupId': group_id if vpc_id is None else lambda previous: previous.get('SecurityGroupId') or group_id,
+        'ExtraSecurityGroupIds': None if vpc_id is None else extra_groups,
+        'SubnetId': subnet_id if vpc_id is None else lambda previous: previous.get('SubnetId') or subnet_id,
+        'ImageId': None,
+        'PrebakedImage': None,
+        'RootDeviceName': None,
+        'WarmPool': None,
+        'StateStore': state_store,
+    }
+
+    if image_id == 'default':
+        image_id = DEFAULT_PROXY_AMI
+
+    if image_id is not None:
+        stack_params['ImageId'] = image_id
+        stack_params['PrebakedImage'] = 'false' if image_id == DEFAULT_PROXY_AMI else 'true'
+        stack_params['RootDeviceName'] = get_root_device_name(image_id)
+
+    if warm_pool is not None:
+        stack_params['WarmPool'] = 'true' if warm_pool else 'false'
+
+    # Shared proxy does not wait for the update adding a group, the instance gets the group directly
+    stack = ensure_stack(stack_name, template, stack_params, {'ImageId': DEFAULT_PROXY_AMI}, wait_for_update=vpc_id is None)
+
+    if vpc_id is not None:
+        if added_groups:
+            attach_security_groups(find_output(stack.get('Outputs'), 'AutoScalingGroup'), shared_groups)
+        parameters = {p['ParameterKey']: p['ParameterValue'] for p in stack.get('Parameters') or []}
+        register_shared_proxy(vpc_id, stack_id, parameters.get('SubnetId', subnet_id), shared_groups)
+
+    # Stack still being updated is looked at again next time
+    if not added_groups:
+        store_deployed_proxy(signature, stack_id, stack.get('Outputs'))
+
+    print(f'Service deployed in {time.time() - start:.3f}s')
+
+    return stack
+
+
+def activate_proxy(function_name):
+    # Returns what the control lambda knows about the instance, None when there is no such function
+    print('Requesting proxy activation')
+    try:
+        reply = invoke_function(function_name, {'Action': 'activate'})
+    except botocore.exceptions.ClientError as e:
+        # Stack is not deployed yet
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        return None
+
+    # Older control lambdas return nothing
+    return reply if isinstance(reply, dict) else {}
+
+
+def ready_instance(reply):
+    # Instance the control lambda vouches for: in service, healthy and with its monitor checking in
+    if not reply.get('Ready'):
+        return None
+    print(f'Instance {reply["InstanceId"]} is ready, last report at {reply.get("LastReport")}')
+    return reply['InstanceId']
+
+
+def resolve_target(args, secret_id, refresh):
+    # Non-concurrent equivalent of what start_proxy does before deploying, for commands working with many databases.
+    # Returns DB credentials, host to tunnel to, security group, subnet, VPC when the proxy is shared by the VPC
+    # (None otherwise) and the discovery cache key.
+
+    db = read_db_secret(secret_id)
+
+    group_id = args.group_id
+    subnet_id = args.subnet_id
+    shared = args.shared_proxy
+
+    # Shared proxy needs to know the VPC, which only discovery finds out
+    if group_id is not None and subnet_id is not None and not shared:
+        return db, db['host'], group_id, subnet_id, None, None
+
+    discovery_key = discovery_cache_key(secret_id)
+
+    cached = None if refresh else lookup_discovery(discovery_key)
+    if cached is not None and not is_discovery_valid(cached, db['account'], db['host']):
+        invalidate_discovery(discovery_key)
+        cached = None
+
+    # Discovered before VPCs were cached
+    if cached is not None and shared and cached.get('vpc_id') is None:
+        cached = None
+
+    if cached is not None:
+        group_id = group_id or cached.get('group_id')
+        subnet_id = subnet_id or cached.get('subnet_id')
+        vpc_id = cached['vpc_id'] if shared else None
+
+        if group_id is not None and subnet_id is not None:
+            return db, cached.get('resolved_host', db['host']), group_id, subnet_id, vpc_id, discovery_key
+
+    db_host, group_id, subnet_id, vpc_id = discover_network(db, discovery_key, group_id, subnet_id, shared)
+
+    return db, db_host, group_id, subnet_id, vpc_id if shared else None, discovery_key
+
+
+def prepare_proxy(group_id, subnet_id, acquire_timeout, image_id = None, warm_pool = None, state_store = None, vpc_id = None):
+    # Deploys, activates and waits for a proxy, returns its instance ID
+    outputs = deploy_proxy(group_id, subnet_id, image_id, warm_pool, state_store, vpc_id).get('Outputs')
+
+    reply = activate_proxy(find_output(outputs, 'ControlLambdaFunction'))
+    if reply is None:
+        raise Exception('control lambda function not found')
+
+    return ready_instance(reply) or acquire_instance(find_output(outputs, 'AutoScalingGroup'), acquire_timeout)
+
+
+def start_proxy(timer, args, refresh, db = None):
+    # Startup steps are run concurrently as soon as what they need is available:
+    #
+    #   secret -> discovery -> deploy -> acquire
+    #                            \---> activate -/
+    #
+    # When security group and subnet (and VPC for a shared proxy) are known upfront (from command line or cache),
+    # the stack name is known too, so activate does not have to wait for the secret and the discovery. Deploy does not
+    # either when they came from command line, from cache it waits for the secret to confirm them.
+    # When the stack was also recently found up to date, it is not looked at, and when the control lambda
+    # reports an instance ready, it is not waited for either: activation is all it takes.
+
+    secret_id = args.secret_id
+    instance_id = args.instance_id
+    group_id = args.group_id
+    subnet_id = args.subnet_id
+    shared = args.shared_proxy
+    vpc_id = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+
+        if db is None:
+            db_future = executor.submit(timer.run, 'secret', read_db_secret, secret_id)
+        else:
+            db_future = concurrent.futures.Future()
+            db_future.set_result(db)
+
+        if instance_id is not None:
+            # Instance ID was provided, no need to deploy our own
+            db = db_future.result()
+            return db, db['host'], instance_id
+
+        discovery_key = None
+        cached = None
+
+        if group_id is None or subnet_id is None or shared:
+            discovery_key = discovery_cache_key(secret_id)
+            cached = None if refresh else lookup_discovery(discovery_key)
+
+            # Discovered before VPCs were cached
+            if cached is not None and shared and cached.get('vpc_id') is None:
+                cached = None
+
+            if cached is not None:
+                group_id = group_id or cached.get('group_id')
+                subnet_id = subnet_id or cached.get('subnet_id')
+                vpc_id = cached['vpc_id'] if shared else None
+
+        known = group_id and subnet_id and (vpc_id or not shared)
+        known_stack_id = make_stack_id(group_id, subnet_id, vpc_id) if known else None
+
+        deployed = None
+
+        if known_stack_id is not None:
+            print(f'Security group: {group_id}')
+            print(f'Subnet: {subnet_id}')
+
+            signature = proxy_signature(render_template('files/template.yaml'), known_stack_id, group_id,
+                                        args.image_id, args.warm_pool, args.state_store)
+            deployed = None if refresh else lookup_deployed_proxy(signature)
+
+        # Each task waits for what it depends on and only then starts its timed phase
+
+        def discover():
+            db = db_future.result()
+
+            if cached is not None:
+                if not is_discovery_valid(cached, db['account'], db['host']):
+                    invalidate_discovery(discovery_key)
+                    raise StaleDiscoveryError()
+
+            if known_stack_id is not None:
+                db_host = cached.get('resolved_host', db['host']) if cached else db['host']
+                return db_host, group_id, subnet_id, vpc_id
+
+            db_host, discovered_group_id, discovered_subnet_id, discovered_vpc_id = \
+                timer.run('discovery', discover_network, db, discovery_key, group_id, subnet_id, shared)
+            return db_host, discovered_group_id, discovered_subnet_id, discovered_vpc_id if shared else None
+
+        def deploy():
+            if deployed is not None:
+                # Control lambda being there confirms the stack still is
+                if known_activation_future.result() is not None:
+                    note_timing('stack', 'cached')
+                    return {'Outputs': deployed['outputs']}
+                forget_deployed_proxy(signature)
+
+            if known_stack_id is not None:
+                # Cached network settings may belong to another database, the stack is only created or updated
+                # once the secret confirms them. A stale cache fails this straight away instead of deploying.
+                if cached is not None:
+                    network_future.result()
+                return timer.run('deploy', deploy_proxy, group_id, subnet_id, args.image_id, args.warm_pool, args.state_store, vpc_id)
+
+            _, discovered_group_id, discovered_subnet_id, discovered_vpc_id = network_future.result()
+            print(f'Security group: {discovered_group_id}')
+            print(f'Subnet: {discovered_subnet_id}')
+            return timer.run('deploy', deploy_proxy, discovered_group_id, discovered_subnet_id, args.image_id, args.warm_pool,
+                             args.state_store, discovered_vpc_id)
+
+        def activate_known():
+            return timer.run('activate', activate_proxy, control_function_name(known_stack_id))
+
+        def activate():
+            if known_activation_future is not None:
+                reply = known_activation_future.result()
+                if reply is not None:
+                    return reply
+
+            outputs = stack_future.result().get('Outputs')
+            reply = timer.run('activate', activate_proxy, find_output(outputs, 'ControlLambdaFunction'))
+            if reply is None:
+                raise Exception('control lambda function not found')
+            return reply
+
+        def acquire():
+            # Do not wait for an instance if the proxy turns out to be for another database
+            network_future.result()
+
+            instance_id = ready_instance(activate_future.result())
+            if instance_id is not None:
+                return instance_id
+
+            outputs = stack_future.result().get('Outputs')
+
+            start = time.time()
+            instance_id = timer.run('acquire', acquire_instance, find_output(outputs, 'AutoScalingGroup'), args.acquire_timeout)
+            print(f'Instance {instance_id} acquired in {time.time() - start:.3f}s')
+            return instance_id
+
+        network_future = executor.submit(discover)
+        known_activation_future = executor.submit(activate_known) if known_stack_id is not None else None
+        stack_future = executor.submit(deploy)
+        activate_future = executor.submit(activate)
+        instance_future = executor.submit(acquire)
+
+        db_host, _, _, _ = network_future.result()
+
+        try:
+            instance_id = instance_future.result()
+        except Exception:
+            # Failure may well be caused by a wrong guess of subnet or group, make sure next run discovers them again
+            if discovery_key is not None:
+                invalidate_discovery(discovery_key)
+            raise
+
+        return db_future.result(), db_host, instance_id
+
+
+def agent_alias(host, reader):
+    # Agent finds tunnels by the host in the secret. Tunnels to replicas get an alias of their own,
+    # so that sessions meant for the writer never end up on a replica.
+    return f'reader:{host}' if reader else host
+
+
+def acquire_tunnel(timer, args, sessions = 1, on_connection_closed = None):
+    # Returns DB credentials, local port of a tunnel to the database and the tunnel to close when done with it,
+    # which is None when the tunnel belongs to the agent. Tunnel carries up to `sessions` connections at the same time.
+
+    db = None
+
+    # Agent tunnels listen on ports of their own
+    use_agent = not args.no_agent and not args.local_port and agent_request({'op': 'ping'}) is not None
+
+    if use_agent:
+        # With a tunnel to the same database already held by the agent, there is nothing else to do
+        db = timer.run('secret', read_db_secret, args.secret_id)
+        reply = agent_request({'op': 'find', 'host': agent_alias(db['host'], args.reader), 'port': db['port']})
+        # Agent may have exited since the ping
+        if reply and reply.get('port') and sessions == 1:
+            print(f'Using agent tunnel via {reply["instance_id"]}. Local port: {reply["port"]}')
+            return db, reply['port'], None
+
+    try:
+        db, db_host, instance_id = start_proxy(timer, args, args.refresh, db)
+    except StaleDiscoveryError:
+        print('Cached discovery results do not match the secret, discovering again')
+        db, db_host, instance_id = start_proxy(timer, args, True, db)
+
+    if args.reader:
+        db_host = timer.run('reader', pick_reader, db_host, args.refresh)
+
+    if use_agent:
+        request = {'op': 'open', 'instance_id': instance_id, 'host': db_host, 'port': db['port'],
+                   'aliases': [agent_alias(db['host'], args.reader)], 'sessions': sessions}
+        reply = timer.run('tunnel', agent_request, request)
+        if reply is not None:
+            print(f'Agent tunnel ready. Local port: {reply["port"]}')
+            return db, reply['port'], None
+        print('Agent is not running anymore, opening the tunnel directly')
+
+    local_port, tunnel = timer.run('tunnel', open_tunnel, instance_id, db_host, db['port'], args.tunnel, sessions,
+                                   args.local_port or 0, on_connection_closed)
+    return db, local_port, tunnel
+
+
+def add_proxy_arguments(parser, multiple_secrets = False, secret_required = True):
+    if multiple_secrets:
+        parser.add_argument('--secret-id', metavar='VALUE', required=secret_required, action='append',
+                            help='name of a secret in AWS Secrets Manager with RDS credentials, can be repeated')
+    else:
+        parser.add_argument('--secret-id', metavar='VALUE', required=secret_required,
+                            help='name of a secret in AWS Secrets Manager with RDS credentials')
+    parser.add_argument('--instance-id', metavar='VALUE',
+                        help='optional ID of an EC2 instance that will be used for tunnelling trafffic.')
+    parser.add_argument('--group-id', metavar='VALUE',
+                        help='ID of a security group for proxy EC2 instance. When omitted, try to infer it from RDS')
+    parser.add_argument('--subnet-id', metavar='VALUE',
+                        help='ID of a subnet to place proxy EC2 instance into. When omitted, try to infer it from RDS')
+    parser.add_argument('--refresh', action='store_true',
+                        help='ignore cached discovery results and look up security group and subnet again')
+    parser.add_argument('--acquire-timeout', metavar='SECONDS', type=int, default=DEFAULT_ACQUIRE_TIMEOUT,
+                        help=f'how long to wait for proxy instance to become ready, default is {DEFAULT_ACQUIRE_TIMEOUT}s')
+    parser.add_argument('--image-id', metavar='VALUE',
+                        help='AMI for proxy instance built with build-image command, or "default" for the stock image. '
+                             'Once given, the proxy stack keeps using it')
+    parser.add_argument('--warm-pool', action=argparse.BooleanOptionalAction,
+                        help='keep a hibernated proxy instance in a warm pool for fast reactivation (runs on demand instead of spot). '
+                             'Once given, the proxy stack keeps the setting')
+    parser.add_argument('--state-store', choices=['asg', 'dynamodb'],
+                        help='where proxy control lambda keeps its state: ASG tags (default) or a DynamoDB table, '
+                             'which avoids Auto Scaling API throttling with many proxies in one account. '
+                             'Once given, the proxy stack keeps the setting')
+    parser.add_argument('--tunnel', choices=['auto', 'native', 'cli'], default='auto',
+                        help='how to open SSM tunnel: natively (needs websockets package) or with `aws ssm start-session`. '
+                             'Default is native when websockets package is installed')
+    parser.add_argument('--no-agent', action='store_true',
+                        help='do not use tunnels of a running agent, open a new one')
+    parser.add_argument('--shared-proxy', action='store_true',
+                        help='use one proxy for all databases of a VPC, with security groups of all of them, '
+                             'instead of a proxy for every security group and subnet')
+    parser.add_argument('--reader', action='store_true',
+                        help='connect to the least loaded available read replica (Aurora reader or RDS read replica) '
+                             'instead of the host in the secret')
+    parser.add_argument('--local-port', metavar='PORT', type=int,
+                        help='local port for the tunnel to listen on, a random free port by default. '
+                             'Tunnels of the agent are not used then')
+    parser.add_argument('--timings', action='store_true',
+                        help='print timings of every AWS call and call counts once the tunnel is ready')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write startup phases and AWS calls with their timings into a JSON file')
+
+
+###########################################
+
+def connect_main(argv):
+
+    parser = argparse.ArgumentParser(
+        description='Command-line client for RDS'
+    )
+
+    add_proxy_arguments(parser)
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='additional arguments to pass to client')
+
+    args = parser.parse_args(argv)
+
+    mysql_args = args.args
+    if mysql_args and mysql_args[0] == '--':
+        mysql_args = mysql_args[1:]
+
+    timer = start_timer()
+
+    db, local_port, tunnel = acquire_tunnel(timer, args)
+
+    finish_timer(timer, args, 'connect')
+
+    mysql_cli(local_port, db['username'], db['password'], db['dbname'], mysql_args)
+
+    if tunnel is not None:
+        close_tunnel(tunnel)
+
+
+DEFAULT_FORWARD_SESSIONS = 4
+
+
+def forward_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} forward',
+        description='Keep a tunnel to the database open for other clients to connect to'
+    )
+
+    add_proxy_arguments(parser)
+    parser.add_argument('--sessions', metavar='N', type=int, default=DEFAULT_FORWARD_SESSIONS,
+                        help=f'number of SSM sessions, which is how many connections are forwarded at the same time, '
+                             f'default is {DEFAULT_FORWARD_SESSIONS}. Native tunnel only')
+
+    args = parser.parse_args(argv)
+
+    def connection_closed(stats):
+        print(f'Connection closed - {format_connection_stats(stats)}')
+
+    timer = start_timer()
+    db, local_port, tunnel = acquire_tunnel(timer, args, args.sessions, connection_closed)
+    finish_timer(timer, args, 'forward')
+
+    print(f'Forwarding 127.0.0.1:{local_port} to {db["host"]}:{db["port"]}, user {db["username"]}')
+
+    if tunnel is None:
+        print('Tunnel is held by the agent, it stays open until the agent closes it')
+        return
+
+    print('Press Ctrl-C to stop')
+
+    try:
+        while True:
+            time.sleep(1)
+            if not isinstance(tunnel, NativeTunnel) and tunnel.poll() is not None:
+                raise Exception('session-manager-plugin exited, tunnel is closed')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if isinstance(tunnel, NativeTunnel):
+            totals = tunnel.stats()['totals']
+            print(f'Forwarded {totals["connections"]} connections, {totals["sent"]} bytes sent, '
+                  f'{totals["received"]} received, {totals["reconnects"]} reconnects')
+        close_tunnel(tunnel)
+
+
+def add_script_arguments(parser):
+    script_group = parser.add_mutually_exclusive_group(required=True)
+    script_group.add_argument('-e', '--execute', metavar='SQL',
+                              help='SQL statements to execute')
+    script_group.add_argument('--file', metavar='PATH',
+                              help='file with SQL statements to execute')
+
+
+def read_script(args):
+    if args.file is not None:
+        with open(args.file, 'rb') as f:
+            return f.read()
+    return args.execute.encode()
+
+
+DEFAULT_EXEC_JOBS = 8
+
+
+def exec_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} exec',
+        description='Run SQL against multiple databases in parallel'
+    )
+
+    add_proxy_arguments(parser, multiple_secrets=True)
+
+    add_script_arguments(parser)
+
+    parser.add_argument('--jobs', metavar='N', type=int, default=DEFAULT_EXEC_JOBS,
+                        help=f'maximum number of databases to work on at the same time, default is {DEFAULT_EXEC_JOBS}')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='additional arguments to pass to client')
+
+    args = parser.parse_args(argv)
+
+    mysql_args = args.args
+    if mysql_args and mysql_args[0] == '--':
+        mysql_args = mysql_args[1:]
+
+    script = read_script(args)
+
+    secret_ids = list(dict.fromkeys(args.secret_id))
+
+    use_agent = not args.no_agent and agent_request({'op': 'ping'}) is not None
+
+    # Databases behind the same proxy share it, so every proxy is prepared once by whoever needs it first.
+    # Proxy shared by a VPC is prepared once for every security group it gets, one after another.
+    proxies = {}
+    proxies_lock = threading.Lock()
+    stack_locks = {}
+
+    def proxy_instance(group_id, subnet_id, vpc_id):
+        stack_id = make_stack_id(group_id, subnet_id, vpc_id)
+        key = (stack_id, group_id if vpc_id else None)
+
+        with proxies_lock:
+            future = proxies.get(key)
+            owner = future is None
+            if owner:
+                future = proxies[key] = concurrent.futures.Future()
+            stack_lock = stack_locks.setdefault(stack_id, threading.Lock())
+
+        if owner:
+            try:
+                with stack_lock:
+                    future.set_result(prepare_proxy(group_id, subnet_id, args.acquire_timeout, args.image_id, args.warm_pool,
+                                                    args.state_store, vpc_id))
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+    def run(secret_id):
+        start = time.time()
+
+        db, db_host, group_id, subnet_id, vpc_id, discovery_key = resolve_target(args, secret_id, args.refresh)
+
+        if args.reader:
+            db_host = pick_reader(db_host, args.refresh)
+
+        instance_id = args.instance_id
+        if instance_id is None:
+            try:
+                instance_id = proxy_instance(group_id, subnet_id, vpc_id)
+            except Exception:
+                if discovery_key is not None:
+                    invalidate_discovery(discovery_key)
+                raise
+
+        tunnel = None
+        reply = None
+        if use_agent:
+            request = {'op': 'open', 'instance_id': instance_id, 'host': db_host, 'port': db['port'],
+                       'aliases': [agent_alias(db['host'], args.reader)]}
+            reply = agent_request(request)
+
+        # Agent may have exited since the ping
+        if reply is not None:
+            local_port = reply['port']
+        else:
+            local_port, tunnel = open_tunnel(instance_id, db_host, db['port'], args.tunnel)
+
+        try:
+            code, output = mysql_batch(local_port, db['username'], db['password'], db['dbname'], mysql_args, script)
+        finally:
+            if tunnel is not None:
+                close_tunnel(tunnel)
+
+        return code, output, time.time() - start
+
+    failed = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(run, secret_id): secret_id for secret_id in secret_ids}
+
+        # Report every database as soon as it is done
+        for future in concurrent.futures.as_completed(futures):
+            secret_id = futures[future]
+            try:
+                code, output, elapsed = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'==> {secret_id}: failed: {e}', flush=True)
+                continue
+
+            if code != 0:
+                failed += 1
+
+            print(f'==> {secret_id}: exit code {code} in {elapsed:.1f}s', flush=True)
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+
+    print(f'{len(secret_ids) - failed} of {len(secret_ids)} databases succeeded')
+
+    if failed:
+        sys.exit(1)
+
+
+def prewarm_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} prewarm',
+        description='Bring proxies up ahead of use without waiting for them'
+    )
+
+    add_proxy_arguments(parser, multiple_secrets=True)
+
+    args = parser.parse_args(argv)
+
+    # Databases behind the same proxy share it, so every proxy is prewarmed once.
+    # Proxy shared by a VPC is deployed for every security group it is to get.
+    stacks = {}
+    for secret_id in dict.fromkeys(args.secret_id):
+        _, _, group_id, subnet_id, vpc_id, _ = resolve_target(args, secret_id, args.refresh)
+        placements = stacks.setdefault(make_stack_id(group_id, subnet_id, vpc_id), {})
+        placements.setdefault(group_id if vpc_id else None, (group_id, subnet_id, vpc_id))
+
+    for stack_id, placements in stacks.items():
+        for group_id, subnet_id, vpc_id in placements.values():
+            outputs = deploy_proxy(group_id, subnet_id, args.image_id, args.warm_pool, args.state_store, vpc_id).get('Outputs')
+        print(f'Prewarming proxy {stack_id}')
+        invoke_function(find_output(outputs, 'ControlLambdaFunction'), {'Action': 'activate', 'Prewarm': True})
+
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} query',
+        description='Run a query and stream its results to stdout'
+    )
+
+    add_proxy_arguments(parser)
+    add_script_arguments(parser)
+
+    parser.add_argument('--format', choices=list(QUERY_WRITERS), default='jsonl',
+                        help='output format, default is jsonl')
+    parser.add_argument('--batch-size', metavar='N', type=int, default=DEFAULT_QUERY_BATCH_SIZE,
+                        help=f'number of rows fetched and written at once, default is {DEFAULT_QUERY_BATCH_SIZE}')
+    parser.add_argument('--param', metavar='VALUE', action='append', default=[],
+                        help='value for a %%s placeholder in the query, can be repeated')
+    parser.add_argument('--database', metavar='NAME',
+                        help='database to use instead of the one in the secret')
+    parser.add_argument('--cache-ttl', metavar='SECONDS', type=int,
+                        help='answer from results of the same SELECT cached locally within that many seconds, '
+                             'run it and cache its results otherwise')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=DEFAULT_QUERY_CACHE_SIZE,
+                        help=f'space cached results may take, least recently used are evicted beyond it, '
+                             f'default is {DEFAULT_QUERY_CACHE_SIZE}MB')
+
+    args = parser.parse_args(argv)
+
+    sql = read_script(args).decode()
+
+    cache = None
+    if args.cache_ttl:
+        check_cacheable(sql)
+
+        key = query_cache_key(args.secret_id, args.database, args.reader, sql, args.param)
+        entry = lookup_query_cache(key, args.cache_ttl)
+        if entry is not None:
+            replay_query(key, entry, args.format, sys.stdout.buffer)
+            return
+
+    # Results go to stdout, so everything else goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        timer = start_timer()
+        db, local_port, tunnel = acquire_tunnel(timer, args)
+        finish_timer(timer, args, 'query')
+
+    try:
+        connection = connect_mysql(local_port, db, args.database)
+        try:
+            if args.cache_ttl:
+                cache = QueryCacheWriter(key, args.cache_ttl, args.cache_size * 1024 * 1024)
+            run_query(connection, sql, args.param, args.format, args.batch_size, sys.stdout.buffer, cache=cache)
+        finally:
+            connection.close()
+    finally:
+        if tunnel is not None:
+            with contextlib.redirect_stdout(sys.stderr):
+                close_tunnel(tunnel)
+
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} bench',
+        description='Measure connect time, round trip latency and throughput through the tunnel, print them as JSON'
+    )
+
+    add_proxy_arguments(parser, secret_required=False)
+
+    parser.add_argument('--offline', action='store_true',
+                        help='measure against a local MySQL protocol stand-in instead of the database, without AWS')
+    parser.add_argument('--label', metavar='TEXT',
+                        help='label to put into the results, e.g. instance type of the proxy')
+    parser.add_argument('--database', metavar='NAME',
+                        help='database to use instead of the one in the secret')
+    parser.add_argument('--connects', metavar='N', type=int, default=DEFAULT_BENCH_CONNECTS,
+                        help=f'number of connections to time, default is {DEFAULT_BENCH_CONNECTS}')
+    parser.add_argument('--pings', metavar='N', type=int, default=DEFAULT_BENCH_PINGS,
+                        help=f'number of SELECT 1 round trips to time, default is {DEFAULT_BENCH_PINGS}')
+    parser.add_argument('--rows', metavar='N', type=int, default=DEFAULT_BENCH_ROWS,
+                        help=f'rows in the result transferred to measure throughput (about 200 bytes each), '
+                             f'default is {DEFAULT_BENCH_ROWS}')
+    parser.add_argument('--runs', metavar='N', type=int, default=DEFAULT_BENCH_RUNS,
+                        help=f'times the result is transferred with and without compression, default is {DEFAULT_BENCH_RUNS}')
+
+    args = parser.parse_args(argv)
+
+    if args.secret_id is None and not args.offline:
+        parser.error('--secret-id is required unless --offline is given')
+
+    standin = None
+    tunnel = None
+
+    # Results go to stdout, so everything else goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            if args.offline:
+                standin = MysqlStandIn()
+                local_port = standin.start()
+                db = {'username': 'bench', 'password': 'bench', 'dbname': 'bench'}
+                target = {'offline': True}
+            else:
+                timer = start_timer()
+                db, local_port, tunnel = acquire_tunnel(timer, args)
+                finish_timer(timer, args, 'bench')
+                target = {'host': db['host'], 'reader': args.reader, 'tunnel': args.tunnel, 'agent': tunnel is None}
+
+            results = run_bench(local_port, db, args.database, args.connects, args.pings, args.rows, args.runs)
+        finally:
+            if tunnel is not None:
+                close_tunnel(tunnel)
+            if standin is not None:
+                standin.close()
+
+    print(json.dumps({'label': args.label, 'target': target, **results}, indent=2))
+
+
+def connect_parallel(args, jobs, command):
+    # Opens a tunnel and `jobs` connections through it
+    timer = start_timer()
+    db, local_port, tunnel = acquire_tunnel(timer, args, jobs)
+    finish_timer(timer, args, command)
+
+    connections = []
+    try:
+        for _ in range(jobs):
+            connections.append(connect_mysql(local_port, db, args.database))
+        return db, connections, tunnel
+    except Exception:
+        for connection in connections:
+            connection.close()
+        if tunnel is not None:
+            close_tunnel(tunnel)
+        raise
+
+
+def dump_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} dump',
+        description='Dump database tables in parallel into a directory'
+    )
+
+    add_proxy_arguments(parser)
+
+    parser.add_argument('--output', metavar='DIR', required=True,
+                        help='directory to write dump files into')
+    parser.add_argument('--database', metavar='NAME',
+                        help='database to dump instead of the one in the secret')
+    parser.add_argument('--table', metavar='NAME', action='append', default=[],
+                        help='table to dump, can be repeated. All tables are dumped when omitted')
+    parser.add_argument('--jobs', metavar='N', type=int, default=DEFAULT_DUMP_JOBS,
+                        help=f'number of parallel connections, default is {DEFAULT_DUMP_JOBS}')
+    parser.add_argument('--chunk-rows', metavar='N', type=int, default=DEFAULT_DUMP_CHUNK_ROWS,
+                        help=f'approximate number of rows per file, default is {DEFAULT_DUMP_CHUNK_ROWS}')
+    parser.add_argument('--compress', choices=list(COMPRESSION_EXTENSIONS), default='gzip',
+                        help='compression of data files, default is gzip')
+
+    args = parser.parse_args(argv)
+
+    # One more connection to plan the work with, it holds the table lock while the others start their snapshots
+    db, connections, tunnel = connect_parallel(args, args.jobs + 1, 'dump')
+
+    try:
+        dump_database(connections, args.output, args.table, args.chunk_rows, args.compress)
+    finally:
+        for connection in connections:
+            connection.close()
+        if tunnel is not None:
+            close_tunnel(tunnel)
+
+
+def restore_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} restore',
+        description='Restore database tables in parallel from a directory created with dump command'
+    )
+
+    add_proxy_arguments(parser)
+
+    parser.add_argument('--input', metavar='DIR', required=True,
+                        help='directory with dump files')
+    parser.add_argument('--database', metavar='NAME',
+                        help='database to restore into instead of the one in the secret')
+    parser.add_argument('--table', metavar='NAME', action='append', default=[],
+                        help='table to restore, can be repeated. All tables are restored when omitted')
+    parser.add_argument('--jobs', metavar='N', type=int, default=DEFAULT_DUMP_JOBS,
+                        help=f'number of parallel connections, default is {DEFAULT_DUMP_JOBS}')
+    parser.add_argument('--drop-existing', action='store_true',
+                        help='drop tables that already exist before restoring them')
+
+    args = parser.parse_args(argv)
+
+    db, connections, tunnel = connect_parallel(args, args.jobs, 'restore')
+
+    try:
+        restore_database(connections, args.input, args.table, args.drop_existing)
+    finally:
+        for connection in connections:
+            connection.close()
+        if tunnel is not None:
+            close_tunnel(tunnel)
+
+
+def build_image_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} build-image',
+        description='Build an AMI for proxy instances with the inactivity monitor preinstalled'
+    )
+
+    parser.add_argument('--base-image-id', metavar='VALUE', default=DEFAULT_PROXY_AMI,
+                        help=f'AMI to build on, default is {DEFAULT_PROXY_AMI}')
+    parser.add_argument('--subnet-id', metavar='VALUE',
+                        help='subnet to launch the build instance in, default VPC is used when omitted')
+    parser.add_argument('--group-id', metavar='VALUE',
+                        help='security group for the build instance')
+
+    args = parser.parse_args(argv)
+
+    image_id = build_image(args.base_image_id, args.subnet_id, args.group_id)
+
+    print(f'Use it with --image-id={image_id}')
+
+
+def status_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} status',
+        description='List proxy stacks across regions and profiles'
+    )
+
+    parser.add_argument('--profile', metavar='NAME', action='append', default=[],
+                        help='AWS profile to look at, can be repeated. Default is the current profile')
+    parser.add_argument('--all-profiles', action='store_true',
+                        help='look at all configured profiles')
+    parser.add_argument('--region', metavar='NAME', action='append', default=[],
+                        help='region to look at, can be repeated. Default is the region of each profile')
+    parser.add_argument('--all-regions', action='store_true',
+                        help='look at all regions enabled in the account')
+    parser.add_argument('--json', action='store_true',
+                        help='print JSON instead of a table')
+
+    args = parser.parse_args(argv)
+
+    profiles = args.profile or [None]
+    if args.all_profiles:
+        profiles = new_session().available_profiles
+
+    # Every region gets a session of its own, as clients of one session cannot be created from different threads
+    targets = []
+    for profile in profiles:
+        session = new_session(profile)
+        regions = args.region or [session.get_config_variable('region')]
+        if args.all_regions:
+            regions = [r['RegionName'] for r in session.create_client('ec2').describe_regions()['Regions']]
+        for region in regions:
+            targets.append((profile, region, new_session(profile)))
+
+    start = time.time()
+    stacks, errors = fleet_status(targets)
+
+    if args.json:
+        json.dump({'stacks': stacks, 'errors': errors}, sys.stdout, indent=2)
+        print()
+    else:
+        columns = ['PROFILE', 'REGION', 'STACK', 'STATUS', 'CAPACITY', 'INSTANCES', 'LAST ACTIVITY', 'LAST REQUEST']
+        rows = [[
+            s['profile'] or '-',
+            s['region'] or '-',
+            s['stack'],
+            s['stack_status'],
+            str(s['desired_capacity']) if s['desired_capacity'] is not None else '-',
+            ', '.join(s['instances']) or '-',
+            s['last_activity'] or '-',
+            s['last_request'] or '-',
+        ] for s in stacks]
+        print_table(rows, columns)
+
+        for e in errors:
+            print(f'{e["profile"] or "-"}/{e["region"]}: {e["error"]}', file=sys.stderr)
+
+        print(f'{len(stacks)} stacks in {len(targets)} regions looked at in {time.time() - start:.1f}s', file=sys.stderr)
+
+    if errors:
+        sys.exit(1)
+
+
+def stats_main(argv):
+    parser = argparse.ArgumentParser(
+        prog=f'{sys.argv[0]} stats',
+        description='Show startup time percentiles of recent runs, per phase and start path'
+    )
+
+    parser.add_argument('--command', metavar='NAME',
+                        help='only include runs of this command (connect, query, dump, restore)')
+    parser.add_argument('--last', metavar='N', type=int,
+                        help='only include the last N runs')
+
+    args = parser.parse_args(argv)
+
+    history = load_history()
+    if args.command is not None:
+        history = [h for h in history if h.get('command') == args.command]
+    if args.last is not None:
+        history = history[-args.last:]
+
+    if not history:
+        print('No runs recorded yet')
+        return
+
+    rows = []
+    for path in ['cold', 'warm', 'hot']:
+        runs = [h for h in history if h.get('path') == path]
+        if not runs:
+            continue
+
+        phases = {'total': [h['total'] for h in runs]}
+        for h in runs:
+            for name, duration in h.get('phases', {}).items():
+                phases.setdefault(name, []).append(duration)
+        phases['api calls'] = [h.get('api_calls', 0) for h in runs]
+
+        for name, values in phases.items():
+            fmt = '{:.0f}' if name == 'api calls' else '{:.3f}s'
+            rows.append([path, name, str(len(values)), fmt.format(percentile(values, 50)), fmt.format(percentile(values, 95))])
+
+    print_table(rows, ['PATH', 'PHASE', 'RUNS', 'P50', 'P95'])
+
+
+COMMANDS = {
+    'agent': agent_main,
+    'forward': forward_main,
+    'exec': exec_main,
+    'query': query_main,
+    'dump': dump_main,
+    'restore': restore_main,
+    'build-image': build_image_main,
+    'prewarm': prewarm_main,
+    'status': status_main,
+    'stats': stats_main,
+    'bench': bench_main,
+}
+
+
+def main():
+    # Without a command, connect to the database as always
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        connect_main(sys.argv[1:])
 
 
-main()
+if __name__ == '__main__':
+    main()
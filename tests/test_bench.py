@@ -0,0 +1,65 @@
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+DB = {'username': 'user', 'password': 'secret', 'dbname': 'test'}
+
+
+class MysqlStandInTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.standin = rdscli.MysqlStandIn()
+        cls.port = cls.standin.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.standin.close()
+
+    def connect(self):
+        connection = rdscli.connect_mysql(self.port, DB)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_select_1(self):
+        with self.connect().cursor() as cursor:
+            for _ in range(3):
+                cursor.execute('SELECT 1')
+                self.assertEqual(cursor.fetchall(), (('1',),))
+
+    def test_bench_query_returns_generated_rows(self):
+        with self.connect().cursor() as cursor:
+            cursor.execute(rdscli.bench_query(1000))
+            self.assertEqual([c[0] for c in cursor.description], ['n', 'hash', 'text'])
+            self.assertEqual(list(cursor.fetchall()), list(rdscli.bench_rows(1000)))
+
+    def test_large_result_streams_over_many_frames(self):
+        rows = 20000
+        nbytes, first, total = rdscli.bench_transfer_pymysql(self.connect(), rdscli.bench_query(rows))
+
+        expected = sum(len('\t'.join(row).encode()) + 1 for row in rdscli.bench_rows(rows))
+        self.assertEqual(nbytes, expected)
+        self.assertGreater(nbytes, rdscli.STANDIN_FRAME_SIZE * 10)
+        self.assertLessEqual(first, total)
+
+    def test_run_bench_without_mysql_client(self):
+        with mock.patch.object(rdscli.shutil, 'which', return_value=None), \
+                mock.patch('sys.stdout', new_callable=io.StringIO):
+            results = rdscli.run_bench(self.port, DB, None, connects=2, pings=5, rows=500, runs=2)
+
+        self.assertEqual(results['transfer']['client'], 'pymysql')
+        self.assertEqual(results['transfer']['plain']['bytes'],
+                         sum(len('\t'.join(row).encode()) + 1 for row in rdscli.bench_rows(500)))
+        self.assertIn('skipped', results['transfer']['compressed'])
+        self.assertLessEqual(results['ping_ms']['min'], results['ping_ms']['max'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import os
+import sys
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'files'))
+
+import control_lambda as cl
+
+
+NOW = datetime(2024, 3, 4, 12, 30, tzinfo=timezone.utc)
+
+
+def ago(seconds):
+    return cl.format_utc(NOW - timedelta(seconds=seconds))
+
+
+class RecordSessionTest(unittest.TestCase):
+
+    def test_appends_new_hour(self):
+        self.assertEqual(cl.record_session([1, 2], 3), [1, 2, 3])
+
+    def test_keeps_known_hour_once(self):
+        self.assertEqual(cl.record_session([1, 2], 2), [1, 2])
+
+    def test_drops_oldest_when_full(self):
+        history = list(range(cl.HISTORY_LIMIT))
+        result = cl.record_session(history, 1000)
+        self.assertEqual(len(result), cl.HISTORY_LIMIT)
+        self.assertEqual(result[0], 1)
+        self.assertEqual(result[-1], 1000)
+
+    def test_history_survives_encoding(self):
+        history = [cl.hour_number(NOW) - 1, cl.hour_number(NOW)]
+        self.assertEqual(cl.decode_history(cl.encode_history(history)), history)
+
+
+class CleanupIfIdleTest(unittest.TestCase):
+
+    def test_nothing_to_clean_up(self):
+        store = cl.MemoryStore(capacity=0)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 0)
+        self.assertEqual(store.changed, {})
+
+    def test_new_stack_is_kept(self):
+        store = cl.MemoryStore(capacity=1)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 1)
+        self.assertEqual(store.get('FirstCleanup'), cl.format_utc(NOW))
+
+    def test_recent_activity_is_kept(self):
+        store = cl.MemoryStore({'LastActivity': ago(60)}, capacity=1)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 1)
+
+    def test_idle_instance_is_released(self):
+        store = cl.MemoryStore({'LastActivity': ago(3600), 'LastRequest': ago(3600), 'ReportingInstance': 'i-1'},
+                               capacity=1)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 0)
+        self.assertEqual(store.get('ReportingInstance'), '')
+
+    def test_open_session_gets_more_time(self):
+        values = {'LastActivity': ago(30 * 60), 'LastSession': ago(60)}
+        store = cl.MemoryStore(values, capacity=1)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 1)
+
+        values['LastActivity'] = ago(2 * 3600)
+        store = cl.MemoryStore(values, capacity=1)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 0)
+
+    def test_expected_demand_keeps_instance(self):
+        hour = cl.hour_number(NOW)
+        history = [hour - week * cl.HOURS_IN_WEEK for week in range(1, cl.PREDICTION_MIN_WEEKS + 1)]
+        store = cl.MemoryStore({cl.HISTORY_TAG: cl.encode_history(history), 'LastActivity': ago(3600)}, capacity=1)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 1)
+
+    def test_expected_demand_prewarms(self):
+        hour = cl.hour_number(NOW + timedelta(seconds=cl.PREWARM_LEAD_SECONDS))
+        history = [hour - week * cl.HOURS_IN_WEEK for week in range(1, cl.PREDICTION_MIN_WEEKS + 1)]
+        store = cl.MemoryStore({cl.HISTORY_TAG: cl.encode_history(history)}, capacity=0)
+        cl.cleanup_if_idle(store, NOW)
+        self.assertEqual(store.capacity, 1)
+
+
+class HandleTest(unittest.TestCase):
+
+    def instance(self, instance_id = 'i-1', state = 'InService', health = 'Healthy'):
+        return {'InstanceId': instance_id, 'LifecycleState': state, 'HealthStatus': health}
+
+    def test_activate_starts_instance(self):
+        store = cl.MemoryStore(capacity=0)
+        response = cl.handle(store, {'Action': 'activate'}, NOW)
+        self.assertEqual(store.capacity, 1)
+        self.assertEqual(response, {'Ready': False})
+        self.assertEqual(store.get('LastRequest'), cl.format_utc(NOW))
+        self.assertEqual(cl.decode_history(store.get(cl.HISTORY_TAG)), [cl.hour_number(NOW)])
+        self.assertEqual(len(store.saved), 1)
+
+    def test_prewarm_is_not_a_session(self):
+        store = cl.MemoryStore(capacity=0)
+        cl.handle(store, {'Action': 'activate', 'Prewarm': True}, NOW)
+        self.assertIsNone(store.get(cl.HISTORY_TAG))
+
+    def test_activate_returns_ready_instance(self):
+        store = cl.MemoryStore({'ReportingInstance': 'i-1', 'ReportingSince': ago(600), 'LastReport': ago(60)},
+                               capacity=1, instances=[self.instance()])
+        response = cl.handle(store, {'Action': 'activate'}, NOW)
+        self.assertTrue(response['Ready'])
+        self.assertEqual(response['InstanceId'], 'i-1')
+
+    def test_activate_waits_for_fresh_instance(self):
+        store = cl.MemoryStore({'ReportingInstance': 'i-1', 'ReportingSince': ago(10), 'LastReport': ago(10)},
+                               capacity=1, instances=[self.instance()])
+        response = cl.handle(store, {'Action': 'activate'}, NOW)
+        self.assertFalse(response['Ready'])
+
+    def test_tag_store_report_time_is_coarse(self):
+        store = cl.MemoryStore(capacity=1)
+        store.last_report_coalesce_seconds = cl.AsgTagStore.last_report_coalesce_seconds
+        report = {'Action': 'report', 'ActiveSessions': 1, 'InstanceId': 'i-1'}
+
+        cl.handle(store, report, NOW - timedelta(seconds=1200))
+        cl.handle(store, report, NOW - timedelta(seconds=900))
+        cl.handle(store, report, NOW - timedelta(seconds=600))
+        self.assertEqual([c for c in store.saved[1:] if 'LastReport' in c], [])
+        self.assertEqual(store.get('LastReport'), ago(1200))
+
+        # Rewritten once it is as old as the coalescing allows
+        cl.handle(store, report, NOW - timedelta(seconds=300))
+        self.assertEqual(store.get('LastReport'), ago(300))
+
+        store.instances = [self.instance()]
+        store.put('LastReport', ago(cl.READY_REPORT_AGE_SECONDS + 600))
+        self.assertTrue(cl.handle(store, {'Action': 'activate'}, NOW)['Ready'])
+
+        # Monitor that stopped reporting is noticed, later than with every report kept
+        store.put('LastReport', ago(cl.READY_REPORT_AGE_SECONDS + store.last_report_coalesce_seconds + 1))
+        self.assertFalse(cl.handle(store, {'Action': 'activate'}, NOW)['Ready'])
+
+    def test_new_instance_report_time_is_written_straight_away(self):
+        store = cl.MemoryStore({'ReportingInstance': 'i-1', 'ReportingSince': ago(3600), 'LastReport': ago(60)}, capacity=1)
+        store.last_report_coalesce_seconds = cl.AsgTagStore.last_report_coalesce_seconds
+        cl.handle(store, {'Action': 'report', 'ActiveSessions': 0, 'InstanceId': 'i-2'}, NOW)
+        self.assertEqual(store.get('ReportingInstance'), 'i-2')
+        self.assertEqual(store.get('LastReport'), ago(0))
+
+    def test_stale_report_is_not_ready(self):
+        store = cl.MemoryStore({'ReportingInstance': 'i-1', 'ReportingSince': ago(3600),
+                                'LastReport': ago(cl.READY_REPORT_AGE_SECONDS + 1)},
+                               capacity=1, instances=[self.instance()])
+        self.assertFalse(cl.handle(store, {'Action': 'activate'}, NOW)['Ready'])
+
+    def test_warming_instance_reports_are_ignored(self):
+        store = cl.MemoryStore({'ReportingInstance': 'i-1', 'ReportingSince': ago(600), 'LastReport': ago(60)},
+                               capacity=1, instances=[self.instance()])
+        cl.handle(store, {'Action': 'report', 'ActiveSessions': 0, 'Bytes': 0, 'InstanceId': 'i-2',
+                          'LifecycleState': 'Warmed:Pending'}, NOW)
+        self.assertEqual(store.get('ReportingInstance'), 'i-1')
+        self.assertEqual(store.saved, [])
+
+        cl.handle(store, {'Action': 'report', 'ActiveSessions': 0, 'Bytes': 0, 'InstanceId': 'i-1',
+                          'LifecycleState': 'InService'}, NOW)
+        self.assertEqual(store.get('LastReport'), ago(0))
+        self.assertTrue(cl.handle(store, {'Action': 'activate'}, NOW)['Ready'])
+
+    def test_report_with_traffic_is_activity(self):
+        store = cl.MemoryStore(capacity=1)
+        cl.handle(store, {'Action': 'report', 'ActiveSessions': 1, 'Bytes': cl.IDLE_SESSION_BYTES}, NOW)
+        self.assertEqual(store.get('LastActivity'), cl.format_utc(NOW))
+        self.assertIsNone(store.get('LastSession'))
+
+    def test_report_without_traffic_is_open_session(self):
+        store = cl.MemoryStore({'LastActivity': ago(60)}, capacity=1)
+        cl.handle(store, {'Action': 'report', 'ActiveSessions': 1, 'Bytes': 0}, NOW)
+        self.assertEqual(store.get('LastActivity'), ago(60))
+        self.assertEqual(store.get('LastSession'), cl.format_utc(NOW))
+
+    def test_cleanup_releases_idle_instance(self):
+        store = cl.MemoryStore({'LastActivity': ago(3600)}, capacity=1)
+        self.assertIsNone(cl.handle(store, {'Action': 'cleanup'}, NOW))
+        self.assertEqual(store.capacity, 0)
+
+    def test_invalid_action(self):
+        with self.assertRaises(Exception):
+            cl.handle(cl.MemoryStore(), {'Action': 'bogus'}, NOW)
+
+
+
+class FakeAutoScaling:
+
+    def __init__(self, capacity, instances = None):
+        self.capacity = capacity
+        self.instances = instances or []
+        self.calls = []
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.calls.append('describe_auto_scaling_groups')
+        return {'AutoScalingGroups': [{'DesiredCapacity': self.capacity, 'Instances': self.instances, 'Tags': []}]}
+
+    def set_desired_capacity(self, AutoScalingGroupName, DesiredCapacity):
+        self.calls.append('set_desired_capacity')
+        self.capacity = DesiredCapacity
+
+
+class FakeDynamoDb:
+
+    def __init__(self, item):
+        self.item = item
+        self.updates = []
+
+    def get_item(self, **kwargs):
+        return {'Item': self.item}
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+class DynamoDbStoreTest(unittest.TestCase):
+
+    def open_store(self, remembered, actual):
+        autoscaling = FakeAutoScaling(actual, [{'InstanceId': 'i-1', 'LifecycleState': 'InService'}] if actual else [])
+        dynamodb = FakeDynamoDb({'Id': {'S': 'asg'}, 'Capacity': {'N': str(remembered)}})
+        with mock.patch.object(cl, '_autoscaling_client', autoscaling), mock.patch.object(cl.boto3, 'client', return_value=dynamodb):
+            store = cl.DynamoDbStore('asg', 'table')
+        store.load()
+        return store, autoscaling, dynamodb
+
+    def test_activate_starts_instance_scaled_in_elsewhere(self):
+        store, autoscaling, dynamodb = self.open_store(1, 0)
+        with mock.patch.object(cl, '_autoscaling_client', autoscaling):
+            response = cl.handle(store, {'Action': 'activate'}, NOW)
+        self.assertEqual(autoscaling.capacity, 1)
+        self.assertEqual(response, {'Ready': False})
+        update = dynamodb.updates[0]
+        saved = {name: update['ExpressionAttributeValues'][':v' + key[2:]] for key, name in update['ExpressionAttributeNames'].items()}
+        self.assertEqual(saved['Capacity'], {'N': '1'})
+
+    def test_activate_describes_group_once(self):
+        store, autoscaling, _ = self.open_store(0, 1)
+        with mock.patch.object(cl, '_autoscaling_client', autoscaling):
+            response = cl.handle(store, {'Action': 'activate'}, NOW)
+        self.assertEqual(autoscaling.calls, ['describe_auto_scaling_groups'])
+        self.assertEqual(response['InstanceId'], 'i-1')
+
+    def test_report_proves_capacity(self):
+        store, autoscaling, _ = self.open_store(0, 1)
+        with mock.patch.object(cl, '_autoscaling_client', autoscaling):
+            cl.handle(store, {'Action': 'report', 'ActiveSessions': 0, 'InstanceId': 'i-1'}, NOW - timedelta(hours=1))
+            self.assertEqual(autoscaling.calls, [])
+            cl.handle(store, {'Action': 'cleanup'}, NOW)
+        self.assertEqual(autoscaling.capacity, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
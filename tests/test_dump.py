@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+MYSQL_TYPE_LONGLONG = 8
+LONGLONG = (MYSQL_TYPE_LONGLONG, 0, 20, 0)
+
+WORKERS = 3
+
+
+class DumpStandInConnection(rdscli.MysqlStandInConnection):
+    # A server without FLUSH TABLES WITH READ LOCK, as on RDS. Chunk queries wait until all workers are dumping
+    # at once, or give up after a while, so a dump over a single connection is slow but still finishes.
+
+    events = []
+    active = 0
+    most_active = 0
+    all_active = threading.Event()
+    lock = threading.Lock()
+
+    def log(self, event):
+        with self.lock:
+            self.events.append((id(self), event))
+
+    def query(self, sql):
+        sql = ' '.join(sql.split())
+
+        if sql.startswith('FLUSH TABLES WITH READ LOCK'):
+            self.log('ftwrl')
+            self.error(1227, 'Access denied; you need the RELOAD privilege for this operation', '42000')
+        elif sql.startswith('LOCK TABLES'):
+            self.log(sql)
+            self.ok()
+        elif sql.startswith(('START TRANSACTION', 'UNLOCK TABLES')):
+            self.log(sql)
+            self.ok()
+        elif 'information_schema.TABLES' in sql:
+            self.result(['TABLE_NAME', 'TABLE_ROWS'], [('big', '4000'), ('small', '10')],
+                        [(rdscli.MYSQL_TYPE_VAR_STRING, 0, 64, 0), LONGLONG])
+        elif "COLUMN_KEY = 'PRI'" in sql:
+            self.result(['COLUMN_NAME', 'DATA_TYPE'], [('id', 'int')])
+        elif 'information_schema.COLUMNS' in sql:
+            self.result(['COLUMN_NAME'], [('id',), ('name',)])
+        elif sql.startswith('SHOW CREATE TABLE'):
+            table = sql.split('`')[1]
+            self.result(['Table', 'Create Table'], [(table, f'CREATE TABLE `{table}` (`id` int PRIMARY KEY, `name` text)')])
+        elif sql.startswith('SELECT MIN('):
+            self.result(['low', 'high'], [('1', '4000')], [LONGLONG, LONGLONG])
+        elif sql.startswith('SELECT `id`, `name` FROM'):
+            self.log('chunk')
+            cls = type(self)
+            with self.lock:
+                cls.active += 1
+                cls.most_active = max(cls.most_active, cls.active)
+                if cls.active == WORKERS:
+                    cls.all_active.set()
+            cls.all_active.wait(2)
+            with self.lock:
+                cls.active -= 1
+            self.result(['id', 'name'], [('1', 'one'), ('2', "it's two")], [LONGLONG, (rdscli.MYSQL_TYPE_VAR_STRING, 0, 1 << 16, 0)])
+        else:
+            super().query(sql)
+
+
+class DumpTest(unittest.TestCase):
+
+    def setUp(self):
+        DumpStandInConnection.events = []
+        DumpStandInConnection.active = 0
+        DumpStandInConnection.most_active = 0
+        DumpStandInConnection.all_active = threading.Event()
+
+        self.standin = rdscli.MysqlStandIn(DumpStandInConnection)
+        port = self.standin.start()
+        db = {'username': 'user', 'password': 'secret', 'dbname': 'test'}
+        self.connections = [rdscli.connect_mysql(port, db) for _ in range(WORKERS + 1)]
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        self.standin.close()
+
+    def test_workers_dump_in_parallel_without_global_lock(self):
+        with tempfile.TemporaryDirectory() as output:
+            rdscli.dump_database(self.connections, output, [], 1000, 'none')
+
+            with open(os.path.join(output, rdscli.DUMP_MANIFEST)) as f:
+                manifest = json.load(f)
+            self.assertEqual(['big', 'small'], [t['name'] for t in manifest['tables']])
+            self.assertEqual(4, len(manifest['tables'][0]['chunks']))
+
+            with open(os.path.join(output, manifest['tables'][0]['chunks'][0])) as f:
+                self.assertEqual("INSERT INTO `big` (`id`, `name`) VALUES (1,'one'),(2,'it\\'s two');\n", f.read())
+
+        self.assertEqual(WORKERS, DumpStandInConnection.most_active)
+
+        events = DumpStandInConnection.events
+        names = [e for _, e in events]
+        self.assertNotIn('ftwrl', names)
+
+        # Coordinator locks the tables, every worker starts its snapshot under the lock, then the lock is released
+        lock = names.index('LOCK TABLES `big` READ, `small` READ')
+        unlock = names.index('UNLOCK TABLES')
+        starts = [i for i, e in enumerate(names) if e == 'START TRANSACTION WITH CONSISTENT SNAPSHOT']
+        self.assertEqual(WORKERS, len(starts))
+        self.assertTrue(lock < min(starts) and max(starts) < unlock)
+
+        coordinator = events[lock][0]
+        self.assertEqual(coordinator, events[unlock][0])
+        workers = set(events[i][0] for i in starts)
+        self.assertNotIn(coordinator, workers)
+
+        # Only connections with a snapshot dump
+        self.assertEqual(workers, set(c for c, e in events if e == 'chunk'))
+
+    def test_single_connection_dumps_on_its_own(self):
+        DumpStandInConnection.all_active.set()
+        with tempfile.TemporaryDirectory() as output:
+            rdscli.dump_database(self.connections[:1], output, ['small'], 1000, 'none')
+
+        names = [e for _, e in DumpStandInConnection.events]
+        self.assertEqual(['START TRANSACTION WITH CONSISTENT SNAPSHOT', 'chunk'], names)
+
+
+if __name__ == '__main__':
+    unittest.main()
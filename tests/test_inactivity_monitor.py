@@ -0,0 +1,201 @@
+import datetime
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+
+spec = importlib.util.spec_from_file_location(
+    'inactivity_monitor', os.path.join(os.path.dirname(__file__), '..', 'files', 'inactivity-monitor.py'))
+monitor = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(monitor)
+
+
+URL = 'https://lambda.eu-west-1.amazonaws.com/2015-03-31/functions/tcp-proxy-control-abc/invocations'
+HEADERS = {'Content-Type': 'application/json', 'X-Amz-Invocation-Type': 'Event'}
+
+
+class SignRequestTest(unittest.TestCase):
+
+    def test_signature_matches_botocore(self):
+        body = json.dumps({'Action': 'report', 'ActiveSessions': 1}).encode()
+
+        request = AWSRequest('POST', URL, data=body, headers=HEADERS)
+        SigV4Auth(Credentials('AKID', 'secret', 'token'), 'lambda', 'eu-west-1').add_auth(request)
+        now = datetime.datetime.strptime(request.headers['X-Amz-Date'], '%Y%m%dT%H%M%SZ') \
+            .replace(tzinfo=datetime.timezone.utc)
+
+        credentials = {'AccessKeyId': 'AKID', 'SecretAccessKey': 'secret', 'Token': 'token'}
+        headers = monitor.sign_request('POST', URL, HEADERS, body, 'eu-west-1', 'lambda', credentials, now)
+
+        self.assertEqual(headers['Authorization'], request.headers['Authorization'])
+        self.assertEqual(headers['X-Amz-Security-Token'], 'token')
+
+
+class InstanceCredentialsTest(unittest.TestCase):
+
+    def metadata(self, expiration):
+        values = {
+            'iam/security-credentials/': 'proxy-role\n',
+            'iam/security-credentials/proxy-role': json.dumps({
+                'AccessKeyId': 'AKID', 'SecretAccessKey': 'secret', 'Token': 'token', 'Expiration': expiration,
+            }),
+        }
+        return lambda *names: [values[n] for n in names]
+
+    def test_credentials_are_kept_until_close_to_expiration(self):
+        now = datetime.datetime(2024, 3, 4, 12, 0, tzinfo=datetime.timezone.utc)
+        credentials = monitor.InstanceCredentials()
+
+        with mock.patch.object(monitor, 'get_metadata', side_effect=self.metadata('2024-03-04T13:00:00Z')) as get:
+            self.assertEqual(credentials.get(now)['AccessKeyId'], 'AKID')
+            credentials.get(now + datetime.timedelta(minutes=30))
+            self.assertEqual(get.call_count, 2)
+
+            credentials.get(now + datetime.timedelta(minutes=56))
+            self.assertEqual(get.call_count, 4)
+
+
+class FakeProc:
+    # Just the parts of /proc the monitor reads: comm and io of every process
+
+    def __init__(self, root):
+        self.root = root
+
+    def process(self, pid, comm, rchar = 0, wchar = 0):
+        os.makedirs(os.path.join(self.root, str(pid)), exist_ok=True)
+        with open(os.path.join(self.root, str(pid), 'comm'), 'w') as f:
+            f.write(comm + '\n')
+        self.io(pid, rchar, wchar)
+
+    def io(self, pid, rchar, wchar):
+        with open(os.path.join(self.root, str(pid), 'io'), 'w') as f:
+            f.write(f'rchar: {rchar}\nwchar: {wchar}\nsyscr: 7\nsyscw: 3\nread_bytes: 0\nwrite_bytes: 0\n')
+
+    def exit(self, pid):
+        for name in os.listdir(os.path.join(self.root, str(pid))):
+            os.remove(os.path.join(self.root, str(pid), name))
+        os.rmdir(os.path.join(self.root, str(pid)))
+
+
+class ProcScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.proc = FakeProc(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_finds_session_workers_only(self):
+        self.proc.process(100, 'ssm-session-worker')
+        self.proc.process(200, 'sshd')
+        self.proc.process(300, 'ssm-session-worker')
+        os.makedirs(os.path.join(self.tmp.name, 'sys'))
+        # Process that exited between the listing and the read
+        os.makedirs(os.path.join(self.tmp.name, '400'))
+
+        self.assertEqual(sorted(monitor.find_session_workers(self.tmp.name)), ['100', '300'])
+
+    def test_io_bytes_are_read_and_written_characters(self):
+        self.proc.process(100, 'ssm-session-worker', rchar=1000, wchar=234)
+
+        self.assertEqual(monitor.read_io_bytes(self.tmp.name, '100'), 1234)
+        self.assertIsNone(monitor.read_io_bytes(self.tmp.name, '999'))
+
+
+class MonitorPollTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.proc = FakeProc(self.tmp.name)
+        self.reports = []
+        self.monitor = monitor.Monitor(self.tmp.name, self.reports.append, 'i-0123')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def poll(self, now):
+        with mock.patch('builtins.print'):
+            return self.monitor.poll(now)
+
+    def test_first_poll_reports_straight_away(self):
+        self.assertEqual(self.poll(1000), {'Action': 'report', 'ActiveSessions': 0, 'Bytes': 0, 'InstanceId': 'i-0123'})
+        self.assertEqual(len(self.reports), 1)
+
+    def test_new_session_is_reported_after_debounce(self):
+        self.poll(1000)
+
+        # A session opened right after a report waits for the debounce interval
+        self.proc.process(100, 'ssm-session-worker', rchar=10)
+        self.assertIsNone(self.poll(1000 + monitor.MIN_REPORT_INTERVAL - 1))
+
+        report = self.poll(1000 + monitor.MIN_REPORT_INTERVAL)
+        self.assertEqual(report['ActiveSessions'], 1)
+        self.assertEqual(report['Bytes'], 10)
+
+        # It is not reported again until the periodic update, however busy it is
+        self.proc.io(100, 5000, 5000)
+        self.assertIsNone(self.poll(1000 + monitor.MIN_REPORT_INTERVAL + 1))
+        self.assertEqual(len(self.reports), 2)
+
+    def test_active_session_reports_traffic(self):
+        self.proc.process(100, 'ssm-session-worker', rchar=100, wchar=100)
+        self.poll(1000)
+
+        for n in range(1, 6):
+            self.proc.io(100, 100 + n * 1000, 100)
+            self.poll(1000 + n)
+
+        report = self.poll(1000 + monitor.REPORT_INTERVAL)
+        self.assertEqual(report['ActiveSessions'], 1)
+        self.assertEqual(report['Bytes'], 5000)
+
+    def test_idle_session_reports_no_traffic(self):
+        # A session left open is still counted, without traffic the lambda can tell it is idle
+        self.proc.process(100, 'ssm-session-worker', rchar=100, wchar=100)
+        self.poll(1000)
+
+        for n in range(1, 5):
+            self.assertIsNone(self.poll(1000 + n * 60))
+
+        report = self.poll(1000 + monitor.REPORT_INTERVAL)
+        self.assertEqual(report['ActiveSessions'], 1)
+        self.assertEqual(report['Bytes'], 0)
+
+    def test_traffic_of_finished_sessions_is_kept(self):
+        self.poll(1000)
+
+        self.proc.process(100, 'ssm-session-worker', rchar=0)
+        self.poll(1001)
+        self.proc.io(100, 700, 0)
+        self.poll(1002)
+        self.proc.exit(100)
+        self.proc.process(101, 'ssm-session-worker', rchar=50)
+        self.poll(1003)
+
+        report = self.poll(1000 + monitor.REPORT_INTERVAL)
+        self.assertEqual(report['ActiveSessions'], 1)
+        self.assertEqual(report['Bytes'], 750)
+
+    def test_lifecycle_state_is_reported(self):
+        self.monitor.lifecycle_state = lambda: 'Warmed:Pending'
+        self.assertEqual(self.poll(1000)['LifecycleState'], 'Warmed:Pending')
+
+        self.monitor.lifecycle_state = lambda: None
+        self.assertNotIn('LifecycleState', self.poll(1000 + monitor.REPORT_INTERVAL))
+
+    def test_failed_report_does_not_stop_monitoring(self):
+        self.monitor.report = mock.Mock(side_effect=OSError('connection refused'))
+        self.assertIsNotNone(self.poll(1000))
+        self.assertIsNotNone(self.poll(1000 + monitor.REPORT_INTERVAL))
+        self.assertEqual(self.monitor.report.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
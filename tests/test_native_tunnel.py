@@ -0,0 +1,210 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+class EchoServer:
+    # Stands in for the remote database, echoes back whatever it gets
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.echo, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def echo(self, reader, writer):
+        while data := await reader.read(1024):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    def close(self):
+        async def shutdown():
+            self.server.close()
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class FakeChannel:
+    # Stands in for SsmDataChannel: each connection forwarded through it goes to the echo server,
+    # like the agent connects to the remote port when data arrives after a disconnect
+
+    def __init__(self, port):
+        self.port = port
+        self.received = asyncio.Queue()
+        self.open = True
+        self.connection = None
+
+    def is_open(self):
+        return self.open
+
+    async def send(self, data):
+        if self.connection is None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+            self.connection = writer
+
+            async def pump():
+                while data := await reader.read(1024):
+                    self.received.put_nowait(data)
+
+            asyncio.create_task(pump())
+        self.connection.write(data)
+
+    async def send_flag(self, flag):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def drop(self):
+        # Session closed by the agent or the network
+        self.open = False
+        self.received.put_nowait(None)
+        if self.connection is not None:
+            self.connection.close()
+
+    async def close(self):
+        self.open = False
+
+
+def exchange(sock, message):
+    sock.sendall(message)
+    received = b''
+    while len(received) < len(message):
+        data = sock.recv(1024)
+        if not data:
+            break
+        received += data
+    return received
+
+
+class NativeTunnelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.echo = EchoServer()
+        self.opened = []
+        self.sockets = []
+        patcher = mock.patch.object(rdscli, 'TUNNEL_RECONNECT_DELAY', 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        deadline = time.time() + 5
+        while self.tunnel.active_connections and time.time() < deadline:
+            time.sleep(0.01)
+        self.tunnel.close()
+        self.echo.close()
+
+    def connect(self, port):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.sockets.append(sock)
+        return sock
+
+    def start_tunnel(self, max_sessions):
+        async def open_channel():
+            await asyncio.sleep(0.01)
+            channel = FakeChannel(self.echo.port)
+            self.opened.append(channel)
+            return channel
+
+        self.closed = []
+        self.tunnel = rdscli.NativeTunnel(open_channel, max_sessions, self.closed.append)
+        return self.tunnel.start(0)
+
+    def call(self, fn, *args):
+        return self.tunnel.loop.call_soon_threadsafe(fn, *args)
+
+    def test_concurrent_clients_share_sessions(self):
+        port = self.start_tunnel(2)
+        results = []
+
+        def client(n):
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                for i in range(5):
+                    message = f'client {n} message {i}'.encode()
+                    results.append(exchange(sock, message) == message)
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+
+        self.assertEqual(results, [True] * 30)
+        self.assertLessEqual(len(self.opened), 2)
+        deadline = time.time() + 5
+        while len(self.closed) < 6 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.tunnel.stats()['totals']['connections'], 6)
+
+    def test_waiting_client_gets_slot_of_dropped_session(self):
+        port = self.start_tunnel(1)
+
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as first:
+            self.assertEqual(exchange(first, b'first'), b'first')
+
+            # The only session is busy, the second connection waits for it
+            second = self.connect(port)
+            second.sendall(b'second')
+            time.sleep(0.3)
+
+            self.call(self.opened[0].drop)
+            self.assertEqual(first.recv(1024), b'')
+
+        received = b''
+        while len(received) < len(b'second'):
+            received += second.recv(1024)
+        self.assertEqual(received, b'second')
+        self.assertEqual(len(self.opened), 2)
+
+    def test_keeper_leaves_wake_up_tokens(self):
+        self.start_tunnel(2)
+
+        self.call(self.tunnel.idle_channels.put_nowait, None)
+        time.sleep(0.3)
+
+        items = asyncio.run_coroutine_threadsafe(self.drain_idle(), self.tunnel.loop).result()
+        self.assertIn(None, items)
+
+    async def drain_idle(self):
+        items = []
+        while not self.tunnel.idle_channels.empty():
+            items.append(self.tunnel.idle_channels.get_nowait())
+        for item in items:
+            self.tunnel.idle_channels.put_nowait(item)
+        return items
+
+    def test_lost_session_is_reopened(self):
+        port = self.start_tunnel(1)
+
+        self.call(self.opened[0].drop)
+        deadline = time.time() + 5
+        while self.tunnel.stats()['totals']['reconnects'] == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.tunnel.stats()['sessions'], 1)
+
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            self.assertEqual(exchange(sock, b'again'), b'again')
+
+
+if __name__ == '__main__':
+    unittest.main()
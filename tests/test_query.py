@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+
+MYSQL_TYPE_LONGLONG = 8
+MYSQL_TYPE_NEWDECIMAL = 246
+MYSQL_TYPE_DATETIME = 12
+
+COLUMNS = ['id', 'price', 'created', 'note']
+TYPES = [
+    (MYSQL_TYPE_LONGLONG, rdscli.MYSQL_UNSIGNED_FLAG, 20, 0),
+    (MYSQL_TYPE_NEWDECIMAL, 0, 10, 2),
+    (MYSQL_TYPE_DATETIME, 0, 19, 0),
+    (rdscli.MYSQL_TYPE_VAR_STRING, 0, 1 << 16, 0),
+]
+ROWS = [
+    ('1', '12.50', '2024-03-04 12:30:00', 'first'),
+    ('18446744073709551615', None, '2024-03-04 12:31:00', None),
+    (None, '-0.01', None, 'third'),
+    ('9223372036854775808', '99999999.99', '2024-03-05 00:00:00', ''),
+    ('5', '0.00', '2024-03-06 23:59:59', 'fifth'),
+]
+
+
+class TypedStandInConnection(rdscli.MysqlStandInConnection):
+    # Answers `SELECT items` with typed rows, `SELECT nothing` with none
+
+    def query(self, sql):
+        if sql.strip() == 'SELECT items':
+            self.result(COLUMNS, ROWS, TYPES)
+        elif sql.strip() == 'SELECT nothing':
+            self.result(COLUMNS, [], TYPES)
+        else:
+            super().query(sql)
+
+
+class RunQueryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.standin = rdscli.MysqlStandIn(TypedStandInConnection)
+        cls.port = cls.standin.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.standin.close()
+
+    def run_query(self, sql, output_format, batch_size = 2):
+        connection = rdscli.connect_mysql(self.port, {'username': 'user', 'password': 'secret', 'dbname': 'test'})
+        out = io.BytesIO()
+        log = io.StringIO()
+        try:
+            rows, nbytes = rdscli.run_query(connection, sql, None, output_format, batch_size, out, log)
+        finally:
+            connection.close()
+        self.assertEqual(nbytes, len(out.getvalue()))
+        return rows, out.getvalue(), log.getvalue()
+
+    def test_jsonl(self):
+        rows, output, log = self.run_query('SELECT items', 'jsonl')
+        self.assertEqual(rows, 5)
+        self.assertIn('Done: 5 rows', log)
+
+        records = [json.loads(line) for line in output.decode().splitlines()]
+        self.assertEqual(records[0], {'id': 1, 'price': '12.50', 'created': '2024-03-04T12:30:00', 'note': 'first'})
+        self.assertEqual(records[1], {'id': 18446744073709551615, 'price': None, 'created': '2024-03-04T12:31:00', 'note': None})
+        self.assertEqual(records[2]['id'], None)
+        self.assertEqual(records[2]['price'], '-0.01')
+
+    def test_csv(self):
+        rows, output, _ = self.run_query('SELECT items', 'csv')
+        self.assertEqual(rows, 5)
+
+        records = list(csv.reader(io.StringIO(output.decode())))
+        self.assertEqual(records[0], COLUMNS)
+        self.assertEqual(records[1], ['1', '12.50', '2024-03-04 12:30:00', 'first'])
+        self.assertEqual(len(records), 6)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        rows, output, _ = self.run_query('SELECT items', 'arrow')
+        self.assertEqual(rows, 5)
+
+        reader = pyarrow.ipc.open_stream(output)
+        self.assertEqual(reader.schema.types, [
+            pyarrow.uint64(), pyarrow.decimal128(10, 2), pyarrow.timestamp('us'), pyarrow.string(),
+        ])
+        batches = list(reader)
+        # Results are streamed in batches of the requested size
+        self.assertEqual([b.num_rows for b in batches], [2, 2, 1])
+
+        table = pyarrow.Table.from_batches(batches).to_pylist()
+        self.assertEqual(table[1]['id'], 18446744073709551615)
+        self.assertEqual(table[3]['id'], 9223372036854775808)
+        self.assertEqual(str(table[3]['price']), '99999999.99')
+        self.assertIsNone(table[1]['price'])
+        self.assertEqual(table[4]['created'].isoformat(), '2024-03-06T23:59:59')
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_without_rows(self):
+        rows, output, _ = self.run_query('SELECT nothing', 'arrow')
+        self.assertEqual(rows, 0)
+
+        reader = pyarrow.ipc.open_stream(output)
+        self.assertEqual(reader.schema.names, COLUMNS)
+        self.assertEqual(reader.read_all().num_rows, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
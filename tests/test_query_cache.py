@@ -0,0 +1,163 @@
+import datetime
+import decimal
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+class NormalizeSqlTest(unittest.TestCase):
+
+    def test_whitespace_and_comments_collapse(self):
+        sql = 'SELECT  a,\n\tb -- columns\nFROM t /* table */ WHERE x = 1 # done\n;;'
+        self.assertEqual(rdscli.normalize_sql(sql), 'SELECT a, b FROM t WHERE x = 1')
+
+    def test_literals_are_kept_as_they_are(self):
+        sql = "SELECT 'a  -- b', \"c /* d */\", `e  f` FROM t WHERE s = 'it''s  #'"
+        self.assertEqual(rdscli.normalize_sql(sql), sql)
+
+    def test_versioned_comment_is_code(self):
+        self.assertEqual(rdscli.normalize_sql('SELECT /*!40001 SQL_NO_CACHE */  1'), 'SELECT /*!40001 SQL_NO_CACHE */ 1')
+
+
+class CheckCacheableTest(unittest.TestCase):
+
+    def assert_rejected(self, sql, reason):
+        with self.assertRaises(Exception) as e:
+            rdscli.check_cacheable(sql)
+        self.assertIn(reason, str(e.exception))
+
+    def test_plain_selects_pass(self):
+        rdscli.check_cacheable('SELECT 1')
+        rdscli.check_cacheable('  -- report\n with x AS (SELECT 1) SELECT * FROM x')
+        rdscli.check_cacheable("SELECT 'INSERT INTO t; DELETE', `update`, \"lock\" FROM t -- FOR UPDATE")
+        rdscli.check_cacheable('SELECT /* SLEEP(1); */ 1')
+        rdscli.check_cacheable('SELECT updated_at, share_count, deleted FROM t')
+
+    def test_side_effects_are_rejected(self):
+        self.assert_rejected('UPDATE t SET a = 1', 'is not a SELECT')
+        self.assert_rejected('SELECT * FROM t FOR UPDATE', 'uses UPDATE')
+        self.assert_rejected('SELECT * FROM t LOCK IN SHARE MODE', 'uses LOCK')
+        self.assert_rejected("SELECT * FROM t INTO OUTFILE '/tmp/x'", 'uses INTO')
+        self.assert_rejected('SELECT 1; DROP TABLE t', 'more than one statement')
+        self.assert_rejected('SELECT @a:=1', 'assigns variables')
+        self.assert_rejected('SELECT sleep(10)', 'calls SLEEP')
+        self.assert_rejected('WITH x AS (SELECT 1) DELETE FROM t', 'uses DELETE')
+
+    def test_versioned_comments_are_checked(self):
+        self.assert_rejected('SELECT * FROM t /*!50000 FOR UPDATE */', 'uses UPDATE')
+
+
+class QueryCacheKeyTest(unittest.TestCase):
+
+    def key(self, sql, params = None, secret_id = 'db/secret', database = None, reader = False):
+        with mock.patch.object(rdscli, 'discovery_cache_key', side_effect=lambda s: f'default/eu-west-1/{s}'):
+            return rdscli.query_cache_key(secret_id, database, reader, sql, params)
+
+    def test_same_query_formatted_differently_shares_key(self):
+        self.assertEqual(self.key('SELECT a FROM t WHERE x = %s', ['1']),
+                         self.key('SELECT  a\nFROM t -- filtered\nWHERE x = %s;', ['1']))
+
+    def test_anything_changing_results_changes_key(self):
+        key = self.key('SELECT a FROM t WHERE x = %s', ['1'])
+        self.assertNotEqual(key, self.key('SELECT a FROM t WHERE x = %s', ['2']))
+        self.assertNotEqual(key, self.key("SELECT a FROM t WHERE x = 'a  b'", ['1']))
+        self.assertNotEqual(key, self.key('SELECT a FROM t WHERE x = %s', ['1'], secret_id='other'))
+        self.assertNotEqual(key, self.key('SELECT a FROM t WHERE x = %s', ['1'], database='other'))
+        self.assertNotEqual(key, self.key('SELECT a FROM t WHERE x = %s', ['1'], reader=True))
+
+
+class QueryCacheStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(rdscli, 'CACHE_DIR', self.tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def store(self, key, batches, max_bytes = 1 << 20):
+        writer = rdscli.QueryCacheWriter(key, 60, max_bytes)
+        for rows in batches:
+            writer.add(rows)
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            writer.commit(['a', 'b'])
+
+    def test_values_come_back_as_they_were(self):
+        rows = [
+            (1, 'text', None, 2.5),
+            (decimal.Decimal('12.50'), b'\x00\xff', datetime.datetime(2024, 3, 4, 12, 30, 1, 5), datetime.date(2024, 3, 4)),
+            (datetime.timedelta(days=-1, seconds=3600), datetime.time(23, 59, 59), '', True),
+        ]
+        self.store('k', [rows[:2], rows[2:]])
+
+        self.assertEqual([r for batch in rdscli.cached_batches('k') for r in batch], rows)
+        self.assertEqual(rdscli.lookup_query_cache('k', 60)['format'], rdscli.QUERY_CACHE_FORMAT)
+
+    def test_pages_are_plain_json(self):
+        self.store('k', [[(decimal.Decimal('1.5'), 'x')]])
+
+        with open(rdscli.query_cache_file('k'), 'rb') as f:
+            data = f.read()
+        (length,) = rdscli.QUERY_CACHE_PAGE_HEADER.unpack(data[:rdscli.QUERY_CACHE_PAGE_HEADER.size])
+        page = zlib.decompress(data[rdscli.QUERY_CACHE_PAGE_HEADER.size:][:length])
+        self.assertEqual(json.loads(page), [[{'decimal': '1.5'}], ['x']])
+
+    def test_entries_of_older_format_are_ignored(self):
+        self.store('k', [[(1, 'x')]])
+        index = rdscli.load_cache(rdscli.QUERY_CACHE_INDEX)
+        del index['k']['format']
+        rdscli.save_cache(rdscli.QUERY_CACHE_INDEX, index)
+
+        self.assertIsNone(rdscli.lookup_query_cache('k', 60))
+
+    def test_values_of_unknown_types_are_not_cached(self):
+        writer = rdscli.QueryCacheWriter('k', 60, 1 << 20)
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            writer.add([(1, object())])
+            writer.commit(['a', 'b'])
+
+        self.assertIn('cannot be cached', stderr.getvalue())
+        self.assertIsNone(rdscli.lookup_query_cache('k', 60))
+        self.assertEqual(os.listdir(rdscli.cache_path(rdscli.QUERY_CACHE_DIR)), [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        rows = [(n, 'x' * 100) for n in range(50)]
+        with mock.patch.object(time, 'time', return_value=1000):
+            self.store('old', [rows])
+        size = rdscli.load_cache(rdscli.QUERY_CACHE_INDEX)['old']['bytes']
+
+        with mock.patch.object(time, 'time', return_value=1001):
+            self.store('used', [rows])
+        with mock.patch.object(time, 'time', return_value=1002):
+            self.store('new', [rows])
+        with mock.patch.object(time, 'time', return_value=1003):
+            # Reading an entry makes it recently used
+            self.assertIsNotNone(rdscli.lookup_query_cache('old', 60))
+            self.store('newest', [rows], max_bytes=size * 3)
+
+        index = rdscli.load_cache(rdscli.QUERY_CACHE_INDEX)
+        self.assertEqual(sorted(index), ['new', 'newest', 'old'])
+        self.assertFalse(os.path.exists(rdscli.query_cache_file('used')))
+
+    def test_expired_entries_are_evicted_first(self):
+        with mock.patch.object(time, 'time', return_value=1000):
+            self.store('expired', [[(1, 'x')]])
+        with mock.patch.object(time, 'time', return_value=2000):
+            self.store('fresh', [[(1, 'x')]])
+
+        self.assertEqual(sorted(rdscli.load_cache(rdscli.QUERY_CACHE_INDEX)), ['fresh'])
+        self.assertFalse(os.path.exists(rdscli.query_cache_file('expired')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+HOST = 'primary.abcdefgwgxg2.eu-west-1.rds.amazonaws.com'
+
+
+def instance(identifier, vpc_id, groups, **fields):
+    return {
+        'DBInstanceIdentifier': identifier,
+        'DBInstanceStatus': 'available',
+        'Endpoint': {'Address': f'{identifier}.abcdefgwgxg2.eu-west-1.rds.amazonaws.com'},
+        'AvailabilityZone': 'eu-west-1a',
+        'DBSubnetGroup': {'VpcId': vpc_id},
+        'VpcSecurityGroups': [{'VpcSecurityGroupId': g} for g in groups],
+        **fields,
+    }
+
+
+PRIMARY = instance('primary', 'vpc-1', ['sg-db'], ReadReplicaDBInstanceIdentifiers=['same', 'other-vpc', 'other-sg'])
+REPLICAS = [
+    instance('same', 'vpc-1', ['sg-db', 'sg-extra']),
+    instance('other-vpc', 'vpc-2', ['sg-db']),
+    instance('other-sg', 'vpc-1', ['sg-other']),
+]
+
+
+class ReaderReachabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        rds = mock.Mock()
+        rds.describe_db_instances.return_value = {'DBInstances': REPLICAS}
+        cloudwatch = mock.Mock()
+        cloudwatch.get_metric_data.return_value = {'MetricDataResults': []}
+        clients = {'rds': rds, 'cloudwatch': cloudwatch}
+
+        patches = [
+            mock.patch.object(rdscli, 'describe_instance', return_value=PRIMARY),
+            mock.patch.object(rdscli, 'aws_client', side_effect=clients.get),
+            mock.patch.object(rdscli, 'load_cache', return_value={}),
+            mock.patch.object(rdscli, 'save_cache'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_replicas_out_of_reach_are_marked(self):
+        readers = {r['id']: r['unreachable'] for r in rdscli.list_readers(HOST)}
+
+        self.assertIsNone(readers['same'])
+        self.assertEqual(readers['other-vpc'], 'it is in vpc-2, not in vpc-1 of the database')
+        self.assertEqual(readers['other-sg'], 'it shares no security group with the database')
+
+    def test_only_reachable_replica_is_picked_with_warnings(self):
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            for _ in range(5):
+                self.assertEqual(rdscli.pick_reader(HOST, True), 'same.abcdefgwgxg2.eu-west-1.rds.amazonaws.com')
+
+        self.assertIn('Warning: skipping reader other-vpc, it is in vpc-2', stderr.getvalue())
+        self.assertIn('Warning: skipping reader other-sg', stderr.getvalue())
+        self.assertNotIn('Warning', stdout.getvalue())
+
+    def test_connection_count_errors_go_to_stderr(self):
+        rdscli.import_botocore()
+        error = rdscli.botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetMetricData')
+        rdscli.aws_client('cloudwatch').get_metric_data.side_effect = error
+
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertIsNone(rdscli.get_connection_counts(['same', 'other']))
+
+        self.assertIn('AccessDenied', stderr.getvalue())
+        self.assertEqual(stdout.getvalue(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+class FakeAgent:
+    # Agent end of an SSM data channel: does the handshake and echoes input back as output, acknowledging both ways.
+    # Acknowledgement of the input messages in drop_acks is not sent the first time they arrive, the client has
+    # to send them again. Other acknowledgements are sent after ack_delay, so that the send window fills up.
+
+    def __init__(self, drop_acks = (), ack_delay = 0):
+        self.drop_acks = set(drop_acks)
+        self.ack_delay = ack_delay
+        self.token = None
+        self.handshake_response = None
+        self.received = {}
+        self.echoed = bytearray()
+        self.flags = []
+        self.unacknowledged_input = set()
+        self.max_unacknowledged_input = 0
+        self.unacknowledged_output = {}
+        self.next_sequence = 0
+        self.server = None
+        self.tasks = set()
+
+    async def start(self):
+        self.server = await websockets.serve(self.handle, '127.0.0.1', 0)
+        return f'ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}'
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def send_output(self, websocket, payload_type, payload):
+        sequence_number = self.next_sequence
+        self.next_sequence += 1
+        self.unacknowledged_output[sequence_number] = payload
+        await websocket.send(rdscli.encode_ssm_message(rdscli.OUTPUT_STREAM_MESSAGE, sequence_number, 0, payload_type, payload))
+
+    async def acknowledge(self, websocket, message, delay):
+        if delay:
+            await asyncio.sleep(delay)
+        self.unacknowledged_input.discard(message['SequenceNumber'])
+        ack = {
+            'AcknowledgedMessageType': message['MessageType'],
+            'AcknowledgedMessageId': message['MessageId'],
+            'AcknowledgedMessageSequenceNumber': message['SequenceNumber'],
+            'IsSequentialMessage': True,
+        }
+        await websocket.send(rdscli.encode_ssm_message(rdscli.ACKNOWLEDGE_MESSAGE, 0, 3, 0, json.dumps(ack).encode()))
+
+    async def handle(self, websocket):
+        self.token = json.loads(await websocket.recv())['TokenValue']
+
+        request = {'RequestedClientActions': [{'ActionType': 'SessionType', 'ActionParameters': {'SessionType': 'Port'}}]}
+        await self.send_output(websocket, rdscli.PAYLOAD_HANDSHAKE_REQUEST, json.dumps(request).encode())
+
+        async for frame in websocket:
+            message = rdscli.decode_ssm_message(frame)
+
+            if message['MessageType'] == rdscli.ACKNOWLEDGE_MESSAGE:
+                ack = json.loads(message['Payload'])
+                self.unacknowledged_output.pop(ack['AcknowledgedMessageSequenceNumber'], None)
+                continue
+
+            sequence_number = message['SequenceNumber']
+            first_time = sequence_number not in self.received
+            self.received[sequence_number] = self.received.get(sequence_number, 0) + 1
+
+            if first_time:
+                self.unacknowledged_input.add(sequence_number)
+                self.max_unacknowledged_input = max(self.max_unacknowledged_input, len(self.unacknowledged_input))
+
+            if first_time and sequence_number in self.drop_acks:
+                pass
+            else:
+                task = asyncio.create_task(self.acknowledge(websocket, message, self.ack_delay))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+            if not first_time:
+                continue
+
+            if message['PayloadType'] == rdscli.PAYLOAD_HANDSHAKE_RESPONSE:
+                self.handshake_response = json.loads(message['Payload'])
+                await self.send_output(websocket, rdscli.PAYLOAD_HANDSHAKE_COMPLETE, b'{}')
+            elif message['PayloadType'] == rdscli.PAYLOAD_OUTPUT:
+                self.echoed += message['Payload']
+                await self.send_output(websocket, rdscli.PAYLOAD_OUTPUT, message['Payload'])
+            elif message['PayloadType'] == rdscli.PAYLOAD_FLAG:
+                self.flags.append(int.from_bytes(message['Payload'][:4], 'big'))
+
+
+class SsmMessageTest(unittest.TestCase):
+
+    def test_header_framing(self):
+        frame = rdscli.encode_ssm_message(rdscli.INPUT_STREAM_MESSAGE, 7, 0, rdscli.PAYLOAD_OUTPUT, b'hello')
+        self.assertEqual(rdscli.SSM_MESSAGE_HEADER.size, 116)
+        self.assertEqual(len(frame), 116 + 4 + 5)
+
+        message = rdscli.decode_ssm_message(frame)
+        self.assertEqual(message['MessageType'], rdscli.INPUT_STREAM_MESSAGE)
+        self.assertEqual(message['SequenceNumber'], 7)
+        self.assertEqual(message['PayloadType'], rdscli.PAYLOAD_OUTPUT)
+        self.assertEqual(message['Payload'], b'hello')
+
+
+class SsmDataChannelTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        for name, value in [('SSM_RESEND_TIMEOUT', 0.2), ('SSM_SEND_WINDOW', 4), ('SSM_STREAM_CHUNK_SIZE', 16)]:
+            patcher = mock.patch.object(rdscli, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def open_channel(self, agent):
+        url = await agent.start()
+        channel = rdscli.SsmDataChannel(url, 'token-1')
+        await channel.open(timeout=5)
+        return channel
+
+    async def receive(self, channel, length):
+        data = b''
+        while len(data) < length:
+            chunk = await asyncio.wait_for(channel.received.get(), 5)
+            self.assertIsNotNone(chunk)
+            data += chunk
+        return data
+
+    async def wait_until(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.05)
+        self.fail('condition not met in time')
+
+    async def close(self, channel, agent):
+        await channel.close()
+        await agent.stop()
+
+    async def test_handshake(self):
+        agent = FakeAgent()
+        channel = await self.open_channel(agent)
+        try:
+            self.assertEqual(agent.token, 'token-1')
+            self.assertEqual(agent.handshake_response['ProcessedClientActions'],
+                             [{'ActionType': 'SessionType', 'ActionStatus': 1}])
+            self.assertEqual(agent.handshake_response['Errors'], [])
+        finally:
+            await self.close(channel, agent)
+
+    async def test_echo_with_lost_ack_and_flow_control(self):
+        # Input 1 is the first data message after the handshake response, its ack is lost once
+        agent = FakeAgent(drop_acks=[1], ack_delay=0.02)
+        channel = await self.open_channel(agent)
+        try:
+            data = bytes(range(256)) * 4
+            await channel.send(data)
+            self.assertEqual(await self.receive(channel, len(data)), data)
+
+            await self.wait_until(lambda: not channel.unacknowledged and not agent.unacknowledged_output)
+
+            self.assertEqual(bytes(agent.echoed), data)
+            self.assertGreaterEqual(agent.received[1], 2)
+            self.assertLessEqual(agent.max_unacknowledged_input, rdscli.SSM_SEND_WINDOW)
+        finally:
+            await self.close(channel, agent)
+
+    async def test_paused_publication(self):
+        agent = FakeAgent()
+        channel = await self.open_channel(agent)
+        try:
+            await channel.handle_message({'MessageType': rdscli.PAUSE_PUBLICATION_MESSAGE})
+            send = asyncio.create_task(channel.send(b'held back'))
+            await asyncio.sleep(0.2)
+            self.assertFalse(send.done())
+            self.assertEqual(bytes(agent.echoed), b'')
+
+            await channel.handle_message({'MessageType': rdscli.START_PUBLICATION_MESSAGE})
+            await send
+            self.assertEqual(await self.receive(channel, 9), b'held back')
+        finally:
+            await self.close(channel, agent)
+
+    async def test_close_terminates_session(self):
+        agent = FakeAgent()
+        channel = await self.open_channel(agent)
+        await channel.send_flag(rdscli.FLAG_DISCONNECT_TO_PORT)
+        await self.wait_until(lambda: agent.flags == [rdscli.FLAG_DISCONNECT_TO_PORT])
+        await channel.close()
+        await self.wait_until(lambda: rdscli.FLAG_TERMINATE_SESSION in agent.flags)
+        await agent.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+DB = {'account': '111111111111', 'host': 'db.abc.eu-west-1.rds.amazonaws.com', 'port': 3306}
+
+
+def startup_args():
+    return types.SimpleNamespace(
+        secret_id='db/secret', instance_id=None, group_id=None, subnet_id=None, shared_proxy=False,
+        image_id=None, warm_pool=None, state_store=None, acquire_timeout=60,
+    )
+
+
+class StaleDiscoveryTest(unittest.TestCase):
+
+    def test_stale_cache_is_not_deployed(self):
+        # Cached network settings were discovered for a database in another account
+        cached = {'account': '222222222222', 'host': DB['host'], 'group_id': 'sg-stale', 'subnet_id': 'subnet-stale'}
+        secret_read = threading.Event()
+        deploys = []
+
+        def read_db_secret(secret_id):
+            secret_read.wait(1)
+            return DB
+
+        def deploy_proxy(*args):
+            deploys.append(args)
+            return {'Outputs': []}
+
+        with mock.patch.multiple(rdscli,
+                                 read_db_secret=read_db_secret,
+                                 discovery_cache_key=lambda secret_id: 'key',
+                                 lookup_discovery=lambda key: cached,
+                                 invalidate_discovery=lambda key: None,
+                                 lookup_deployed_proxy=lambda signature: None,
+                                 render_template=lambda path: 'template',
+                                 activate_proxy=lambda name: secret_read.set(),
+                                 deploy_proxy=deploy_proxy):
+            with self.assertRaises(rdscli.StaleDiscoveryError):
+                rdscli.start_proxy(rdscli.PhaseTimer(), startup_args(), False)
+
+        self.assertEqual(deploys, [])
+
+
+
+class AgentGoneTest(unittest.TestCase):
+
+    def test_agent_exiting_after_ping_falls_back_to_own_tunnel(self):
+        replies = iter([{'ok': True}, None, None])
+        args = types.SimpleNamespace(secret_id='db/secret', no_agent=False, local_port=None, reader=False,
+                                     refresh=False, tunnel='cli')
+
+        with mock.patch.multiple(rdscli,
+                                 agent_request=lambda request, timeout = 60: next(replies),
+                                 read_db_secret=lambda secret_id: DB,
+                                 start_proxy=lambda timer, args, refresh, db: (db, DB['host'], 'i-1'),
+                                 open_tunnel=lambda *args: (12345, 'tunnel')):
+            db, local_port, tunnel = rdscli.acquire_tunnel(rdscli.PhaseTimer(), args)
+
+        self.assertEqual((local_port, tunnel), (12345, 'tunnel'))
+
+
+if __name__ == '__main__':
+    unittest.main()
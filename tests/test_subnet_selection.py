@@ -0,0 +1,185 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+VPC_CIDR = '10.0.0.0/16'
+
+
+def route_table(route_table_id, routes = (), subnet_ids = (), main = False):
+    associations = [{'SubnetId': s} for s in subnet_ids]
+    if main:
+        associations.append({'Main': True})
+    return {
+        'RouteTableId': route_table_id,
+        'Associations': associations,
+        'Routes': [{'DestinationCidrBlock': VPC_CIDR, 'GatewayId': 'local', 'State': 'active'}] + list(routes),
+    }
+
+
+def default_route(**target):
+    return dict({'DestinationCidrBlock': rdscli.INTERNET, 'State': 'active'}, **target)
+
+
+def acl_entry(rule_number, action, egress, cidr = rdscli.INTERNET, protocol = '-1', ports = None):
+    entry = {'RuleNumber': rule_number, 'RuleAction': action, 'Egress': egress, 'CidrBlock': cidr, 'Protocol': protocol}
+    if ports is not None:
+        entry['PortRange'] = {'From': ports[0], 'To': ports[1]}
+    return entry
+
+
+def open_acl(acl_id = 'acl-default', default = True, subnet_ids = ()):
+    return {
+        'NetworkAclId': acl_id,
+        'IsDefault': default,
+        'Associations': [{'SubnetId': s} for s in subnet_ids],
+        'Entries': [
+            acl_entry(100, 'allow', True),
+            acl_entry(100, 'allow', False),
+            acl_entry(32767, 'deny', True),
+            acl_entry(32767, 'deny', False),
+        ],
+    }
+
+
+def endpoint(service, private_dns = True):
+    return {
+        'ServiceName': f'com.amazonaws.eu-west-1.{service}',
+        'VpcEndpointType': 'Interface',
+        'State': 'available',
+        'PrivateDnsEnabled': private_dns,
+    }
+
+
+def network(subnets, route_tables, acls = None, endpoints = ()):
+    return {
+        'Subnets': subnets,
+        'RouteTables': route_tables,
+        'NetworkAcls': acls if acls is not None else [open_acl()],
+        'VpcEndpoints': list(endpoints),
+    }
+
+
+def subnet(subnet_id, public_ip = False):
+    return {'SubnetId': subnet_id, 'State': 'available', 'MapPublicIpOnLaunch': public_ip}
+
+
+class AclAllowsTest(unittest.TestCase):
+
+    def test_first_matching_rule_decides(self):
+        acl = {'Entries': [
+            acl_entry(200, 'allow', True),
+            acl_entry(100, 'deny', True, protocol='6', ports=(443, 443)),
+        ]}
+        self.assertFalse(rdscli.acl_allows(acl, True, 443, rdscli.INTERNET))
+        self.assertTrue(rdscli.acl_allows(acl, True, 80, rdscli.INTERNET))
+
+    def test_deny_for_other_destination_does_not_match(self):
+        acl = {'Entries': [
+            acl_entry(100, 'deny', True, cidr='192.168.0.0/16'),
+            acl_entry(200, 'allow', True),
+        ]}
+        self.assertTrue(rdscli.acl_allows(acl, True, 443, VPC_CIDR))
+
+    def test_direction_is_respected(self):
+        acl = {'Entries': [acl_entry(100, 'allow', False)]}
+        self.assertFalse(rdscli.acl_allows(acl, True, 443, rdscli.INTERNET))
+        self.assertTrue(rdscli.acl_allows(acl, False, 443, rdscli.INTERNET))
+
+    def test_other_protocols_are_skipped(self):
+        acl = {'Entries': [
+            acl_entry(100, 'deny', True, protocol='17'),
+            acl_entry(200, 'allow', True, protocol='6', ports=(443, 443)),
+        ]}
+        self.assertTrue(rdscli.acl_allows(acl, True, 443, rdscli.INTERNET))
+
+
+class EvaluateSubnetTest(unittest.TestCase):
+
+    def test_main_route_table_is_used_without_own_association(self):
+        net = network(
+            [subnet('subnet-a')],
+            [route_table('rtb-other', [], ['subnet-b']), route_table('rtb-main', [default_route(NatGatewayId='nat-1')], main=True)],
+        )
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertTrue(usable)
+        self.assertEqual(reasons, ['default route via nat-1'])
+
+    def test_own_route_table_overrides_main(self):
+        net = network(
+            [subnet('subnet-a')],
+            [route_table('rtb-own', [], ['subnet-a']), route_table('rtb-main', [default_route(NatGatewayId='nat-1')], main=True)],
+        )
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertFalse(usable)
+        self.assertEqual(reasons, ['no default route and no SSM VPC endpoints'])
+
+    def test_internet_gateway_needs_public_ip(self):
+        net = network([subnet('subnet-a')], [route_table('rtb-a', [default_route(GatewayId='igw-1')], ['subnet-a'])])
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertFalse(usable)
+        self.assertIn('default route via igw-1 but instances get no public IP', reasons)
+
+        usable, reasons = rdscli.evaluate_subnet(subnet('subnet-a', public_ip=True), net)
+        self.assertTrue(usable)
+
+    def test_endpoints_need_private_dns(self):
+        endpoints = [endpoint('ssm'), endpoint('ssmmessages'), endpoint('ec2messages', private_dns=False)]
+        net = network([subnet('subnet-a')], [route_table('rtb-a', [], ['subnet-a'])], endpoints=endpoints)
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertFalse(usable)
+        self.assertEqual(reasons, ['no VPC endpoints for ec2messages'])
+
+    def test_endpoints_with_private_dns_are_enough(self):
+        endpoints = [endpoint(s) for s in rdscli.SSM_ENDPOINT_SERVICES]
+        net = network([subnet('subnet-a')], [route_table('rtb-a', [], ['subnet-a'])], endpoints=endpoints)
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertTrue(usable)
+
+    def test_acl_deny_before_allow_blocks_path(self):
+        acl = open_acl('acl-a', default=False, subnet_ids=['subnet-a'])
+        acl['Entries'].append(acl_entry(50, 'deny', True, protocol='6', ports=(443, 443)))
+        net = network(
+            [subnet('subnet-a')],
+            [route_table('rtb-a', [default_route(NatGatewayId='nat-1')], ['subnet-a'])],
+            [open_acl(), acl],
+        )
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertFalse(usable)
+        self.assertEqual(reasons, [f'default route via nat-1 but network ACL acl-a blocks outbound HTTPS to {rdscli.INTERNET}'])
+
+    def test_acl_blocking_responses(self):
+        acl = open_acl('acl-a', default=False, subnet_ids=['subnet-a'])
+        acl['Entries'].append(acl_entry(50, 'deny', False, protocol='6', ports=(1024, 65535)))
+        net = network(
+            [subnet('subnet-a')],
+            [route_table('rtb-a', [default_route(NatGatewayId='nat-1')], ['subnet-a'])],
+            [acl],
+        )
+        usable, reasons = rdscli.evaluate_subnet(net['Subnets'][0], net)
+        self.assertFalse(usable)
+        self.assertIn('blocks responses', reasons[0])
+
+
+class RankSubnetsTest(unittest.TestCase):
+
+    def test_usable_subnets_come_first_in_original_order(self):
+        net = network(
+            [subnet('subnet-a'), subnet('subnet-b'), subnet('subnet-c')],
+            [
+                route_table('rtb-private', [], ['subnet-a']),
+                route_table('rtb-main', [default_route(NatGatewayId='nat-1')], main=True),
+            ],
+        )
+        ranking = rdscli.rank_subnets(['subnet-a', 'subnet-missing', 'subnet-c', 'subnet-b'], net)
+        self.assertEqual([r['SubnetId'] for r in ranking], ['subnet-c', 'subnet-b', 'subnet-a', 'subnet-missing'])
+        self.assertEqual([r['Usable'] for r in ranking], [True, True, False, False])
+        self.assertEqual(ranking[3]['Reasons'], ['subnet not found'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import stat
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import rdscli
+
+
+# Stands in for `aws ssm start-session`: reports the port, then keeps printing far more than a pipe holds,
+# like the plugin does with a line per connection over a long life
+FAKE_AWS = '''#!/bin/sh
+echo "Starting session with SessionId: test"
+echo "Port 12345 opened for sessionId test."
+i=0
+while [ $i -lt 4000 ]; do
+    echo "Connection accepted for session [test] with a line long enough to fill the pipe buffer quickly"
+    i=$((i + 1))
+done
+touch "$DONE_FILE"
+sleep 60
+'''
+
+
+class CliTunnelTest(unittest.TestCase):
+
+    def test_output_is_drained_after_port_is_known(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            aws = os.path.join(tmp, 'aws')
+            with open(aws, 'w') as f:
+                f.write(FAKE_AWS)
+            os.chmod(aws, os.stat(aws).st_mode | stat.S_IEXEC)
+            done_file = os.path.join(tmp, 'done')
+
+            env = {'PATH': tmp + os.pathsep + os.environ['PATH'], 'DONE_FILE': done_file}
+            with mock.patch.dict(os.environ, env):
+                local_port, proc = rdscli.open_tunnel_cli('i-1', 'db.example.com', 3306)
+
+            try:
+                self.assertEqual(local_port, 12345)
+                deadline = time.time() + 10
+                while not os.path.exists(done_file) and time.time() < deadline:
+                    time.sleep(0.05)
+                self.assertTrue(os.path.exists(done_file), 'plugin blocked writing its output')
+            finally:
+                rdscli.close_tunnel_cli(proc)
+                proc.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()